@@ -11,6 +11,13 @@ class PostAdmin(admin.ModelAdmin):
         obj.author = request.user
         obj.save()
 
+class IngestJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'status', 'author', 'created', 'finished', 'post')
+    list_filter = ('status',)
+    readonly_fields = ('payload', 'author', 'claimed_by', 'attempts', 'error', 'post',
+                       'created', 'started', 'finished')
+
 admin.site.register(models.Category)
 admin.site.register(models.Tag)
 admin.site.register(models.Post, PostAdmin)
+admin.site.register(models.IngestJob, IngestJobAdmin)
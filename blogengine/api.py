@@ -0,0 +1,281 @@
+"""
+JSON API over posts, categories and tags, and the ingestion endpoint news
+sources submit posts to.
+
+Clients pick the fields they want with ?fields=a,b,c, and the queries load
+only the columns and relations those fields need, so a client skipping
+text and html never reads the post bodies. Posts are paged newest first by
+the same (pub_date, id) cursors as the HTML listings, categories and tags
+by id; ?limit= sets the page size, up to MAX_LIMIT.
+
+Responses go through the page cache like the HTML pages, and carry a
+strong ETag hashed from their body, so repeat polls with If-None-Match are
+answered 304 Not Modified.
+
+Sources submit posts by POSTing one or a list of them to /api/ingest/ with
+an "Authorization: Token <token>" header naming one of
+BLOGENGINE_INGEST_TOKENS. The posts are queued as IngestJobs, answered 202
+Accepted, and each job's progress can be polled at /api/ingest/<id>/.
+"""
+import hashlib
+import json
+from collections import OrderedDict
+from functools import wraps
+from urllib import urlencode
+
+from django.db.models import Prefetch
+from django.http import HttpResponseNotModified, JsonResponse
+from django.utils.http import parse_etags, quote_etag
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from blogengine import counters, ingest, pagecache, slugcache
+from blogengine.models import Category, IngestJob, Post, Tag, load_stale_text
+from blogengine.pagination import MAX_ID, paginate_by_cursor
+from blogengine.sites import request_site, site_url
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+def absolute_url(request, path):
+    return '%s:%s' % (request.scheme, site_url(request_site(request), path))
+
+def related_record(instance):
+    return {'name': instance.name, 'slug': instance.slug}
+
+# Each field with the columns it reads and how it is rendered
+POST_FIELDS = OrderedDict([
+    ('id', (['id'], lambda request, post: post.id)),
+    ('title', (['title'], lambda request, post: post.title)),
+    ('slug', (['slug'], lambda request, post: post.slug)),
+    ('pub_date', (['pub_date'], lambda request, post: post.pub_date.isoformat())),
+    ('url', (['pub_date', 'slug'],
+             lambda request, post: absolute_url(request, post.get_absolute_url()))),
+    ('author', (['author', 'author__username'],
+                lambda request, post: post.author.username)),
+    ('category', (['category__name', 'category__slug'],
+                  lambda request, post: related_record(post.category) if post.category else None)),
+    ('tags', ([], lambda request, post: [related_record(tag) for tag in post.tags.all()])),
+    ('excerpt', (['excerpt', 'renderer_version'], lambda request, post: post.get_excerpt())),
+    ('text', (['text'], lambda request, post: post.text)),
+    ('html', (['text', 'rendered_text', 'text_hash', 'renderer_version'],
+              lambda request, post: post.get_rendered_text())),
+])
+
+LABEL_FIELDS = OrderedDict([
+    ('id', (['id'], lambda request, label: label.id)),
+    ('name', (['name'], lambda request, label: label.name)),
+    ('slug', (['slug'], lambda request, label: label.slug)),
+    ('description', (['description'], lambda request, label: label.description)),
+    ('post_count', ([], lambda request, label: label.post_count)),
+    ('url', (['slug'], lambda request, label: absolute_url(request, label.get_absolute_url()))),
+])
+
+class BadRequest(Exception):
+    pass
+
+def error_response(message, status=400):
+    return JsonResponse({'error': message}, status=status)
+
+def requested_fields(request, available):
+    """
+    Returns the fields named by ?fields=, or all of them.
+    """
+    if not request.GET.get('fields'):
+        return list(available)
+    fields = [field for field in request.GET['fields'].split(',') if field]
+    unknown = [field for field in fields if field not in available]
+    if unknown:
+        raise BadRequest("Unknown fields %s; choose from %s" % (
+            ', '.join(unknown), ', '.join(available)))
+    return fields
+
+def requested_limit(request):
+    try:
+        limit = int(request.GET.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise BadRequest("limit must be a number")
+    if not 1 <= limit <= MAX_LIMIT:
+        raise BadRequest("limit must be between 1 and %d" % MAX_LIMIT)
+    return limit
+
+def columns(available, fields, always=()):
+    loaded = set(always)
+    for field in fields:
+        loaded.update(available[field][0])
+    return loaded
+
+def records(request, available, fields, instances):
+    return [OrderedDict((field, available[field][1](request, instance)) for field in fields)
+            for instance in instances]
+
+def page_url(request, **params):
+    query = dict(request.GET.items())
+    query.pop('after', None)
+    query.pop('before', None)
+    query.update(params)
+    return absolute_url(request, '%s?%s' % (request.path, urlencode(sorted(query.items()))))
+
+def api_view(view):
+    """
+    Turns a BadRequest into a 400 and adds a strong ETag, answering a
+    matching If-None-Match with 304 Not Modified.
+    """
+    @wraps(view)
+    def json_view(request, *args, **kwargs):
+        try:
+            response = view(request, *args, **kwargs)
+        except BadRequest as error:
+            return error_response(unicode(error))
+        if response.status_code != 200:
+            return response
+        etag = hashlib.md5(response.content).hexdigest()
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
+        response['ETag'] = quote_etag(etag)
+        return response
+    return json_view
+
+def post_queryset(request, fields):
+    # The cursor needs pub_date and id whatever was asked for
+    posts = (Post.objects.for_site(request_site(request))
+                         .only(*columns(POST_FIELDS, fields, ['id', 'pub_date', 'category'])))
+    if 'author' in fields:
+        posts = posts.select_related('author')
+    if 'category' in fields:
+        posts = posts.select_related('category')
+    if 'tags' in fields:
+        posts = posts.prefetch_related(Prefetch('tags', queryset=Tag.objects.only('name', 'slug')))
+    return posts
+
+def post_dependencies(request, post, fields):
+    pagecache.depends_on(request, 'post:%d' % post.id)
+    if 'category' in fields and post.category_id is not None:
+        pagecache.depends_on(request, 'category:%d' % post.category_id)
+    if 'tags' in fields:
+        pagecache.depends_on(request, *['tag:%d' % tag.id for tag in post.tags.all()])
+
+def post_list(request):
+    fields = requested_fields(request, POST_FIELDS)
+    posts = post_queryset(request, fields)
+    pagecache.depends_on(request, 'posts')
+    for model, cache, name in ((Category, slugcache.categories, 'category'),
+                               (Tag, slugcache.tags, 'tag')):
+        slug = request.GET.get(name)
+        if not slug:
+            continue
+        pagecache.depends_on(request, '%s-slug:%s' % (name, slug))
+        instance = cache.get(slug)
+        if instance is None:
+            posts = posts.none()
+            continue
+        pagecache.depends_on(request, '%s-posts:%d' % (name, instance.id))
+        posts = posts.filter(**{name: instance.id})
+
+    try:
+        page = paginate_by_cursor(posts, requested_limit(request),
+                                  after=request.GET.get('after'),
+                                  before=request.GET.get('before'))
+    except ValueError:
+        raise BadRequest("Invalid page cursor")
+    for post in page:
+        post_dependencies(request, post, fields)
+    if 'excerpt' in fields and 'text' not in columns(POST_FIELDS, fields):
+        load_stale_text(page.object_list)
+    return JsonResponse({
+        'results': records(request, POST_FIELDS, fields, page),
+        'next': page_url(request, after=page.next_cursor()) if page.has_next() else None,
+        'previous': (page_url(request, before=page.previous_cursor())
+                     if page.has_previous() else None),
+    })
+
+def post_detail(request, post_id):
+    fields = requested_fields(request, POST_FIELDS)
+    try:
+        post = post_queryset(request, fields).get(id=post_id)
+    except Post.DoesNotExist:
+        return error_response("No post %s" % post_id, status=404)
+    post_dependencies(request, post, fields)
+    return JsonResponse(records(request, POST_FIELDS, fields, [post])[0])
+
+def label_list(request, model, dependency):
+    fields = requested_fields(request, LABEL_FIELDS)
+    labels = model.objects.only(*columns(LABEL_FIELDS, fields, ['id'])).order_by('id')
+    if request.GET.get('after'):
+        try:
+            after = int(request.GET['after'])
+        except ValueError:
+            raise BadRequest("Invalid page cursor")
+        if not -MAX_ID - 1 <= after <= MAX_ID:
+            raise BadRequest("Invalid page cursor")
+        labels = labels.filter(id__gt=after)
+    limit = requested_limit(request)
+    labels = list(labels[:limit + 1])
+    pagecache.depends_on(request, dependency)
+    if 'post_count' in fields:
+        # The counts of the request's site
+        counts = counters.label_counts(model, request_site(request),
+                                       [label.id for label in labels[:limit]])
+        for label in labels:
+            label.post_count = counts.get(label.id, 0)
+        pagecache.depends_on(request, 'post-counts')
+    return JsonResponse({
+        'results': records(request, LABEL_FIELDS, fields, labels[:limit]),
+        'next': page_url(request, after=labels[limit - 1].id) if len(labels) > limit else None,
+    })
+
+def category_list(request):
+    return label_list(request, Category, 'categories')
+
+def tag_list(request):
+    return label_list(request, Tag, 'tags')
+
+def request_author(request):
+    scheme, _, token = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    if scheme.lower() != 'token':
+        return None
+    return ingest.source_author(token.strip())
+
+def job_record(request, job):
+    return OrderedDict([
+        ('id', job.id),
+        ('status', job.status),
+        ('error', job.error),
+        ('post', absolute_url(request, '/api/posts/%d/' % job.post_id) if job.post_id else None),
+        ('url', absolute_url(request, '/api/ingest/%d/' % job.id)),
+    ])
+
+@csrf_exempt
+@require_POST
+def ingest_posts(request):
+    author = request_author(request)
+    if author is None:
+        return error_response("A valid source token is required", status=401)
+    try:
+        submitted = json.loads(request.body)
+    except ValueError:
+        return error_response("The body must be JSON")
+    if isinstance(submitted, dict):
+        submitted = [submitted]
+    if not isinstance(submitted, list) or not 1 <= len(submitted) <= ingest.MAX_BATCH:
+        return error_response("Submit a post or a list of 1 to %d posts" % ingest.MAX_BATCH)
+
+    errors = {}
+    for index, record in enumerate(submitted):
+        try:
+            ingest.clean_record(record)
+        except ValueError as error:
+            errors[index] = unicode(error)
+    if errors:
+        return JsonResponse({'errors': errors}, status=400)
+    jobs = ingest.enqueue(submitted, author)
+    return JsonResponse({'jobs': [job_record(request, job) for job in jobs]}, status=202)
+
+def ingest_status(request, job_id):
+    author = request_author(request)
+    if author is None:
+        return error_response("A valid source token is required", status=401)
+    # Sources only see their own jobs
+    job = IngestJob.objects.filter(id=job_id, author=author).first()
+    if job is None:
+        return error_response("No job %s" % job_id, status=404)
+    return JsonResponse(job_record(request, job))
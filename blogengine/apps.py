@@ -0,0 +1,16 @@
+from django.apps import AppConfig
+
+class BlogEngineConfig(AppConfig):
+    name = 'blogengine'
+    verbose_name = 'Blog engine'
+
+    def ready(self):
+        # Connect the receivers keeping the caches, counters and indexes current
+        import blogengine.counters
+        import blogengine.feedcache
+        import blogengine.months
+        import blogengine.pagecache
+        import blogengine.related
+        import blogengine.search
+        import blogengine.sitemaps
+        import blogengine.slugcache
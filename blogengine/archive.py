@@ -0,0 +1,40 @@
+"""
+Streams every post as one JSON object per line, for backups and analytics.
+
+Posts are walked in id order a chunk at a time, each chunk fetched with its
+categories, authors and sites joined in and its tags prefetched, so memory
+stays flat however large the archive is. The records use the fields
+import_posts reads, so an archive can be imported again.
+"""
+import json
+
+from blogengine.models import Post
+
+def iter_posts(chunk_size=500):
+    last_id = 0
+    while True:
+        chunk = list(Post.objects.filter(id__gt=last_id).order_by('id')
+                                 .select_related('category', 'author', 'site')
+                                 .prefetch_related('tags')[:chunk_size])
+        for post in chunk:
+            yield post
+        if len(chunk) < chunk_size:
+            return
+        last_id = chunk[-1].id
+
+def post_record(post):
+    return {
+        'id': post.id,
+        'title': post.title,
+        'slug': post.slug,
+        'pub_date': post.pub_date.isoformat(),
+        'text': post.text,
+        'author': post.author.username,
+        'site': post.site.domain,
+        'category': post.category.name if post.category else None,
+        'tags': [tag.name for tag in post.tags.all()],
+    }
+
+def archive_lines(chunk_size=500):
+    for post in iter_posts(chunk_size):
+        yield json.dumps(post_record(post)) + '\n'
@@ -0,0 +1,8 @@
+from django.contrib.flatpages.models import FlatPage
+from blogengine.sites import request_site
+
+def navigation(request):
+    # The flat pages of the request's site for the navigation bar, as
+    # get_flatpages would only find those of SITE_ID
+    return {'navigation_pages': FlatPage.objects.filter(sites=request_site(request),
+                                                        registration_required=False)}
@@ -0,0 +1,191 @@
+"""
+Keeps how many posts of each site every Category and Tag has, for the tag
+cloud, the category list and the sitemaps.
+
+The counts live in CategoryCount and TagCount, one row per site and
+category or tag, as the labels are shared by every site but each site
+lists only its own posts. Saving a Post that moved to another category or
+site moves its counts, deleting one drops them, and adding or removing tag
+links moves the tag counts, with UPDATEs of the counters themselves rather
+than recounts. A save that moved nothing leaves the counts, and the
+'post-counts' pages, alone. bulk_create skips the signals, so bulk imports
+apply their counts with add(), and the reconcile_post_counts command
+recounts everything should the counters drift.
+"""
+from collections import Counter, defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from blogengine import pagecache
+from blogengine.models import Category, CategoryCount, Post, Tag, TagCount
+
+COUNT_MODELS = {Category: CategoryCount, Tag: TagCount}
+
+def add_rows(model, site_id, label_ids, delta):
+    rows = model.objects.filter(site_id=site_id, **{model.label_name + '__in': label_ids})
+    if rows.update(posts=F('posts') + delta) == len(label_ids) or delta < 0:
+        return
+    existing = set(rows.values_list(model.label_name + '_id', flat=True))
+    for label_id in label_ids:
+        if label_id in existing:
+            continue
+        try:
+            with transaction.atomic():
+                model.objects.create(site_id=site_id, posts=delta,
+                                     **{model.label_name + '_id': label_id})
+        except IntegrityError:
+            # Another process created the row first
+            model.objects.filter(site_id=site_id, **{model.label_name + '_id': label_id}).update(
+                posts=F('posts') + delta)
+
+def add(model, counts):
+    """
+    Adds a Counter of post counts by (site id, label id) to the counters of
+    the model, Category or Tag.
+    """
+    ids_by_delta = defaultdict(list)
+    for (site_id, label_id), delta in counts.items():
+        if label_id is not None and delta:
+            ids_by_delta[(site_id, delta)].append(label_id)
+    for (site_id, delta), label_ids in ids_by_delta.items():
+        add_rows(COUNT_MODELS[model], site_id, label_ids, delta)
+    if ids_by_delta:
+        pagecache.invalidate(['post-counts'])
+
+def site_counts(model, site):
+    """
+    Returns the counters of the categories or tags, by model, with posts on
+    the site, each with its category or tag loaded.
+    """
+    count_model = COUNT_MODELS[model]
+    return count_model.objects.filter(site=site, posts__gt=0).select_related(count_model.label_name)
+
+def counted_labels(counts):
+    """
+    Returns the categories or tags of counters, each with its count in
+    post_count.
+    """
+    labels = []
+    for count in counts:
+        label = getattr(count, count.label_name)
+        label.post_count = count.posts
+        labels.append(label)
+    return labels
+
+def label_counts(model, site, label_ids):
+    """
+    Returns the site's post counts by category or tag id.
+    """
+    count_model = COUNT_MODELS[model]
+    return dict(count_model.objects.filter(site=site, **{count_model.label_name + '__in': label_ids})
+                                   .values_list(count_model.label_name + '_id', 'posts'))
+
+def reconcile():
+    """
+    Recounts the posts of every site in every category and tag, returning
+    the number of counters that were wrong.
+    """
+    fixed = 0
+    with transaction.atomic():
+        category_counts = (Post.objects.exclude(category=None).order_by()
+                                       .values_list('site', 'category')
+                                       .annotate(posts=Count('id')))
+        tag_counts = (Post.tags.through.objects.order_by().values_list('post__site', 'tag')
+                                                .annotate(posts=Count('id')))
+        for model, counts in ((CategoryCount, category_counts), (TagCount, tag_counts)):
+            counts = dict(((site_id, label_id), posts) for site_id, label_id, posts in counts)
+            rows = model.objects.values_list('id', 'site_id', model.label_name + '_id', 'posts')
+            for row_id, site_id, label_id, posts in rows:
+                expected = counts.pop((site_id, label_id), 0)
+                if expected != posts:
+                    model.objects.filter(id=row_id).update(posts=expected)
+                    fixed += 1
+            # Left are the counts without a row
+            model.objects.bulk_create(model(site_id=site_id, posts=posts,
+                                            **{model.label_name + '_id': label_id})
+                                      for (site_id, label_id), posts in counts.items())
+            fixed += len(counts)
+    if fixed:
+        pagecache.invalidate(['post-counts'])
+    return fixed
+
+def post_tag_ids(post_id):
+    return list(Post.tags.through.objects.filter(post_id=post_id)
+                                         .values_list('tag_id', flat=True))
+
+@receiver(post_save, sender=Post)
+def post_saved(sender, instance, created, **kwargs):
+    if created:
+        add(Category, Counter([(instance.site_id, instance.category_id)]))
+        return
+    # Saved without its category or site loaded, it stayed where it was
+    site_id = instance.saved_values.get('site_id', instance.site_id)
+    category_id = instance.saved_values.get('category_id', instance.category_id)
+    if (site_id, category_id) != (instance.site_id, instance.category_id):
+        add(Category, Counter({(instance.site_id, instance.category_id): 1,
+                               (site_id, category_id): -1}))
+    if site_id != instance.site_id:
+        tag_counts = Counter()
+        for tag_id in post_tag_ids(instance.id):
+            tag_counts[(instance.site_id, tag_id)] += 1
+            tag_counts[(site_id, tag_id)] -= 1
+        add(Tag, tag_counts)
+
+@receiver(pre_delete, sender=Post)
+def post_deleting(sender, instance, **kwargs):
+    # The tag links are deleted along with the post
+    instance.counted_tag_ids = post_tag_ids(instance.id)
+
+@receiver(post_delete, sender=Post)
+def post_deleted(sender, instance, **kwargs):
+    add(Category, Counter({(instance.site_id, instance.category_id): -1}))
+    add(Tag, Counter(dict(((instance.site_id, tag_id), -1)
+                          for tag_id in instance.counted_tag_ids)))
+
+def linked_tag_counts(instance, reverse, pk_set=None):
+    # How many links of each site each tag has among those about to go
+    links = Post.tags.through.objects.all()
+    if reverse:
+        links = links.filter(tag_id=instance.id)
+        if pk_set is not None:
+            links = links.filter(post_id__in=pk_set)
+    else:
+        links = links.filter(post_id=instance.id)
+        if pk_set is not None:
+            links = links.filter(tag_id__in=pk_set)
+    return Counter(links.values_list('post__site', 'tag_id'))
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def post_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        instance.removed_tag_counts = linked_tag_counts(instance, reverse)
+    elif action == 'pre_remove':
+        # pk_set may name links that don't exist
+        instance.removed_tag_counts = linked_tag_counts(instance, reverse, pk_set)
+    elif action in ('post_clear', 'post_remove'):
+        add(Tag, Counter(dict((key, -posts) for key, posts in
+                              instance.removed_tag_counts.items())))
+    elif action == 'post_add':
+        # pk_set only holds the new links
+        if reverse:
+            add(Tag, Counter((site_id, instance.id) for site_id in
+                             Post.objects.filter(id__in=pk_set).values_list('site_id', flat=True)))
+        else:
+            add(Tag, Counter((instance.site_id, tag_id) for tag_id in pk_set))
+
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Tag)
+def counted_saved(sender, instance, **kwargs):
+    # The cloud and the category list show names and slugs too, but only
+    # of those with posts
+    count_model = COUNT_MODELS[sender]
+    counts = count_model.objects.filter(posts__gt=0, **{count_model.label_name: instance})
+    if counts.exists():
+        pagecache.invalidate(['post-counts'])
+
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=Tag)
+def counted_deleted(sender, instance, **kwargs):
+    pagecache.invalidate(['post-counts'])
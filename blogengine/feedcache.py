@@ -0,0 +1,231 @@
+"""
+Stores the serialized XML of every RSS feed so requests seldom build one.
+
+Feeds are identified by a (site id, category slug) pair, with a slug of None
+standing for the feed of all the site's posts. Each is stored with an ETag
+hashed from the id, pub_date, title and text hash of its posts and the
+newest pub_date as its last modified time, which answer conditional polls;
+rebuilding a feed whose posts are unchanged keeps its validators.
+
+Entries are rebuilt whenever a Post, Category or Tag that can appear in
+them changes; within a request, FeedRebuildMiddleware has the feeds its
+saves changed rebuilt once each as it responds, rather than once for every
+signal. With BLOGENGINE_FEED_CACHE_ASYNC the stale entries are only dropped
+during the save and rebuilt by the next request for them, so admin saves
+don't pay for the feed render. Django has no hook for a transaction's
+commit, so rebuilding later from another thread could read the rows from
+before it; a request in that window can still store the old feed, until
+the timeout below.
+
+Only one process rebuilds a feed, so BLOGENGINE_FEED_CACHE must be a cache
+shared by all of them; entries also expire after
+BLOGENGINE_FEED_CACHE_TIMEOUT seconds, which bounds how long a feed stored
+elsewhere can go stale.
+"""
+import hashlib
+import threading
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core import checks
+from django.core.cache import caches
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.http import Http404, HttpRequest, HttpResponse
+from blogengine import metrics
+from blogengine.models import Category, Post, Tag
+
+# Caches each process keeps to itself, where a save only rebuilds the feeds
+# of the process that made it
+LOCAL_CACHE_BACKENDS = ('django.core.cache.backends.locmem.LocMemCache',)
+
+# What of each post the validators are hashed from
+VALIDATED_FIELDS = ('id', 'pub_date', 'title', 'text_hash')
+
+_local = threading.local()
+
+def feed_cache_name():
+    return getattr(settings, 'BLOGENGINE_FEED_CACHE', 'default')
+
+def feed_cache():
+    return caches[feed_cache_name()]
+
+def feed_cache_timeout():
+    return getattr(settings, 'BLOGENGINE_FEED_CACHE_TIMEOUT', 10 * 60)
+
+@checks.register()
+def check_feed_cache(app_configs, **kwargs):
+    backend = settings.CACHES.get(feed_cache_name(), {}).get('BACKEND')
+    if settings.DEBUG or backend not in LOCAL_CACHE_BACKENDS:
+        return []
+    return [checks.Warning(
+        "BLOGENGINE_FEED_CACHE names a cache private to each process, so other "
+        "processes serve their old feeds until BLOGENGINE_FEED_CACHE_TIMEOUT.",
+        hint="Point it at a cache shared by all processes, such as memcached.",
+        id='blogengine.W001')]
+
+def feed_key(site_id, slug=None):
+    if slug is None:
+        return 'blogengine:feed-xml:%d:posts' % site_id
+    return 'blogengine:feed-xml:%d:category:%s' % (site_id, slug)
+
+def feed_path(slug=None):
+    if slug is None:
+        return '/feeds/posts/'
+    return '/feeds/posts/category/%s/' % slug
+
+def get_feed(site_id, slug=None):
+    """
+    Returns the stored (content, content type, ETag, last modified) of a
+    feed, or None.
+    """
+    cached = feed_cache().get(feed_key(site_id, slug))
+    metrics.record_hit('feed', cached is not None)
+    return cached
+
+def feed_response(feed):
+    content, content_type, etag, last_modified = feed
+    return HttpResponse(content, content_type=content_type)
+
+def feed_validators(posts):
+    """
+    Returns the ETag and last modified time of a feed of posts, given as
+    rows of their VALIDATED_FIELDS newest first.
+    """
+    digest = hashlib.md5()
+    for post_id, pub_date, title, text_hash in posts:
+        digest.update((u'%d\t%s\t%s\t%s\n' % (post_id, pub_date.isoformat(), text_hash, title))
+                      .encode('utf-8'))
+    # HTTP dates are in whole seconds
+    last_modified = posts[0][1].replace(microsecond=0) if posts else None
+    return digest.hexdigest(), last_modified
+
+def store_feed_response(site_id, slug, response, posts):
+    """
+    Stores a rendered feed with the validators of its posts, given as for
+    feed_validators(), and returns it as get_feed() would.
+    """
+    etag, last_modified = feed_validators(posts)
+    feed = (response.content, response['Content-Type'], etag, last_modified)
+    if response.status_code == 200:
+        feed_cache().set(feed_key(site_id, slug), feed, feed_cache_timeout())
+    return feed
+
+def rebuild_feed(site_id, slug=None):
+    from blogengine.views import CategoryPostsFeed, PostsFeed
+
+    request = HttpRequest()
+    request.method = 'GET'
+    request.path = feed_path(slug)
+    try:
+        request.site = Site.objects.get(id=site_id)
+        if slug is None:
+            feed = PostsFeed()
+            response = feed.render_feed(request)
+        else:
+            feed = CategoryPostsFeed()
+            response = feed.render_feed(request, slug=slug)
+    except (Http404, Site.DoesNotExist):
+        feed_cache().delete(feed_key(site_id, slug))
+    else:
+        store_feed_response(site_id, slug, response, feed.validated_posts(request))
+
+def rebuild_feeds(feeds):
+    if getattr(settings, 'BLOGENGINE_FEED_CACHE_ASYNC', False):
+        # Rebuilt by the next request for them, once the save has committed
+        feed_cache().delete_many([feed_key(site_id, slug) for site_id, slug in feeds])
+        return
+    deferred = getattr(_local, 'feeds', None)
+    if deferred is not None:
+        deferred.update(feeds)
+        return
+    for site_id, slug in feeds:
+        rebuild_feed(site_id, slug)
+
+def defer_rebuilds():
+    """
+    Collects the feeds rebuild_feeds() is given until rebuild_deferred(),
+    so each is rebuilt once however many signals change it.
+    """
+    _local.feeds = set()
+
+def rebuild_deferred():
+    feeds = getattr(_local, 'feeds', None)
+    _local.feeds = None
+    if feeds:
+        rebuild_feeds(feeds)
+
+class FeedRebuildMiddleware(object):
+    """
+    Rebuilds the feeds a request's saves changed once, as it responds and
+    after the view's transaction has committed, rather than on each signal:
+    an admin save of a tagged post sends post_save and m2m_changed for
+    every tag removed and added.
+    """
+    def process_request(self, request):
+        defer_rebuilds()
+
+    def process_response(self, request, response):
+        rebuild_deferred()
+        return response
+
+def post_feeds(posts):
+    # The feeds of all posts plus every category feed, on every site the
+    # posts are or were on
+    site_ids = set()
+    category_ids = set()
+    for post in posts:
+        site_ids.update([post.site_id, post.saved_values.get('site_id')])
+        category_ids.update([post.category_id, post.saved_values.get('category_id')])
+    site_ids.discard(None)
+    category_ids.discard(None)
+    slugs = set([None])
+    if category_ids:
+        slugs.update(Category.objects.filter(id__in=category_ids)
+                                     .values_list('slug', flat=True))
+    return set((site_id, slug) for site_id in site_ids for slug in slugs)
+
+def category_feeds(slugs):
+    site_ids = Site.objects.values_list('id', flat=True)
+    return set((site_id, slug) for site_id in site_ids for slug in slugs)
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def post_changed(sender, instance, **kwargs):
+    rebuild_feeds(post_feeds([instance]))
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_changed(sender, instance, **kwargs):
+    slugs = set([instance.slug, instance.saved_values.get('slug')])
+    slugs.discard(None)
+    rebuild_feeds(category_feeds(slugs))
+
+def tagged_post_feeds(tag):
+    return post_feeds(Post.objects.filter(tags=tag).only('id', 'category', 'site'))
+
+@receiver(post_save, sender=Tag)
+def tag_saved(sender, instance, **kwargs):
+    rebuild_feeds(tagged_post_feeds(instance))
+
+@receiver(pre_delete, sender=Tag)
+def tag_deleting(sender, instance, **kwargs):
+    # The tagged posts can't be found any more once the tag is gone
+    instance.feeds = tagged_post_feeds(instance)
+
+@receiver(post_delete, sender=Tag)
+def tag_deleted(sender, instance, **kwargs):
+    rebuild_feeds(instance.feeds)
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def post_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action.startswith('post_'):
+            rebuild_feeds(post_feeds([instance]))
+    elif action == 'pre_clear':
+        instance.feeds = tagged_post_feeds(instance)
+    elif action == 'post_clear':
+        rebuild_feeds(instance.feeds)
+    elif action.startswith('post_'):
+        posts = Post.objects.filter(id__in=pk_set).only('id', 'category', 'site')
+        rebuild_feeds(post_feeds(posts))
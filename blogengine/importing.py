@@ -0,0 +1,307 @@
+"""
+Streams posts from JSON lines or CSV files into the database in batches.
+
+Each record has a title and text, and optionally a slug, pub_date (ISO 8601),
+author username, site domain, category name and tags, either a list or a
+comma separated string of names. Records are read lazily and handled a batch
+at a time: the batch's categories, tags, authors and sites are resolved with
+one lookup each and the missing categories and tags created with
+bulk_create, the Markdown is rendered in a process pool, and the posts and
+their tag links are inserted with bulk_create. Posts whose slug already
+exists are skipped, so an interrupted import can be run again; with
+allocate_slugs, records without a slug are instead given a unique one made
+from their title. Should another writer take a slug, category or tag first,
+the batch is rolled back and inserted again.
+
+bulk_create skips the model signals, so each batch is added to the search
+index, the archive month counts and the category and tag post counts itself,
+and the caches and feeds are brought up to date once the import is done.
+"""
+import csv
+import json
+from collections import Counter
+from itertools import islice
+from multiprocessing import Pool
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.text import slugify
+from blogengine import counters, feedcache, months, pagecache, search, sitemaps, slugcache
+from blogengine.models import Category, Post, Tag
+from blogengine.rendering import RENDERER_VERSION, make_excerpt, render_markdown, text_digest
+from blogengine.slugs import ATTEMPTS as SLUG_ATTEMPTS, allocate_slugs, slug_base
+
+SLUG_LENGTH = Post._meta.get_field('slug').max_length
+
+def slug_for(name):
+    return slugify(unicode(name))[:SLUG_LENGTH]
+
+def read_records(path, format=None):
+    """
+    Yields the records of a .jsonl or .csv file as dicts.
+    """
+    format = format or ('csv' if path.endswith('.csv') else 'jsonl')
+    with open(path, 'rb') as f:
+        if format == 'csv':
+            for row in csv.DictReader(f):
+                yield dict((key, value.decode('utf-8')) for key, value in row.items())
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+def batches(records, size):
+    records = iter(records)
+    while True:
+        batch = list(islice(records, size))
+        if not batch:
+            return
+        yield batch
+
+def record_name(record):
+    return '"%s"' % (record.get('slug') or record.get('title'))
+
+def record_pub_date(record, default=None):
+    """
+    Returns the record's pub_date as an aware datetime, or default if it has
+    none, raising ValueError if it isn't an ISO 8601 date and time.
+    """
+    if not record.get('pub_date'):
+        return default
+    try:
+        pub_date = parse_datetime(record['pub_date'])
+    except ValueError:
+        pub_date = None
+    if pub_date is None:
+        raise ValueError("pub_date must be an ISO 8601 date and time")
+    if timezone.is_naive(pub_date):
+        pub_date = timezone.make_aware(pub_date, timezone.get_current_timezone())
+    return pub_date
+
+def tag_names(record):
+    tags = record.get('tags') or []
+    if isinstance(tags, basestring):
+        tags = tags.split(',')
+    return [name.strip() for name in tags if name.strip()]
+
+def resolve(model, names):
+    """
+    Returns a dict of the instances of Category or Tag with the given names
+    by slug, creating the missing ones.
+    """
+    slugs = dict((slug_for(name), name) for name in names)
+    slugs.pop('', None)
+    found = dict((instance.slug, instance)
+                 for instance in model.objects.filter(slug__in=slugs.keys()))
+    missing = [model(name=name, slug=slug, description='')
+               for slug, name in slugs.items() if slug not in found]
+    if missing:
+        model.objects.bulk_create(missing)
+        found.update((instance.slug, instance) for instance in
+                     model.objects.filter(slug__in=[instance.slug for instance in missing]))
+    return found
+
+def render_text(text):
+    html = render_markdown(text)
+    return html, text_digest(text), make_excerpt(html)
+
+class Importer(object):
+    """
+    Imports batches of records, keeping count of what it did and of what
+    the caches need to forget afterwards.
+    """
+    def __init__(self, author, processes=1, allocate_slugs=False):
+        self.default_author = author
+        self.pool = Pool(processes) if processes > 1 else None
+        self.allocate_slugs = allocate_slugs
+        self.imported = 0
+        self.skipped = 0
+        self.site_ids = set()
+        self.category_ids = set()
+        self.tag_ids = set()
+        # The lowest id imported on each site, the first sitemap chunk
+        # they change
+        self.first_ids = {}
+
+    def render(self, texts):
+        if self.pool is None:
+            return map(render_text, texts)
+        return self.pool.map(render_text, texts)
+
+    def record_slugs(self, records):
+        """
+        Returns the slug each record is imported under, or None for the
+        records skipped because their slug is taken, or was earlier in the
+        batch.
+        """
+        wanted = [record['slug'][:SLUG_LENGTH] if record.get('slug') else None
+                  for record in records]
+        if not self.allocate_slugs:
+            wanted = [slug or slug_base(Post, record['title'])
+                      for slug, record in zip(wanted, records)]
+        taken = set(Post.objects.filter(slug__in=[slug for slug in wanted if slug])
+                                .values_list('slug', flat=True))
+        slugs = []
+        for slug in wanted:
+            if slug is not None and slug not in taken:
+                taken.add(slug)
+                slugs.append(slug)
+            else:
+                slugs.append(None)
+
+        # The rest are given one, after the slugs records asked for
+        untitled = [index for index, slug in enumerate(wanted) if slug is None]
+        bases = [slug_base(Post, records[index]['title']) for index in untitled]
+        for index, slug in zip(untitled, allocate_slugs(Post, bases, reserved=taken)):
+            slugs[index] = slug
+        return slugs
+
+    def import_batch(self, records):
+        """
+        Imports the records, returning the post created for each, or None
+        where one was skipped.
+        """
+        renderings = {}
+        for attempt in range(SLUG_ATTEMPTS):
+            slugs = self.record_slugs(records)
+            unrendered = [index for index, slug in enumerate(slugs)
+                          if slug is not None and index not in renderings]
+            renderings.update(zip(unrendered, self.render([records[index]['text']
+                                                           for index in unrendered])))
+            try:
+                with transaction.atomic():
+                    posts, links = self.insert_batch(records, slugs, renderings)
+                break
+            except IntegrityError:
+                if attempt + 1 == SLUG_ATTEMPTS:
+                    raise
+
+        created = [post for post in posts if post is not None]
+        self.imported += len(created)
+        self.skipped += len(records) - len(created)
+        self.site_ids.update(post.site_id for post in created)
+        self.category_ids.update(post.category_id for post in created
+                                 if post.category_id is not None)
+        self.tag_ids.update(tag_id for post_id, tag_id in links)
+        for post in created:
+            self.first_ids[post.site_id] = min(post.id, self.first_ids.get(post.site_id, post.id))
+        return posts
+
+    def insert_batch(self, records, slugs, renderings):
+        # The posts, with None for the records skipped, and their tag links
+        batch = [(record, slug, renderings[index])
+                 for index, (record, slug) in enumerate(zip(records, slugs)) if slug is not None]
+        if not batch:
+            return [None] * len(records), set()
+
+        now = timezone.now()
+        pub_dates = []
+        for record, slug, rendering in batch:
+            if not (record.get('author') or self.default_author):
+                raise ValueError("Post %s has no author and no default author was given"
+                                 % record_name(record))
+            try:
+                pub_dates.append(record_pub_date(record, now))
+            except ValueError as error:
+                raise ValueError("Post %s: %s" % (record_name(record), error))
+
+        categories = resolve(Category, [record['category'] for record, slug, rendering in batch
+                                        if record.get('category')])
+        tags = resolve(Tag, [name for record, slug, rendering in batch
+                             for name in tag_names(record)])
+        usernames = set(record.get('author') or self.default_author
+                        for record, slug, rendering in batch)
+        authors = dict(User.objects.filter(username__in=usernames)
+                                   .values_list('username', 'id'))
+        unknown = usernames - set(authors)
+        if unknown:
+            raise ValueError("Unknown authors: %s" % ', '.join(sorted(unknown)))
+        domains = set(record['site'] for record, slug, rendering in batch if record.get('site'))
+        sites = dict(Site.objects.filter(domain__in=domains).values_list('domain', 'id'))
+        unknown = domains - set(sites)
+        if unknown:
+            raise ValueError("Unknown sites: %s" % ', '.join(sorted(unknown)))
+
+        posts = []
+        for (record, slug, (rendered_text, text_hash, excerpt)), pub_date in zip(batch, pub_dates):
+            category = categories.get(slug_for(record.get('category') or ''))
+            posts.append(Post(title=record['title'], slug=slug,
+                              text=record['text'], pub_date=pub_date,
+                              author_id=authors[record.get('author') or self.default_author],
+                              site_id=sites.get(record.get('site'), settings.SITE_ID),
+                              category_id=category.id if category else None,
+                              rendered_text=rendered_text, text_hash=text_hash, excerpt=excerpt,
+                              renderer_version=RENDERER_VERSION))
+
+        Post.objects.bulk_create(posts)
+        # bulk_create doesn't hand back primary keys
+        ids = dict(Post.objects.filter(slug__in=[post.slug for post in posts])
+                               .values_list('slug', 'id'))
+        links = set()
+        post_sites = {}
+        for post, (record, slug, rendering) in zip(posts, batch):
+            post.id = ids[post.slug]
+            post_sites[post.id] = post.site_id
+            for name in tag_names(record):
+                tag = tags.get(slug_for(name))
+                if tag is not None:
+                    links.add((post.id, tag.id))
+        Through = Post.tags.through
+        Through.objects.bulk_create(Through(post_id=post_id, tag_id=tag_id)
+                                    for post_id, tag_id in links)
+        search.backend().index(posts)
+        months.add(Counter(months.month_of(post.site_id, post.pub_date) for post in posts))
+        counters.add(Category, Counter((post.site_id, post.category_id) for post in posts))
+        counters.add(Tag, Counter((post_sites[post_id], tag_id) for post_id, tag_id in links))
+
+        created = iter(posts)
+        return [next(created) if slug is not None else None for slug in slugs], links
+
+    def finish(self):
+        """
+        Shuts the render pool down and brings the caches and feeds up to
+        date with the imported posts.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        if not self.imported:
+            return
+
+        category_slugs = list(Category.objects.filter(id__in=self.category_ids)
+                                              .values_list('slug', flat=True))
+        tag_slugs = Tag.objects.filter(id__in=self.tag_ids).values_list('slug', flat=True)
+        dependencies = ['posts']
+        for site_id, post_id in self.first_ids.items():
+            dependencies.append('sitemap-index:%d' % site_id)
+            dependencies.extend(sitemaps.chunks_from(site_id, post_id))
+        dependencies.extend('category-posts:%d' % category_id for category_id in self.category_ids)
+        dependencies.extend('category-slug:%s' % slug for slug in category_slugs)
+        dependencies.extend('tag-posts:%d' % tag_id for tag_id in self.tag_ids)
+        dependencies.extend('tag-slug:%s' % slug for slug in tag_slugs)
+        pagecache.invalidate(dependencies)
+        slugcache.categories.invalidate()
+        slugcache.tags.invalidate()
+        slugcache.posts.invalidate()
+        feedcache.rebuild_feeds(set((site_id, slug) for site_id in self.site_ids
+                                    for slug in [None] + category_slugs))
+
+def import_posts(records, author, batch_size=500, processes=1, allocate_slugs=False,
+                 progress=None):
+    """
+    Imports the records in batches, calling progress with the importer after
+    each one, and returns the importer.
+    """
+    importer = Importer(author, processes=processes, allocate_slugs=allocate_slugs)
+    try:
+        for batch in batches(records, batch_size):
+            importer.import_batch(batch)
+            if progress is not None:
+                progress(importer)
+    finally:
+        importer.finish()
+    return importer
@@ -0,0 +1,152 @@
+"""
+Queue of posts submitted by outside news sources.
+
+The ingestion API checks each submission and stores it as an IngestJob,
+answering straight away; the process_ingest_queue command then imports the
+jobs in batches through importing.Importer, so slugs, Markdown rendering,
+category and tag resolution, the search index, the counters and the caches
+are all handled as for a bulk import, away from the request threads. Posts
+submitted without a slug are given a unique one, and those naming a slug
+that is taken fail, so a source can resubmit safely by sending slugs. The
+imported posts are then scored for related posts.
+
+Any number of workers can drain the queue at once: each claims a batch by
+marking it with its own id in one UPDATE, and jobs still running after
+BLOGENGINE_INGEST_TIMEOUT seconds, their worker having died, are put back
+until they have been tried MAX_ATTEMPTS times.
+"""
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from blogengine import related
+from blogengine.importing import Importer, record_pub_date
+from blogengine.models import IngestJob, Post
+
+# Most posts accepted in one submission
+MAX_BATCH = 100
+MAX_ATTEMPTS = 3
+
+RECORD_FIELDS = ('title', 'text', 'slug', 'pub_date', 'site', 'category', 'tags')
+TITLE_LENGTH = Post._meta.get_field('title').max_length
+
+def ingest_timeout():
+    return getattr(settings, 'BLOGENGINE_INGEST_TIMEOUT', 10 * 60)
+
+def source_author(token):
+    """
+    Returns the User whose posts the source with the token submits, or None
+    if no source has it.
+    """
+    for source_token, username in getattr(settings, 'BLOGENGINE_INGEST_TOKENS', {}).items():
+        if token and constant_time_compare(token, source_token):
+            return User.objects.filter(username=username).first()
+    return None
+
+def clean_record(record):
+    """
+    Checks a submitted post has the fields import_posts reads, raising
+    ValueError if not. Posts are by the source's user, so author is refused.
+    """
+    if not isinstance(record, dict):
+        raise ValueError("A post must be an object")
+    unknown = set(record) - set(RECORD_FIELDS)
+    if unknown:
+        raise ValueError("Unknown fields: %s" % ', '.join(sorted(unknown)))
+    for field in ('title', 'text'):
+        if not isinstance(record.get(field), basestring) or not record[field].strip():
+            raise ValueError("%s is required" % field)
+    if len(record['title']) > TITLE_LENGTH:
+        raise ValueError("title is longer than %d characters" % TITLE_LENGTH)
+    for field in ('slug', 'pub_date', 'site', 'category'):
+        if record.get(field) is not None and not isinstance(record[field], basestring):
+            raise ValueError("%s must be a string" % field)
+    record_pub_date(record)
+    tags = record.get('tags')
+    if not (tags is None or isinstance(tags, basestring) or
+            (isinstance(tags, list) and all(isinstance(tag, basestring) for tag in tags))):
+        raise ValueError("tags must be a list of names or a comma separated string")
+
+def enqueue(records, author):
+    with transaction.atomic():
+        return [IngestJob.objects.create(payload=json.dumps(record), author=author)
+                for record in records]
+
+def requeue_stale(timeout=None):
+    """
+    Puts jobs that have been running longer than the timeout back in the
+    queue, or fails them if they were tried too often, returning how many
+    were put back.
+    """
+    timeout = ingest_timeout() if timeout is None else timeout
+    now = timezone.now()
+    stale = IngestJob.objects.filter(status=IngestJob.RUNNING,
+                                     started__lt=now - timedelta(seconds=timeout))
+    stale.filter(attempts__gte=MAX_ATTEMPTS).update(
+        status=IngestJob.FAILED, finished=now,
+        error="Gave up after %d attempts" % MAX_ATTEMPTS)
+    return stale.update(status=IngestJob.PENDING, claimed_by='')
+
+def claim(batch_size, worker):
+    """
+    Marks up to batch_size of the oldest pending jobs as running for the
+    worker and returns them.
+    """
+    ids = list(IngestJob.objects.filter(status=IngestJob.PENDING).order_by('id')
+                                .values_list('id', flat=True)[:batch_size])
+    if not ids:
+        return []
+    IngestJob.objects.filter(id__in=ids, status=IngestJob.PENDING).update(
+        status=IngestJob.RUNNING, claimed_by=worker, started=timezone.now(),
+        attempts=F('attempts') + 1)
+    # Other workers may have claimed some of them first
+    return list(IngestJob.objects.filter(id__in=ids, status=IngestJob.RUNNING,
+                                         claimed_by=worker)
+                                 .select_related('author').order_by('id'))
+
+def finish_job(job, status, post_id=None, error=''):
+    IngestJob.objects.filter(id=job.id).update(status=status, post=post_id, error=error,
+                                               finished=timezone.now())
+
+def job_record(job):
+    record = json.loads(job.payload)
+    record['author'] = job.author.username
+    return record
+
+def import_jobs(importer, jobs):
+    records = [job_record(job) for job in jobs]
+    try:
+        posts = importer.import_batch(records)
+    except Exception as error:
+        if len(jobs) > 1:
+            # One at a time, to find the jobs at fault
+            return [post for job in jobs for post in import_jobs(importer, [job])]
+        finish_job(jobs[0], IngestJob.FAILED, error=unicode(error) or error.__class__.__name__)
+        return []
+
+    for job, record, post in zip(jobs, records, posts):
+        if post is None:
+            finish_job(job, IngestJob.FAILED,
+                       error="A post with the slug %s already exists" % record['slug'])
+        else:
+            finish_job(job, IngestJob.DONE, post_id=post.id)
+    return [post for post in posts if post is not None]
+
+def process(jobs, processes=1):
+    """
+    Imports the claimed jobs, rendering their Markdown in the given number
+    of processes, and returns the posts created.
+    """
+    importer = Importer(None, processes=processes, allocate_slugs=True)
+    try:
+        posts = import_jobs(importer, jobs)
+    finally:
+        importer.finish()
+    for post in posts:
+        related.update_related(post)
+    return posts
@@ -0,0 +1,206 @@
+import json
+import platform
+import subprocess
+import time
+from optparse import make_option
+
+import django
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from blogengine import counters, feedcache, months
+from blogengine.models import Category, Post, Tag
+from blogengine.seeding import seed_posts
+
+# The cache the measured views use in place of the site's
+BENCHMARK_CACHE = 'blogengine-benchmark'
+
+def percentile(timings, fraction):
+    # Nearest rank of sorted timings
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark_settings():
+    # A cache of its own, so measuring neither reads, fills nor clears the
+    # site's caches
+    cache_settings = dict(settings.CACHES)
+    cache_settings[BENCHMARK_CACHE] = {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': BENCHMARK_CACHE,
+    }
+    return {
+        'CACHES': cache_settings,
+        'BLOGENGINE_PAGE_CACHE': BENCHMARK_CACHE,
+        'BLOGENGINE_FEED_CACHE': BENCHMARK_CACHE,
+        'BLOGENGINE_SLUG_CACHE': BENCHMARK_CACHE,
+        'BLOGENGINE_RENDER_CACHE': BENCHMARK_CACHE,
+    }
+
+def clear_caches():
+    caches[BENCHMARK_CACHE].clear()
+
+class Command(BaseCommand):
+    help = ("Measures requests per second, latency percentiles and query counts "
+            "of the public views and feeds over synthetic posts seeded into a "
+            "throwaway database, or over the configured database as it is, and "
+            "writes them as JSON.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--seed', type='int', default=0,
+                    help='Number of synthetic posts to add to the throwaway database.'),
+        make_option('--existing-database', action='store_true', default=False,
+                    help='Measure the configured database, adding nothing to it, '
+                         'instead of a throwaway one.'),
+        make_option('--tags-per-post', type='int', default=3,
+                    help='Tags on each seeded post.'),
+        make_option('--text-words', type='int', default=200,
+                    help='Words in each seeded post.'),
+        make_option('--requests', type='int', default=200,
+                    help='Number of timed requests per view and mode.'),
+        make_option('--warmup', type='int', default=10,
+                    help='Untimed requests made before each measurement.'),
+        make_option('--output', default=None,
+                    help='File to write the JSON results to, instead of stdout.'),
+        make_option('--compare', default=None,
+                    help='Earlier JSON results to print the change against.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['existing_database'] and options['seed']:
+            raise CommandError("--seed only seeds the throwaway database; "
+                               "drop --existing-database to use it.")
+        with override_settings(**benchmark_settings()):
+            if options['existing_database']:
+                self.benchmark(options)
+                return
+            # Created like the test runner's, and dropped afterwards
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                self.benchmark(options)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def benchmark(self, options):
+        if options['seed']:
+            started = time.time()
+            seed_posts(options['seed'], tags_per_post=options['tags_per_post'],
+                       text_words=options['text_words'])
+            # bulk_create skips the signals keeping these current
+            counters.reconcile()
+            months.rebuild_counts()
+            self.stderr.write("Seeded %d posts in %.1fs" % (options['seed'],
+                                                           time.time() - started))
+
+        # The newest tagged post, whose category and tag listings are sure
+        # to have posts
+        post = (Post.objects.filter(category__isnull=False, tags__isnull=False)
+                            .order_by('-pub_date', '-id').first())
+        if post is None:
+            raise CommandError("Need a post with a category and a tag; "
+                               "use --seed to create some.")
+        category = post.category
+        tag = post.tags.order_by('id').first()
+
+        views = [
+            ('index', '/'),
+            ('detail', post.get_absolute_url()),
+            ('category', category.get_absolute_url()),
+            ('tag', tag.get_absolute_url()),
+            ('feed', feedcache.feed_path()),
+            ('category feed', feedcache.feed_path(category.slug)),
+        ]
+        results = {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'existing_database': options['existing_database'],
+            'dataset': {
+                'posts': Post.objects.count(),
+                'categories': Category.objects.count(),
+                'tags': Tag.objects.count(),
+                'tag_links': Post.tags.through.objects.count(),
+                'tags_per_post': options['tags_per_post'],
+                'text_words': options['text_words'],
+            },
+            'views': {},
+        }
+        client = Client()
+        for name, path in views:
+            results['views'][name] = {
+                # Served from the page and feed caches, as most requests are
+                'cached': self.measure(client, path, options, cold=False),
+                # Rendered from the database on every request
+                'uncached': self.measure(client, path, options, cold=True),
+            }
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+        if options['compare']:
+            with open(options['compare']) as previous_file:
+                self.compare(json.load(previous_file), results)
+
+    def measure(self, client, path, options, cold):
+        clear_caches()
+        for _ in range(options['warmup']):
+            if cold:
+                clear_caches()
+            self.get(client, path)
+
+        if cold:
+            clear_caches()
+        with CaptureQueriesContext(connection) as queries:
+            self.get(client, path)
+        # Read now, as later requests reset the query log
+        query_count = len(queries)
+
+        # Queries are counted apart, as logging them slows the timed requests
+        timings = []
+        for _ in range(options['requests']):
+            if cold:
+                clear_caches()
+            started = time.time()
+            self.get(client, path)
+            timings.append((time.time() - started) * 1000)
+        timings.sort()
+        return {
+            'requests': len(timings),
+            'requests_per_second': len(timings) / (sum(timings) / 1000) if sum(timings) else None,
+            'p50_ms': percentile(timings, 0.5),
+            'p99_ms': percentile(timings, 0.99),
+            'queries': query_count,
+        }
+
+    def get(self, client, path):
+        response = client.get(path)
+        if response.status_code != 200:
+            raise CommandError("%s answered %d" % (path, response.status_code))
+        return response
+
+    def compare(self, previous, results):
+        self.stderr.write("Changes against %s:" % (previous.get('commit') or 'earlier results'))
+        for name in sorted(results['views']):
+            for mode in ('cached', 'uncached'):
+                now = results['views'][name][mode]
+                before = previous.get('views', {}).get(name, {}).get(mode)
+                if not before:
+                    continue
+                self.stderr.write("%s, %s: p50 %.2fms -> %.2fms (%+.0f%%), queries %d -> %d" % (
+                    name, mode, before['p50_ms'], now['p50_ms'],
+                    (now['p50_ms'] / before['p50_ms'] - 1) * 100 if before['p50_ms'] else 0,
+                    before['queries'], now['queries']))
@@ -0,0 +1,73 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+from blogengine.models import Category, Post, Tag
+from blogengine.seeding import seed_posts
+
+class Command(BaseCommand):
+    help = ("Prints the query plan and timing of each post listing query "
+            "shape, optionally seeding synthetic posts first.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--seed', type='int', default=0,
+                    help='Number of synthetic posts to add before measuring.'),
+        make_option('--runs', type='int', default=20,
+                    help='Number of timed runs per query.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            started = time.time()
+            seed_posts(options['seed'], render=False)
+            self.stdout.write("Seeded %d posts in %.1fs" % (options['seed'],
+                                                           time.time() - started))
+
+        post = Post.objects.order_by('id').first()
+        category = Category.objects.first()
+        tag = Tag.objects.first()
+        if post is None or category is None or tag is None:
+            raise CommandError("Need at least one post, category and tag; "
+                               "use --seed to create some.")
+
+        # A cursor halfway into the archive, as a crawler would reach it
+        middle = Post.objects.order_by('-pub_date', '-id')[Post.objects.count() // 2]
+        newest = ('-pub_date', '-id')
+        shapes = [
+            ('index', Post.objects.order_by(*newest)[:20]),
+            ('index, deep cursor', Post.objects.filter(
+                Q(pub_date__lt=middle.pub_date) |
+                Q(pub_date=middle.pub_date, id__lt=middle.id)).order_by(*newest)[:20]),
+            ('category', Post.objects.filter(category=category).order_by(*newest)[:10]),
+            ('site', Post.objects.filter(site_id=post.site_id).order_by(*newest)[:20]),
+            ('tag', Post.objects.filter(tags=tag).order_by(*newest)[:10]),
+            # The detail view resolves the post by its unique slug alone
+            ('detail', Post.objects.filter(slug=post.slug)),
+        ]
+        for name, queryset in shapes:
+            self.explain(name, queryset, options['runs'])
+
+    def explain(self, name, queryset, runs):
+        sql, params = queryset.query.sql_with_params()
+        if connection.vendor == 'sqlite':
+            explain = 'EXPLAIN QUERY PLAN '
+        else:
+            explain = 'EXPLAIN '
+
+        cursor = connection.cursor()
+        cursor.execute(explain + sql, params)
+        plan = cursor.fetchall()
+
+        timings = []
+        for _ in range(runs):
+            started = time.time()
+            list(queryset._clone())
+            timings.append((time.time() - started) * 1000)
+        timings.sort()
+
+        self.stdout.write("%s: median %.2fms, max %.2fms" % (
+            name, timings[len(timings) // 2], timings[-1]))
+        for row in plan:
+            self.stdout.write("    %s" % ' '.join(unicode(column) for column in row))
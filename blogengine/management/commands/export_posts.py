@@ -0,0 +1,23 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from blogengine.archive import archive_lines
+
+class Command(BaseCommand):
+    args = '[file]'
+    help = ("Writes every post with its category, tags, author and site as JSON "
+            "lines to the file, or to standard output.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', default=500,
+                    help='Number of posts fetched at a time.'),
+    )
+
+    def handle(self, *args, **options):
+        if args:
+            with open(args[0], 'wb') as f:
+                for line in archive_lines(options['chunk_size']):
+                    f.write(line)
+        else:
+            for line in archive_lines(options['chunk_size']):
+                self.stdout.write(line, ending='')
@@ -0,0 +1,40 @@
+import multiprocessing
+import time
+from optparse import make_option
+
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+from blogengine.snapshot import export_site
+
+class Command(BaseCommand):
+    args = '<output directory>'
+    help = ("Renders every public page and feed of the blog into a directory "
+            "tree, as <path>/index.html or <path>/index.xml for feeds.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', default=multiprocessing.cpu_count(),
+                    help='Number of processes rendering pages.'),
+        make_option('--site',
+                    help='Domain of the site to export, the SITE_ID site by default.'),
+        make_option('--incremental', action='store_true', default=False,
+                    help='Only re-render pages whose content changed since the '
+                         'last export into the directory.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: export_static %s" % self.args)
+
+        if options['site']:
+            try:
+                site = Site.objects.get(domain=options['site'])
+            except Site.DoesNotExist:
+                raise CommandError("No site with domain %s" % options['site'])
+        else:
+            site = Site.objects.get_current()
+
+        started = time.time()
+        rendered, removed = export_site(args[0], site, processes=options['processes'],
+                                        incremental=options['incremental'])
+        self.stdout.write("Rendered %d pages and removed %d in %.1fs" % (
+            rendered, removed, time.time() - started))
@@ -0,0 +1,51 @@
+import multiprocessing
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from blogengine.importing import import_posts, read_records
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = ("Imports posts in batches from a JSON lines or CSV file with title, "
+            "text and optional slug, pub_date, author, category and tags fields.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', choices=['jsonl', 'csv'],
+                    help='File format, guessed from the extension by default.'),
+        make_option('--author',
+                    help='Username of the author of records without one.'),
+        make_option('--batch-size', type='int', default=500,
+                    help='Number of posts inserted at a time.'),
+        make_option('--processes', type='int', default=multiprocessing.cpu_count(),
+                    help='Number of processes rendering Markdown.'),
+        make_option('--allocate-slugs', action='store_true', default=False,
+                    help='Give records without a slug a unique one rather than '
+                         'skipping them when their title\'s is taken.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: import_posts %s" % self.args)
+
+        started = time.time()
+
+        def progress(importer):
+            elapsed = time.time() - started
+            self.stdout.write("Imported %d posts, %.0f rows/sec" % (
+                importer.imported, importer.imported / elapsed if elapsed else 0))
+
+        try:
+            importer = import_posts(read_records(args[0], options['format']),
+                                    options['author'],
+                                    batch_size=options['batch_size'],
+                                    processes=options['processes'],
+                                    allocate_slugs=options['allocate_slugs'],
+                                    progress=progress)
+        except ValueError as e:
+            raise CommandError(e)
+
+        elapsed = time.time() - started
+        self.stdout.write("Imported %d posts and skipped %d existing in %.1fs, %.0f rows/sec" % (
+            importer.imported, importer.skipped, elapsed,
+            importer.imported / elapsed if elapsed else 0))
@@ -0,0 +1,42 @@
+import time
+import uuid
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from blogengine import ingest
+
+class Command(BaseCommand):
+    help = ("Imports the posts submitted through the ingestion API in batches, "
+            "waiting for more unless --once is given. Several can run at once.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=100,
+                    help='Number of jobs claimed and imported at a time.'),
+        make_option('--processes', type='int', default=1,
+                    help='Number of processes rendering Markdown.'),
+        make_option('--once', action='store_true', default=False,
+                    help='Exit once the queue is empty.'),
+        make_option('--sleep', type='float', default=2.0,
+                    help='Seconds to wait before looking at an empty queue again.'),
+    )
+
+    def handle(self, *args, **options):
+        worker = uuid.uuid4().hex
+        imported = 0
+        while True:
+            requeued = ingest.requeue_stale()
+            if requeued:
+                self.stdout.write("Requeued %d stalled jobs" % requeued)
+            jobs = ingest.claim(options['batch_size'], worker)
+            if not jobs:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+                continue
+
+            started = time.time()
+            posts = ingest.process(jobs, processes=options['processes'])
+            imported += len(posts)
+            self.stdout.write("Imported %d of %d jobs in %.1fs" % (
+                len(posts), len(jobs), time.time() - started))
+        self.stdout.write("Imported %d posts" % imported)
@@ -0,0 +1,8 @@
+from django.core.management.base import BaseCommand
+from blogengine.months import rebuild_counts
+
+class Command(BaseCommand):
+    help = "Counts the posts of every site and month for the date archive again."
+
+    def handle(self, *args, **options):
+        self.stdout.write("Counted posts in %d months" % rebuild_counts())
@@ -0,0 +1,27 @@
+import time
+from optparse import make_option
+
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+from blogengine.related import rebuild_related
+
+class Command(BaseCommand):
+    help = "Scores every post against the others of its site and stores its related posts."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--site',
+                    help='Domain of the site to rebuild, every site by default.'),
+    )
+
+    def handle(self, *args, **options):
+        sites = Site.objects.order_by('id')
+        if options['site']:
+            sites = sites.filter(domain=options['site'])
+            if not sites:
+                raise CommandError("No site with domain %s" % options['site'])
+
+        for site in sites:
+            started = time.time()
+            posts = rebuild_related(site)
+            self.stdout.write("Related %d posts of %s in %.1fs" % (
+                posts, site.domain, time.time() - started))
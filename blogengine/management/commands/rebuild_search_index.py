@@ -0,0 +1,19 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from blogengine.search import backend, rebuild_index
+
+class Command(BaseCommand):
+    help = "Empties the post search index and indexes every post again."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=1000,
+                    help='Number of posts indexed at a time.'),
+    )
+
+    def handle(self, *args, **options):
+        started = time.time()
+        indexed = rebuild_index(batch_size=options['batch_size'])
+        self.stdout.write("Indexed %d posts with the %s in %.1fs" % (
+            indexed, backend().__class__.__name__, time.time() - started))
@@ -0,0 +1,8 @@
+from django.core.management.base import BaseCommand
+from blogengine.counters import reconcile
+
+class Command(BaseCommand):
+    help = "Recounts the posts of every category and tag and fixes any counter that drifted."
+
+    def handle(self, *args, **options):
+        self.stdout.write("Fixed %d post counts" % reconcile())
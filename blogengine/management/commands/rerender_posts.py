@@ -0,0 +1,17 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from blogengine.rerendering import rerender_posts
+
+class Command(BaseCommand):
+    help = ("Renders again the posts whose stored HTML and excerpt are from an older "
+            "renderer or were left behind by a text changed without saving the post.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=500,
+                    help='Number of posts checked at a time.'),
+    )
+
+    def handle(self, *args, **options):
+        self.stdout.write("Rendered %d posts again" %
+                          rerender_posts(batch_size=options['batch_size']))
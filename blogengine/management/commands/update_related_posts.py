@@ -0,0 +1,32 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from blogengine.related import update_stale
+
+class Command(BaseCommand):
+    help = ("Scores the posts queued by saves against their neighbours and updates "
+            "their related posts, waiting for more unless --once is given.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=100,
+                    help='Number of queued posts scored at a time.'),
+        make_option('--once', action='store_true', default=False,
+                    help='Exit once the queue is empty.'),
+        make_option('--sleep', type='float', default=2.0,
+                    help='Seconds to wait before looking at an empty queue again.'),
+    )
+
+    def handle(self, *args, **options):
+        updated = 0
+        while True:
+            started = time.time()
+            scored = update_stale(options['batch_size'])
+            if not scored:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+                continue
+            updated += scored
+            self.stdout.write("Scored %d posts in %.1fs" % (scored, time.time() - started))
+        self.stdout.write("Updated the related posts of %d posts" % updated)
@@ -0,0 +1,220 @@
+"""
+Per-request timings and cache hit counts.
+
+MetricsMiddleware times each request along with its database queries, its
+template rendering and the Markdown rendered by the custom_markdown filter
+and the feeds, and counts hits and misses of the page, feed and Markdown
+caches. They're sent back in a Server-Timing header when
+BLOGENGINE_SERVER_TIMING is set, which it isn't by default as the header
+tells anyone what a page costs, and added to histograms kept in-process,
+which the staff-only /metrics/ view reports; each worker process keeps its
+own. Outside a request timed() and record_hit() do nothing.
+
+Queries are timed by wrapping the cursors the connections hand out from
+the view on, without the SQL formatting of Django's debug cursor; templates
+are timed from the rendering of a TemplateResponse, so views calling
+render() directly only count towards the total.
+"""
+import bisect
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.utils import CursorWrapper
+
+# Upper bounds of the histogram buckets, in milliseconds or queries
+BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_local = threading.local()
+
+def current():
+    return getattr(_local, 'metrics', None)
+
+@contextmanager
+def timed(name):
+    request_metrics = current()
+    if request_metrics is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        request_metrics.add_time(name, time.time() - start)
+
+def record_hit(cache, hit):
+    request_metrics = current()
+    if request_metrics is not None:
+        request_metrics.record_hit(cache, hit)
+
+class RequestMetrics(object):
+    def __init__(self):
+        self.start = time.time()
+        self.times = defaultdict(float)
+        self.hits = defaultdict(lambda: [0, 0])
+        self.queries = 0
+
+    def add_query(self, seconds):
+        self.queries += 1
+        self.times['db'] += seconds
+
+    def add_time(self, name, seconds):
+        self.times[name] += seconds
+
+    def record_hit(self, cache, hit):
+        self.hits[cache][0 if hit else 1] += 1
+
+    def server_timing(self):
+        entries = ['total;dur=%.1f' % self.times['total'],
+                   'db;dur=%.1f;desc="%d queries"' % (self.times['db'], self.queries)]
+        for name in sorted(self.times):
+            if name not in ('total', 'db'):
+                entries.append('%s;dur=%.1f' % (name, self.times[name]))
+        for cache, (hits, misses) in sorted(self.hits.items()):
+            entries.append('%s-cache;desc="%d/%d hits"' % (cache, hits, hits + misses))
+        return ', '.join(entries)
+
+class TimedCursorWrapper(CursorWrapper):
+    def __init__(self, cursor, db, request_metrics):
+        super(TimedCursorWrapper, self).__init__(cursor, db)
+        self.request_metrics = request_metrics
+
+    def execute(self, sql, params=None):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.request_metrics.add_query(time.time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.request_metrics.add_query(time.time() - start)
+
+def time_cursors(request_metrics):
+    # Each connection's own cursor() still decides whether to log queries;
+    # the cursor it makes is wrapped
+    untime_cursors()
+    for connection in connections.all():
+        make_cursor = connection.cursor
+        connection.cursor = lambda make_cursor=make_cursor, connection=connection: (
+            TimedCursorWrapper(make_cursor(), connection, request_metrics))
+
+def untime_cursors():
+    for connection in connections.all():
+        if 'cursor' in connection.__dict__:
+            del connection.cursor
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def report(self):
+        bounds = list(BUCKETS) + ['+Inf']
+        return {
+            'buckets': [[bound, count] for bound, count in zip(bounds, self.counts)],
+            'count': self.count,
+            'sum': self.sum,
+        }
+
+class Registry(object):
+    """
+    Histograms of request timings and totals of cache hits, aggregated over
+    the requests this process served.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.histograms = defaultdict(Histogram)
+            self.hits = defaultdict(lambda: [0, 0])
+
+    def add(self, request_metrics):
+        with self._lock:
+            self.requests += 1
+            for name, seconds in request_metrics.times.items():
+                self.histograms[name].observe(seconds)
+            self.histograms['db-queries'].observe(request_metrics.queries)
+            for cache, (hits, misses) in request_metrics.hits.items():
+                self.hits[cache][0] += hits
+                self.hits[cache][1] += misses
+
+    def report(self):
+        with self._lock:
+            caches = {}
+            for cache, (hits, misses) in self.hits.items():
+                caches[cache] = {
+                    'hits': hits,
+                    'misses': misses,
+                    'hit_ratio': float(hits) / (hits + misses) if hits + misses else 0.0,
+                }
+            return {
+                'requests': self.requests,
+                'histograms': dict((name, histogram.report())
+                                   for name, histogram in self.histograms.items()),
+                'caches': caches,
+            }
+
+registry = Registry()
+
+class MetricsMiddleware(object):
+    """
+    Times each request; goes first in MIDDLEWARE_CLASSES so the total covers
+    the other middleware too. Queries are timed from the view on, and the
+    connections are given back their own cursors when the view raises as
+    well as when it returns.
+    """
+    def process_request(self, request):
+        # In case an earlier request's response middleware failed before
+        # this one's ran
+        untime_cursors()
+        _local.metrics = RequestMetrics()
+
+    def process_view(self, request, view, args, kwargs):
+        request_metrics = current()
+        if request_metrics is not None:
+            time_cursors(request_metrics)
+
+    def process_exception(self, request, exception):
+        untime_cursors()
+
+    def process_template_response(self, request, response):
+        request_metrics = current()
+        if request_metrics is not None:
+            start = time.time()
+
+            def rendered(response):
+                request_metrics.add_time('template', time.time() - start)
+            response.add_post_render_callback(rendered)
+        return response
+
+    def process_response(self, request, response):
+        untime_cursors()
+        request_metrics = current()
+        if request_metrics is None:
+            return response
+        _local.metrics = None
+        request_metrics.add_time('total', time.time() - request_metrics.start)
+
+        # Milliseconds from here on
+        for name in request_metrics.times:
+            request_metrics.times[name] *= 1000
+        registry.add(request_metrics)
+        if getattr(settings, 'BLOGENGINE_SERVER_TIMING', False):
+            response['Server-Timing'] = request_metrics.server_timing()
+        return response
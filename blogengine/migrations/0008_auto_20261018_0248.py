@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+from blogengine.rendering import RENDERER_VERSION, render_markdown, text_digest
+
+
+def render_existing_posts(apps, schema_editor):
+    Post = apps.get_model('blogengine', 'Post')
+    for post in Post.objects.iterator():
+        post.rendered_text = render_markdown(post.text)
+        post.text_hash = text_digest(post.text)
+        post.renderer_version = RENDERER_VERSION
+        post.save(update_fields=['rendered_text', 'text_hash', 'renderer_version'])
+
+
+def forget_rendered_posts(apps, schema_editor):
+    # The columns are dropped on the way back, nothing to undo
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogengine', '0007_auto_20150110_0811'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='rendered_text',
+            field=models.TextField(editable=False, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='renderer_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='text_hash',
+            field=models.CharField(max_length=40, editable=False, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='post',
+            name='tags',
+            field=models.ManyToManyField(to='blogengine.Tag', null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(render_existing_posts, forget_rendered_posts),
+    ]
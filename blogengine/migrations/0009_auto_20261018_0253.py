@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class RunIndexSQL(migrations.RunSQL):
+    """
+    Creates an index Django doesn't manage, and drops it with the
+    database's own DROP INDEX statement, which names the table on MySQL.
+    Each way is a single statement, run as is rather than split up with
+    sqlparse, which RunSQL would need installed.
+    """
+    def __init__(self, name, table, columns):
+        self.name = name
+        self.table = table
+        super(RunIndexSQL, self).__init__(
+            'CREATE INDEX %s ON %s (%s)' % (name, table, ', '.join(columns)),
+            reverse_sql='DROP INDEX %s' % name)
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        schema_editor.execute(self.sql)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        schema_editor.execute(schema_editor.sql_delete_index % {
+            'name': schema_editor.quote_name(self.name),
+            'table': schema_editor.quote_name(self.table),
+        })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogengine', '0008_auto_20261018_0248'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='post',
+            index_together=set([('pub_date', 'id'), ('site', 'pub_date', 'id'), ('category', 'pub_date', 'id')]),
+        ),
+        # Tag listings walk the through table by tag, but its automatic
+        # unique index leads with post_id
+        RunIndexSQL('blogengine_post_tags_tag_id_post_id', 'blogengine_post_tags',
+                    ['tag_id', 'post_id']),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.utils import OperationalError
+
+
+# The search index of SQLite builds with FTS5, filled from the existing posts;
+# other databases use SearchTerm
+def create_post_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    try:
+        schema_editor.execute('CREATE VIRTUAL TABLE blogengine_post_search '
+                              'USING fts5(title, text)')
+    except OperationalError:
+        return
+    schema_editor.execute('INSERT INTO blogengine_post_search (rowid, title, text) '
+                          'SELECT id, title, text FROM blogengine_post')
+
+
+def drop_post_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS blogengine_post_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogengine', '0009_auto_20261018_0253'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchTerm',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('term', models.CharField(max_length=40)),
+                ('weight', models.PositiveIntegerField()),
+                ('post', models.ForeignKey(to='blogengine.Post')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='searchterm',
+            index_together=set([('term', 'post')]),
+        ),
+        migrations.RunPython(create_post_search_table, drop_post_search_table),
+    ]
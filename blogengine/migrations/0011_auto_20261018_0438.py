@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import Counter
+
+from django.db import models, migrations
+
+
+# Count the existing posts, by the year and month of their URLs
+def fill_month_counts(apps, schema_editor):
+    Post = apps.get_model('blogengine', 'Post')
+    MonthCount = apps.get_model('blogengine', 'MonthCount')
+    counts = Counter((site_id, pub_date.year, pub_date.month) for site_id, pub_date in
+                     Post.objects.values_list('site_id', 'pub_date').iterator())
+    MonthCount.objects.bulk_create(MonthCount(site_id=site_id, year=year, month=month, posts=posts)
+                                   for (site_id, year, month), posts in counts.items())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0001_initial'),
+        ('blogengine', '0010_auto_20261018_0426'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('year', models.PositiveSmallIntegerField()),
+                ('month', models.PositiveSmallIntegerField()),
+                ('posts', models.PositiveIntegerField(default=0)),
+                ('site', models.ForeignKey(to='sites.Site')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='monthcount',
+            unique_together=set([('site', 'year', 'month')]),
+        ),
+        migrations.RunPython(fill_month_counts, lambda apps, schema_editor: None),
+    ]
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Count
+
+
+# Count the posts of each site in the existing categories and tags
+def fill_post_counts(apps, schema_editor):
+    Post = apps.get_model('blogengine', 'Post')
+    CategoryCount = apps.get_model('blogengine', 'CategoryCount')
+    TagCount = apps.get_model('blogengine', 'TagCount')
+    category_counts = (Post.objects.exclude(category=None).order_by()
+                                   .values_list('site', 'category')
+                                   .annotate(posts=Count('id')))
+    tag_counts = (Post.tags.through.objects.order_by().values_list('post__site', 'tag')
+                                            .annotate(posts=Count('id')))
+    CategoryCount.objects.bulk_create(CategoryCount(site_id=site_id, category_id=category_id,
+                                                    posts=posts)
+                                      for site_id, category_id, posts in category_counts)
+    TagCount.objects.bulk_create(TagCount(site_id=site_id, tag_id=tag_id, posts=posts)
+                                 for site_id, tag_id, posts in tag_counts)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0001_initial'),
+        ('blogengine', '0011_auto_20261018_0438'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('posts', models.PositiveIntegerField(default=0)),
+                ('category', models.ForeignKey(to='blogengine.Category')),
+                ('site', models.ForeignKey(to='sites.Site')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='TagCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('posts', models.PositiveIntegerField(default=0)),
+                ('site', models.ForeignKey(to='sites.Site')),
+                ('tag', models.ForeignKey(to='blogengine.Tag')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='tagcount',
+            unique_together=set([('site', 'tag')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='categorycount',
+            unique_together=set([('site', 'category')]),
+        ),
+        migrations.RunPython(fill_post_counts, lambda apps, schema_editor: None),
+    ]
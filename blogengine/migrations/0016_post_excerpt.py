@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+from blogengine.rendering import make_excerpt
+
+
+def excerpt_existing_posts(apps, schema_editor):
+    Post = apps.get_model('blogengine', 'Post')
+    for post in Post.objects.only('id', 'rendered_text').iterator():
+        Post.objects.filter(id=post.id).update(excerpt=make_excerpt(post.rendered_text))
+
+
+def forget_excerpts(apps, schema_editor):
+    # The column is dropped on the way back, nothing to undo
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogengine', '0015_auto_20261018_0524'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='excerpt',
+            field=models.TextField(editable=False, blank=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(excerpt_existing_posts, forget_excerpts),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogengine', '0016_post_excerpt'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostViewCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('day', models.DateField()),
+                ('views', models.PositiveIntegerField(default=0)),
+                ('post', models.ForeignKey(to='blogengine.Post')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='postviewcount',
+            unique_together=set([('post', 'day')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='postviewcount',
+            index_together=set([('day', 'post')]),
+        ),
+    ]
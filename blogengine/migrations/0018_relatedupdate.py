@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogengine', '0017_auto_20261018_0530'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RelatedUpdate',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('post', models.ForeignKey(to='blogengine.Post', unique=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
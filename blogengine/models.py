@@ -1,18 +1,60 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
-from django.utils.text import slugify
+from blogengine import slugs
+from blogengine.rendering import (RENDERER_VERSION, make_excerpt, render_markdown,
+                                  render_markdown_cached, text_digest)
 
 # Create your models here.
-class Tag(models.Model):
+class SavedValuesMixin(object):
+    """
+    Remembers the values of tracked_fields as last loaded or saved, so
+    signal receivers can tell what an instance moved away from.
+    """
+    tracked_fields = ()
+
+    def __init__(self, *args, **kwargs):
+        super(SavedValuesMixin, self).__init__(*args, **kwargs)
+        self.remember_saved_values()
+
+    def save(self, *args, **kwargs):
+        super(SavedValuesMixin, self).save(*args, **kwargs)
+        self.remember_saved_values()
+
+    def remember_saved_values(self):
+        # Fields deferred by only() or defer() are left out rather than
+        # loaded
+        self.saved_values = dict((field, self.__dict__[field])
+                                 for field in self.tracked_fields
+                                 if field in self.__dict__)
+
+class SlugMixin(object):
+    """
+    Gives rows saved without a slug a unique one made from slug_source,
+    allocating another if a concurrent save takes it first.
+    """
+    slug_source = 'name'
+
+    def save(self, *args, **kwargs):
+        if self.slug:
+            return super(SlugMixin, self).save(*args, **kwargs)
+        model = self._meta.concrete_model
+        base = slugs.slug_base(model, getattr(self, self.slug_source))
+        for attempt in range(slugs.ATTEMPTS):
+            self.slug = slugs.allocate_slugs(model, [base])[0]
+            try:
+                with transaction.atomic():
+                    return super(SlugMixin, self).save(*args, **kwargs)
+            except IntegrityError:
+                if attempt + 1 == slugs.ATTEMPTS:
+                    raise
+
+class Tag(SlugMixin, SavedValuesMixin, models.Model):
     name = models.CharField(max_length=200)
     description = models.TextField()
     slug = models.SlugField(max_length=40, unique=True, blank=True, null=True)
 
-    def save(self, *args, **kwargs):
-        if not self.slug:
-            self.slug = slugify(unicode(self.name))
-        super(Tag, self).save(*args, **kwargs)
+    tracked_fields = ('slug',)
 
     def get_absolute_url(self):
         return "/tag/%s/" % (self.slug)
@@ -20,15 +62,12 @@ class Tag(models.Model):
     def __unicode__(self):
         return self.name
 
-class Category(models.Model):
+class Category(SlugMixin, SavedValuesMixin, models.Model):
     name = models.CharField(max_length=200)
     description = models.TextField()
     slug = models.SlugField(max_length=40, unique=True, blank=True, null=True)
 
-    def save(self, *args, **kwargs):
-        if not self.slug:
-            self.slug = slugify(unicode(self.name))
-        super(Category, self).save(*args, **kwargs)
+    tracked_fields = ('slug',)
 
     def get_absolute_url(self):
         return "/category/%s/" % (self.slug)
@@ -39,15 +78,60 @@ class Category(models.Model):
     class Meta:
         verbose_name_plural = 'categories'
 
-class Post(models.Model):
+class PostQuerySet(models.QuerySet):
+    def for_site(self, site):
+        return self.filter(site=site)
+
+class Post(SlugMixin, SavedValuesMixin, models.Model):
     title = models.CharField(max_length=300)
     pub_date = models.DateTimeField()
     text = models.TextField()
-    slug = models.SlugField(max_length=40, unique=True)
+    slug = models.SlugField(max_length=40, unique=True, blank=True)
     author = models.ForeignKey(User)
     site = models.ForeignKey(Site)
     category = models.ForeignKey(Category, blank=True, null=True)
     tags = models.ManyToManyField(Tag, blank=True, null=True)
+    rendered_text = models.TextField(blank=True, editable=False)
+    text_hash = models.CharField(max_length=40, blank=True, editable=False)
+    renderer_version = models.PositiveIntegerField(default=0, editable=False)
+    excerpt = models.TextField(blank=True, editable=False)
+
+    objects = PostQuerySet.as_manager()
+
+    slug_source = 'title'
+    tracked_fields = ('category_id', 'site_id', 'pub_date', 'slug')
+
+    def save(self, *args, **kwargs):
+        if not self.rendered_text_is_current():
+            self.render_text()
+        super(Post, self).save(*args, **kwargs)
+
+    def render_text(self):
+        self.rendered_text = render_markdown(self.text)
+        self.excerpt = make_excerpt(self.rendered_text)
+        self.text_hash = text_digest(self.text)
+        self.renderer_version = RENDERER_VERSION
+
+    def rendered_text_is_current(self):
+        return (self.renderer_version == RENDERER_VERSION and
+                self.text_hash == text_digest(self.text))
+
+    def get_rendered_text(self):
+        # Fall back to a live render if the text was changed without going
+        # through save(), e.g. by a queryset update().
+        if self.rendered_text_is_current():
+            return self.rendered_text
+        return render_markdown_cached(self.text)
+
+    def get_excerpt(self):
+        # Only the renderer version is checked, so that listings deferring
+        # the text never load it; the excerpt of a text changed without
+        # save(), e.g. by a queryset update(), stays as it was until the
+        # post is saved or the rerender_posts command is run. Listings load
+        # the text of stale posts up front with load_stale_text().
+        if self.renderer_version == RENDERER_VERSION:
+            return self.excerpt
+        return make_excerpt(self.get_rendered_text())
 
     def get_absolute_url(self):
         return "/%s/%s/%s/" % (self.pub_date.year, self.pub_date.month, self.slug)
@@ -57,3 +141,145 @@ class Post(models.Model):
 
     class Meta:
         ordering = ["-pub_date"]
+        # Match the listing queries, which all order by (-pub_date, -id)
+        index_together = [
+            ('pub_date', 'id'),
+            ('category', 'pub_date', 'id'),
+            ('site', 'pub_date', 'id'),
+        ]
+
+def load_stale_text(posts):
+    """
+    Loads the text of the posts from an older renderer, whose excerpts
+    get_excerpt() makes again, with one query rather than one for each post
+    the text was deferred on.
+    """
+    stale = [post for post in posts if post.renderer_version != RENDERER_VERSION]
+    if stale:
+        texts = dict(Post.objects.filter(id__in=[post.id for post in stale])
+                                 .values_list('id', 'text'))
+        for post in stale:
+            post.text = texts[post.id]
+    return posts
+
+class MonthCount(models.Model):
+    """
+    How many posts a site has in a month, kept up to date as posts are
+    saved and deleted for the date archive.
+    """
+    site = models.ForeignKey(Site)
+    year = models.PositiveSmallIntegerField()
+    month = models.PositiveSmallIntegerField()
+    posts = models.PositiveIntegerField(default=0)
+
+    def get_absolute_url(self):
+        return "/archive/%s/%s/" % (self.year, self.month)
+
+    class Meta:
+        unique_together = [('site', 'year', 'month')]
+
+class PostCount(models.Model):
+    """
+    How many posts of a site are in a category or carry a tag, kept up to
+    date as posts are saved, deleted and tagged for the sidebars and
+    sitemaps.
+    """
+    site = models.ForeignKey(Site)
+    posts = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+class CategoryCount(PostCount):
+    category = models.ForeignKey(Category)
+
+    label_name = 'category'
+
+    class Meta:
+        unique_together = [('site', 'category')]
+
+class TagCount(PostCount):
+    tag = models.ForeignKey(Tag)
+
+    label_name = 'tag'
+
+    class Meta:
+        unique_together = [('site', 'tag')]
+
+class RelatedPost(models.Model):
+    """
+    One of a post's nearest neighbours on its site, by shared tags and
+    text similarity.
+    """
+    post = models.ForeignKey(Post, related_name='related_set')
+    related = models.ForeignKey(Post, related_name='+')
+    score = models.FloatField()
+
+    class Meta:
+        index_together = [('post', 'score')]
+
+class RelatedUpdate(models.Model):
+    """
+    A post whose related posts are to be scored again, queued once however
+    often it changes until the update_related_posts worker gets to it.
+    """
+    post = models.ForeignKey(Post, unique=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+class SearchTerm(models.Model):
+    """
+    A posting of the pure-Python search index: how strongly a word occurs
+    in a post, with title occurrences weighted above the text.
+    """
+    term = models.CharField(max_length=40)
+    post = models.ForeignKey(Post)
+    weight = models.PositiveIntegerField()
+
+    class Meta:
+        index_together = [('term', 'post')]
+
+class PostViewCount(models.Model):
+    """
+    How many times a post's page was read on a day, for the most read
+    listing.
+    """
+    post = models.ForeignKey(Post)
+    day = models.DateField()
+    views = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [('post', 'day')]
+        # The most read listing sums the rows of the last days
+        index_together = [('day', 'post')]
+
+class IngestJob(models.Model):
+    """
+    A post submitted through the ingestion API, waiting for the
+    process_ingest_queue worker to import it.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    payload = models.TextField()
+    author = models.ForeignKey(User)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    # The worker holding the job, and how many times it was claimed
+    claimed_by = models.CharField(max_length=32, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    post = models.ForeignKey(Post, blank=True, null=True, on_delete=models.SET_NULL)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        # Workers claim the oldest pending jobs
+        index_together = [('status', 'id')]
@@ -0,0 +1,88 @@
+"""
+Post counts per site and month for the date archive.
+
+The counts live in MonthCount, one row per site and month, so the archive
+sidebar is a single read of a site's rows. Saving or deleting a Post moves
+its count from the month it was in to the month it is in now; months are
+those of the post URLs. bulk_create skips the signals, so bulk imports
+apply their counts with add().
+"""
+from collections import Counter
+from datetime import datetime
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from blogengine import pagecache
+from blogengine.models import MonthCount, Post
+
+def month_of(site_id, pub_date):
+    return (site_id, pub_date.year, pub_date.month)
+
+def month_range(year, month):
+    """
+    Returns the start of the month and of the month after it, to filter
+    pub_date on.
+    """
+    tzinfo = timezone.utc if settings.USE_TZ else None
+    start = datetime(year, month, 1, tzinfo=tzinfo)
+    if month == 12:
+        return start, datetime(year + 1, 1, 1, tzinfo=tzinfo)
+    return start, datetime(year, month + 1, 1, tzinfo=tzinfo)
+
+def add(counts):
+    """
+    Adds a Counter of post counts by (site_id, year, month) to the stored
+    ones.
+    """
+    for (site_id, year, month), posts in counts.items():
+        if not posts:
+            continue
+        rows = MonthCount.objects.filter(site_id=site_id, year=year, month=month)
+        if rows.update(posts=F('posts') + posts) or posts < 0:
+            continue
+        try:
+            with transaction.atomic():
+                MonthCount.objects.create(site_id=site_id, year=year, month=month, posts=posts)
+        except IntegrityError:
+            # Another process created the month first
+            rows.update(posts=F('posts') + posts)
+    if any(counts.values()):
+        pagecache.invalidate(['months'])
+
+def site_months(site):
+    # Months left empty by deletes keep their row at zero
+    return (MonthCount.objects.filter(site=site, posts__gt=0)
+                              .order_by('-year', '-month'))
+
+def rebuild_counts():
+    """
+    Counts every post again, returning the number of months with posts.
+    """
+    counts = Counter(month_of(site_id, pub_date) for site_id, pub_date in
+                     Post.objects.values_list('site_id', 'pub_date').iterator())
+    with transaction.atomic():
+        MonthCount.objects.all().delete()
+        MonthCount.objects.bulk_create(
+            MonthCount(site_id=site_id, year=year, month=month, posts=posts)
+            for (site_id, year, month), posts in counts.items())
+    pagecache.invalidate(['months'])
+    return len(counts)
+
+@receiver(post_save, sender=Post)
+def post_saved(sender, instance, created, **kwargs):
+    counts = Counter([month_of(instance.site_id, instance.pub_date)])
+    if not created:
+        previous = instance.saved_values.get('pub_date')
+        if previous is None:
+            # Saved without its date loaded, so it stayed where it was
+            return
+        counts[month_of(instance.saved_values.get('site_id', instance.site_id), previous)] -= 1
+    add(counts)
+
+@receiver(post_delete, sender=Post)
+def post_deleted(sender, instance, **kwargs):
+    add(Counter({month_of(instance.site_id, instance.pub_date): -1}))
@@ -0,0 +1,202 @@
+"""
+Caches whole public pages for anonymous visitors.
+
+While a page renders, the view names everything it shows with depends_on():
+single objects as 'post:<id>', 'category:<id>' and 'tag:<id>', the post
+listings as 'posts', 'category-posts:<id>' and 'tag-posts:<id>', and slug
+lookups as 'category-slug:<slug>' and 'tag-slug:<slug>', the archive month
+counts as 'months', the category and tag post counts as 'post-counts', a
+post's related posts as 'related:<id>', a site's sitemaps as
+'sitemap-index:<site id>' and 'sitemap-posts:<site id>:<chunk>', the most
+read posts as 'most-read', and every category or tag as 'categories' and
+'tags'. Every page also depends on 'flatpages' for the navigation bar.
+Pages are stored per site along with the generation token of each of their
+dependencies, which are shared by all sites. Saving or deleting a Post,
+Category, Tag or FlatPage drops the tokens of exactly the dependencies it
+affects, and writing post views drops 'most-read', so the pages stored under
+them are discarded when next requested.
+"""
+import hashlib
+import uuid
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.flatpages.models import FlatPage
+from django.core.cache import caches
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.http import HttpResponse
+from blogengine import metrics
+from blogengine.models import Category, Post, Tag
+from blogengine.sites import request_site
+
+def page_cache():
+    return caches[getattr(settings, 'BLOGENGINE_PAGE_CACHE', 'default')]
+
+def page_key(request):
+    path = request.get_full_path().encode('utf-8')
+    return 'blogengine:page:%d:%s' % (request_site(request).id, hashlib.md5(path).hexdigest())
+
+def dependency_key(dependency):
+    return 'blogengine:page-dependency:%s' % dependency
+
+def depends_on(request, *dependencies):
+    # Requests that won't be cached don't collect anything
+    if hasattr(request, 'page_dependencies'):
+        request.page_dependencies.update(dependencies)
+
+def post_dependencies(post):
+    # The post as shown on its own page or in a listing; uses the
+    # prefetched tags
+    dependencies = ['post:%d' % post.id]
+    if post.category_id is not None:
+        dependencies.append('category:%d' % post.category_id)
+    dependencies.extend('tag:%d' % tag.id for tag in post.tags.all())
+    return dependencies
+
+def is_cacheable(request):
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    user = getattr(request, 'user', None)
+    return user is None or not user.is_authenticated()
+
+def get_page(request):
+    cache = page_cache()
+    cached = cache.get(page_key(request))
+    if cached is None:
+        metrics.record_hit('page', False)
+        return None
+    content, content_type, tokens = cached
+    if cache.get_many(tokens.keys()) != tokens:
+        metrics.record_hit('page', False)
+        return None
+    metrics.record_hit('page', True)
+    return HttpResponse(content, content_type=content_type)
+
+def store_page(request, response):
+    if response.status_code != 200 or response.streaming:
+        return
+    cache = page_cache()
+    keys = [dependency_key(dependency) for dependency in request.page_dependencies]
+    tokens = cache.get_many(keys)
+    missing = [key for key in keys if key not in tokens]
+    if missing:
+        for key in missing:
+            cache.add(key, uuid.uuid4().hex, None)
+        tokens.update(cache.get_many(missing))
+    # A token evicted in between leaves the page stale from the start
+    tokens.update((key, None) for key in missing if key not in tokens)
+
+    # Saves only drop tokens before their transaction commits, so a page
+    # rendered from the old rows in that window can outlive them; the
+    # timeout bounds how long
+    timeout = getattr(settings, 'BLOGENGINE_PAGE_CACHE_TIMEOUT', 24 * 60 * 60)
+    cache.set(page_key(request), (response.content, response['Content-Type'], tokens),
+              timeout)
+
+def cached_page(view):
+    """
+    Serves the view's pages to anonymous visitors from the page cache,
+    storing them on the way out.
+    """
+    @wraps(view)
+    def cached_view(request, *args, **kwargs):
+        if not is_cacheable(request):
+            return view(request, *args, **kwargs)
+        response = get_page(request)
+        if response is not None:
+            return response
+
+        request.page_dependencies = set(['flatpages'])
+        response = view(request, *args, **kwargs)
+        if request.method == 'GET':
+            if getattr(response, 'is_rendered', True):
+                store_page(request, response)
+            else:
+                response.add_post_render_callback(lambda rendered: store_page(request, rendered))
+        return response
+    return cached_view
+
+def invalidate(dependencies):
+    page_cache().delete_many([dependency_key(dependency) for dependency in dependencies])
+
+def link_dependencies(links):
+    # The post pages and tag listings on either end of (post_id, tag_id) links
+    dependencies = set()
+    for post_id, tag_id in links:
+        dependencies.add('post:%d' % post_id)
+        dependencies.add('tag-posts:%d' % tag_id)
+    return dependencies
+
+def tagged_dependencies(post_id):
+    return link_dependencies(Post.tags.through.objects.filter(post_id=post_id)
+                                                      .values_list('post_id', 'tag_id'))
+
+@receiver(post_save, sender=Post)
+def post_saved(sender, instance, **kwargs):
+    dependencies = tagged_dependencies(instance.id)
+    dependencies.update(['post:%d' % instance.id, 'posts'])
+    for category_id in (instance.category_id, instance.saved_values.get('category_id')):
+        if category_id is not None:
+            dependencies.add('category-posts:%d' % category_id)
+    invalidate(dependencies)
+
+@receiver(pre_delete, sender=Post)
+def post_deleting(sender, instance, **kwargs):
+    # The tag links are deleted along with the post
+    instance.page_dependencies = tagged_dependencies(instance.id)
+    instance.page_dependencies.add('post:%d' % instance.id)
+
+@receiver(post_delete, sender=Post)
+def post_deleted(sender, instance, **kwargs):
+    dependencies = instance.page_dependencies
+    dependencies.add('posts')
+    if instance.category_id is not None:
+        dependencies.add('category-posts:%d' % instance.category_id)
+    invalidate(dependencies)
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_changed(sender, instance, **kwargs):
+    dependencies = set(['category:%d' % instance.id, 'categories'])
+    for slug in (instance.slug, instance.saved_values.get('slug')):
+        if slug is not None:
+            dependencies.add('category-slug:%s' % slug)
+    invalidate(dependencies)
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def tag_changed(sender, instance, **kwargs):
+    dependencies = set(['tag:%d' % instance.id, 'tags'])
+    for slug in (instance.slug, instance.saved_values.get('slug')):
+        if slug is not None:
+            dependencies.add('tag-slug:%s' % slug)
+    invalidate(dependencies)
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def post_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # The links are gone by the time post_clear is sent
+        if reverse:
+            links = Post.tags.through.objects.filter(tag_id=instance.id)
+        else:
+            links = Post.tags.through.objects.filter(post_id=instance.id)
+        instance.page_dependencies = link_dependencies(links.values_list('post_id', 'tag_id'))
+    elif action == 'post_clear':
+        invalidate(instance.page_dependencies)
+    elif action.startswith('post_'):
+        if reverse:
+            links = [(post_id, instance.id) for post_id in pk_set]
+        else:
+            links = [(instance.id, tag_id) for tag_id in pk_set]
+        invalidate(link_dependencies(links))
+
+@receiver(post_save, sender=FlatPage)
+@receiver(post_delete, sender=FlatPage)
+def flatpage_changed(sender, instance, **kwargs):
+    invalidate(['flatpages'])
+
+@receiver(m2m_changed, sender=FlatPage.sites.through)
+def flatpage_sites_changed(sender, action, **kwargs):
+    if action.startswith('post_'):
+        invalidate(['flatpages'])
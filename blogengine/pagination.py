@@ -0,0 +1,89 @@
+"""
+Keyset pagination over querysets ordered newest first by (pub_date, id).
+
+A cursor names the last post seen rather than a position, so fetching the
+page after it is an indexed range scan whatever the depth, with no
+COUNT(*) and no OFFSET.
+"""
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
+# Ids past a signed 64-bit integer can't be bound as query parameters
+MAX_ID = 2 ** 63 - 1
+
+def encode_cursor(post):
+    pub_date = post.pub_date
+    if timezone.is_aware(pub_date):
+        pub_date = timezone.make_naive(pub_date, timezone.utc)
+    return '%s-%d' % (pub_date.strftime(CURSOR_DATE_FORMAT), post.id)
+
+def decode_cursor(cursor):
+    """
+    Returns the (pub_date, id) pair of a cursor, raising ValueError if it is
+    malformed.
+    """
+    pub_date, post_id = cursor.split('-', 1)
+    pub_date = datetime.strptime(pub_date, CURSOR_DATE_FORMAT)
+    if settings.USE_TZ:
+        pub_date = timezone.make_aware(pub_date, timezone.utc)
+    post_id = int(post_id)
+    if not -MAX_ID - 1 <= post_id <= MAX_ID:
+        raise ValueError("Post id %d is out of range" % post_id)
+    return pub_date, post_id
+
+class CursorPage(object):
+    def __init__(self, object_list, has_next, has_previous):
+        self.object_list = object_list
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def next_cursor(self):
+        if self.has_next():
+            return encode_cursor(self.object_list[-1])
+
+    def previous_cursor(self):
+        if self.has_previous():
+            return encode_cursor(self.object_list[0])
+
+def paginate_by_cursor(queryset, per_page, after=None, before=None):
+    """
+    Returns the CursorPage of up to per_page posts following the cursor
+    after, or preceding the cursor before, or the first page if neither is
+    given.
+    """
+    if before:
+        pub_date, post_id = decode_cursor(before)
+        queryset = queryset.filter(Q(pub_date__gt=pub_date) |
+                                   Q(pub_date=pub_date, id__gt=post_id))
+        posts = list(queryset.order_by('pub_date', 'id')[:per_page + 1])
+        has_previous = len(posts) > per_page
+        posts = posts[:per_page]
+        posts.reverse()
+        return CursorPage(posts, has_next=True, has_previous=has_previous)
+
+    if after:
+        pub_date, post_id = decode_cursor(after)
+        queryset = queryset.filter(Q(pub_date__lt=pub_date) |
+                                   Q(pub_date=pub_date, id__lt=post_id))
+    posts = list(queryset.order_by('-pub_date', '-id')[:per_page + 1])
+    return CursorPage(posts[:per_page], has_next=len(posts) > per_page,
+                      has_previous=bool(after))
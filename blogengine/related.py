@@ -0,0 +1,288 @@
+"""
+Related posts, from the tags and words posts have in common.
+
+Each post's nearest neighbours on its site are stored as RelatedPost rows,
+BLOGENGINE_RELATED_POSTS of them, so a post page reads them with one indexed
+query. Two posts score the sum of the cosine similarity of their tag sets
+and that of their tf-idf vectors, title words counting TITLE_WEIGHT times
+as much as the text, as in search.
+
+rebuild_related() scores every post of a site against the others in one
+pass. Each post is reduced to its SIGNATURE_TERMS heaviest terms, and only
+posts sharing one of those or a tag are compared, through inverted indexes.
+The rebuild_related_posts command runs it, and should be run after bulk
+imports, which skip the signals.
+
+Saving a post, or changing its tags, queues it as a RelatedUpdate, once
+however many signals one save sends, in the saving transaction; the
+update_related_posts worker then runs update_related() on the queued posts
+outside the request, once the rows it reads have committed.
+update_related() scores a post against the posts sharing its tags and the
+site's BLOGENGINE_RELATED_WINDOW most recent posts, weighting terms by how
+common they are among those, replaces its neighbours and adds it to the
+lists of the posts it now beats a neighbour of.
+"""
+import heapq
+import math
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from blogengine import pagecache
+from blogengine.models import Post, RelatedPost, RelatedUpdate
+from blogengine.search import TITLE_WEIGHT, terms
+
+SIGNATURE_TERMS = 30
+# Terms and tags on more posts than this are left out of the comparisons;
+# they say little about a post and cost the most to compare
+MAX_POSTINGS = 1000
+
+def related_count():
+    return getattr(settings, 'BLOGENGINE_RELATED_POSTS', 5)
+
+def related_window():
+    return getattr(settings, 'BLOGENGINE_RELATED_WINDOW', 200)
+
+def term_counts(title, text):
+    counts = Counter(terms(text))
+    for term in terms(title):
+        counts[term] += TITLE_WEIGHT
+    return counts
+
+class Corpus(object):
+    """
+    The signatures and tag sets of a set of posts, indexed for scoring them
+    against each other.
+
+    posts is a callable returning an iterable of (id, term counts); it is
+    called twice, first to count the posts each term appears in and then to
+    weight the terms, so the texts needn't all be held at once.
+    """
+    def __init__(self, posts, post_tags):
+        frequencies = Counter()
+        total = 0
+        for post_id, counts in posts():
+            frequencies.update(counts.keys())
+            total += 1
+
+        self.signatures = {}
+        self.postings = defaultdict(list)
+        for post_id, counts in posts():
+            weights = dict((term, (1 + math.log(count)) *
+                                  math.log(1 + float(total) / frequencies[term]))
+                           for term, count in counts.items())
+            # The norm of the whole vector, so cosines stay comparable
+            # whatever was cut
+            norm = math.sqrt(sum(weight * weight for weight in weights.values())) or 1
+            signature = heapq.nlargest(SIGNATURE_TERMS, weights.items(),
+                                       key=lambda item: item[1])
+            self.signatures[post_id] = [(term, weight / norm) for term, weight in signature]
+            for term, weight in self.signatures[post_id]:
+                if 1 < frequencies[term] <= MAX_POSTINGS:
+                    self.postings[term].append((post_id, weight / norm))
+
+        # Tag postings carry the inverse norm of each post's tag set, so
+        # summing their products gives the cosine
+        self.tag_signatures = {}
+        self.tagged = defaultdict(list)
+        for post_id, tag_ids in post_tags.items():
+            if post_id in self.signatures and tag_ids:
+                weight = 1 / math.sqrt(len(tag_ids))
+                self.tag_signatures[post_id] = (tag_ids, weight)
+                for tag_id in tag_ids:
+                    self.tagged[tag_id].append((post_id, weight))
+
+    def scores(self, post_id):
+        """
+        Returns the scores of the posts related to the post by id.
+        """
+        scores = defaultdict(float)
+        for term, weight in self.signatures.get(post_id, []):
+            for other, other_weight in self.postings.get(term, []):
+                scores[other] += weight * other_weight
+        tag_ids, weight = self.tag_signatures.get(post_id, ((), 0))
+        for tag_id in tag_ids:
+            if len(self.tagged[tag_id]) <= MAX_POSTINGS:
+                for other, other_weight in self.tagged[tag_id]:
+                    scores[other] += weight * other_weight
+        scores.pop(post_id, None)
+        return scores
+
+def best(scores, count):
+    return [(post_id, scores[post_id])
+            for post_id in heapq.nlargest(count, scores, key=scores.__getitem__)]
+
+def post_tags(links):
+    tags = defaultdict(set)
+    for post_id, tag_id in links:
+        tags[post_id].add(tag_id)
+    return tags
+
+def invalidate(post_ids):
+    pagecache.invalidate(['related:%d' % post_id for post_id in post_ids])
+
+def rebuild_related(site, chunk_size=1000):
+    """
+    Scores every post of the site against the others and replaces their
+    related posts, returning the number of posts.
+    """
+    posts = Post.objects.for_site(site).order_by('id')
+
+    def texts():
+        # Keyset chunks, as archive.iter_posts reads them
+        last_id = 0
+        while True:
+            chunk = list(posts.filter(id__gt=last_id).values_list('id', 'title', 'text')
+                                                     [:chunk_size])
+            for post_id, title, text in chunk:
+                yield post_id, term_counts(title, text)
+            if len(chunk) < chunk_size:
+                return
+            last_id = chunk[-1][0]
+
+    links = Post.tags.through.objects.filter(post__site=site).values_list('post_id', 'tag_id')
+    corpus = Corpus(texts, post_tags(links.iterator()))
+    count = related_count()
+    with transaction.atomic():
+        RelatedPost.objects.filter(post__site=site).delete()
+        rows = []
+        for post_id in corpus.signatures:
+            rows.extend(RelatedPost(post_id=post_id, related_id=related_id, score=score)
+                        for related_id, score in best(corpus.scores(post_id), count))
+            if len(rows) >= chunk_size:
+                RelatedPost.objects.bulk_create(rows)
+                rows = []
+        RelatedPost.objects.bulk_create(rows)
+    invalidate(corpus.signatures)
+    return len(corpus.signatures)
+
+def related_posts(post):
+    """
+    Returns the post's related posts, best first.
+    """
+    rows = (RelatedPost.objects.filter(post=post.id).order_by('-score')
+                               .select_related('related')[:related_count()])
+    return [row.related for row in rows]
+
+def chunked(ids, size=500):
+    # SQLite allows 999 parameters a query
+    ids = list(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+def update_related(post):
+    """
+    Scores the post against the posts sharing its tags and the most recent
+    ones, and updates its related posts and theirs.
+    """
+    window = related_window()
+    posts = Post.objects.filter(site=post.site_id)
+    Through = Post.tags.through
+    tag_ids = list(Through.objects.filter(post=post.id).values_list('tag_id', flat=True))
+    candidate_ids = set([post.id])
+    candidate_ids.update(posts.order_by('-pub_date', '-id').values_list('id', flat=True)[:window])
+    if tag_ids:
+        candidate_ids.update(Through.objects.filter(tag__in=tag_ids, post__site=post.site_id)
+                                            .order_by('-post').values_list('post_id', flat=True)
+                                            [:window])
+    counts = []
+    links = []
+    for ids in chunked(candidate_ids):
+        counts.extend((post_id, term_counts(title, text)) for post_id, title, text in
+                      posts.filter(id__in=ids).values_list('id', 'title', 'text'))
+        links.extend(Through.objects.filter(post__in=ids).values_list('post_id', 'tag_id'))
+    scores = Corpus(lambda: counts, post_tags(links)).scores(post.id)
+    count = related_count()
+
+    # The other lists the post is on, or could now join
+    listed_by = set(RelatedPost.objects.filter(related=post.id).values_list('post_id', flat=True))
+    lists = defaultdict(dict)
+    for ids in chunked(listed_by | set(scores)):
+        for post_id, related_id, score in (RelatedPost.objects.filter(post__in=ids)
+                                                      .exclude(related=post.id)
+                                                      .values_list('post_id', 'related_id', 'score')):
+            lists[post_id][related_id] = score
+    changed = set(listed_by)
+    for other, score in scores.items():
+        neighbours = lists[other]
+        if len(neighbours) < count or score > min(neighbours.values()):
+            neighbours[post.id] = score
+            changed.add(other)
+
+    new_rows = [RelatedPost(post_id=post.id, related_id=related_id, score=score)
+                for related_id, score in best(scores, count)]
+    for other in changed:
+        new_rows.extend(RelatedPost(post_id=other, related_id=related_id, score=score)
+                        for related_id, score in best(lists[other], count))
+    changed.add(post.id)
+    with transaction.atomic():
+        for ids in chunked(changed):
+            RelatedPost.objects.filter(post__in=ids).delete()
+        RelatedPost.objects.bulk_create(new_rows)
+    invalidate(changed)
+
+def mark_stale(post_ids):
+    """
+    Queues the posts for update_stale(), once each.
+    """
+    for ids in chunked(set(post_ids)):
+        queued = set(RelatedUpdate.objects.filter(post__in=ids).values_list('post_id', flat=True))
+        try:
+            with transaction.atomic():
+                RelatedUpdate.objects.bulk_create(RelatedUpdate(post_id=post_id)
+                                                  for post_id in ids if post_id not in queued)
+        except IntegrityError:
+            # Another save queued some of them first
+            for post_id in ids:
+                RelatedUpdate.objects.get_or_create(post_id=post_id)
+
+def update_stale(limit=None):
+    """
+    Scores up to limit of the queued posts, oldest first, returning how
+    many were taken off the queue.
+    """
+    post_ids = list(RelatedUpdate.objects.order_by('id').values_list('post_id', flat=True)
+                                         [:limit])
+    for post_id in post_ids:
+        # Taken off the queue first, so a save while scoring queues it again
+        RelatedUpdate.objects.filter(post=post_id).delete()
+        post = Post.objects.filter(id=post_id).only('id', 'site').first()
+        if post is None:
+            continue
+        try:
+            update_related(post)
+        except Exception:
+            mark_stale([post_id])
+            raise
+    return len(post_ids)
+
+@receiver(post_save, sender=Post)
+def post_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        mark_stale([instance.id])
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def post_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            mark_stale([instance.id])
+    elif action == 'pre_clear':
+        # The links are gone by the time post_clear is sent
+        instance.related_post_ids = list(Post.tags.through.objects.filter(tag=instance.id)
+                                                         .values_list('post_id', flat=True))
+    elif action == 'post_clear':
+        mark_stale(instance.related_post_ids)
+    elif action in ('post_add', 'post_remove'):
+        mark_stale(pk_set)
+
+@receiver(pre_delete, sender=Post)
+def post_deleting(sender, instance, **kwargs):
+    # The rows listing the post are deleted along with it
+    instance.related_listings = list(RelatedPost.objects.filter(related=instance.id)
+                                                        .values_list('post_id', flat=True))
+
+@receiver(post_delete, sender=Post)
+def post_deleted(sender, instance, **kwargs):
+    invalidate(instance.related_listings)
@@ -0,0 +1,120 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import markdown2
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.encoding import force_unicode, smart_str
+from django.utils.text import Truncator
+from blogengine import metrics
+
+# Bump whenever the extras or markdown2 version change the generated HTML,
+# so stored renderings are treated as stale and redone.
+RENDERER_VERSION = 1
+
+MARKDOWN_EXTRAS = ["fenced-code-blocks"]
+
+# Words kept in the excerpts shown on listings and feeds; bump
+# RENDERER_VERSION too when changing it, so stored excerpts are redone.
+EXCERPT_WORDS = 60
+
+def text_digest(text):
+    return hashlib.sha1(smart_str(text)).hexdigest()
+
+def render_markdown(text):
+    return markdown2.markdown(force_unicode(text), extras=MARKDOWN_EXTRAS)
+
+def make_excerpt(html):
+    # Cut on words with the tags left open closed again, so excerpts keep
+    # their markup; shorter posts are kept whole
+    return Truncator(html).words(EXCERPT_WORDS, html=True, truncate=u' \u2026')
+
+class RenderCache(object):
+    """
+    Content-addressed cache of rendered Markdown.
+
+    Lookups go through a bounded in-process LRU first and then the Django
+    cache named by BLOGENGINE_RENDER_CACHE, so a body is only rendered once
+    across workers until the shared entry expires.
+    """
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def max_entries(self):
+        return getattr(settings, 'BLOGENGINE_RENDER_CACHE_SIZE', 512)
+
+    @property
+    def shared(self):
+        return caches[getattr(settings, 'BLOGENGINE_RENDER_CACHE', 'default')]
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'BLOGENGINE_RENDER_CACHE_TIMEOUT', 60 * 60 * 24)
+
+    def key(self, text):
+        extras = ','.join(sorted(MARKDOWN_EXTRAS))
+        digest = text_digest(u'%s\0%s' % (extras, force_unicode(text)))
+        return 'blogengine:markdown:%s:%s' % (RENDERER_VERSION, digest)
+
+    def render(self, text):
+        key = self.key(text)
+
+        with self._lock:
+            html = self._entries.pop(key, None)
+            if html is not None:
+                self._entries[key] = html
+                self.local_hits += 1
+                metrics.record_hit('markdown', True)
+                return html
+
+        html = self.shared.get(key)
+        metrics.record_hit('markdown', html is not None)
+        if html is not None:
+            self.shared_hits += 1
+        else:
+            self.misses += 1
+            html = render_markdown(text)
+            self.shared.set(key, html, self.timeout)
+
+        self._remember(key, html)
+        return html
+
+    def _remember(self, key, html):
+        with self._lock:
+            self._entries[key] = html
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        lookups = self.local_hits + self.shared_hits + self.misses
+        hits = self.local_hits + self.shared_hits
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'local_hits': self.local_hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': float(hits) / lookups if lookups else 0.0,
+        }
+
+    def reset_stats(self):
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+render_cache = RenderCache()
+
+def render_markdown_cached(text):
+    return render_cache.render(text)
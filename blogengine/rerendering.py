@@ -0,0 +1,69 @@
+"""
+Renders again the posts whose stored HTML and excerpt are out of date.
+
+A post's rendering goes stale when RENDERER_VERSION is bumped, or when its
+text is changed without saving it, e.g. by a queryset update(). The posts
+are checked a batch at a time and the stale ones given their new rendering
+with UPDATEs rather than saves, as a save sends every post_save receiver,
+rebuilding the feeds once for each post. Each batch instead drops the pages
+showing its posts and indexes those whose text changed for search and
+related posts, and the feeds are rebuilt once everything is rendered.
+"""
+from django.db import transaction
+from blogengine import feedcache, pagecache, related, search
+from blogengine.models import Post
+from blogengine.rendering import text_digest
+
+# Set by Post.render_text()
+RENDERED_FIELDS = ['rendered_text', 'excerpt', 'text_hash', 'renderer_version']
+
+def rerender_batch(posts):
+    """
+    Renders the stale posts again, returning them.
+    """
+    stale = [post for post in posts if not post.rendered_text_is_current()]
+    if not stale:
+        return stale
+    # Text changed behind save() rather than only the renderer
+    changed = [post for post in stale if post.text_hash != text_digest(post.text)]
+    with transaction.atomic():
+        for post in stale:
+            post.render_text()
+            Post.objects.filter(id=post.id).update(**dict((field, getattr(post, field))
+                                                          for field in RENDERED_FIELDS))
+        if changed:
+            search.backend().index(changed)
+            related.mark_stale([post.id for post in changed])
+
+    dependencies = pagecache.link_dependencies(
+        Post.tags.through.objects.filter(post__in=[post.id for post in stale])
+                                 .values_list('post_id', 'tag_id'))
+    dependencies.add('posts')
+    for post in stale:
+        dependencies.add('post:%d' % post.id)
+        if post.category_id is not None:
+            dependencies.add('category-posts:%d' % post.category_id)
+    pagecache.invalidate(dependencies)
+    return stale
+
+def rerender_posts(posts=None, batch_size=500):
+    """
+    Renders again the stale posts of a queryset, all posts by default,
+    returning how many were.
+    """
+    if posts is None:
+        posts = Post.objects.all()
+    posts = posts.only('title', 'text', 'text_hash', 'renderer_version', 'site', 'category')
+    rerendered = 0
+    feeds = set()
+    last_id = 0
+    while True:
+        batch = list(posts.filter(id__gt=last_id).order_by('id')[:batch_size])
+        if not batch:
+            break
+        last_id = batch[-1].id
+        stale = rerender_batch(batch)
+        feeds.update(feedcache.post_feeds(stale))
+        rerendered += len(stale)
+    feedcache.rebuild_feeds(feeds)
+    return rerendered
@@ -0,0 +1,194 @@
+"""
+Full-text search over post titles and text.
+
+On SQLite builds with FTS5, posts are indexed in the blogengine_post_search
+virtual table and ranked by bm25. Elsewhere, or with
+BLOGENGINE_SEARCH_BACKEND set to 'python', words are indexed as SearchTerm
+rows and ranked by tf-idf in Python. In both cases title matches count for
+TITLE_WEIGHT times text matches. The index follows Post saves and deletes,
+and the rebuild_search_index command refills it in bulk.
+"""
+import math
+import re
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from blogengine.models import Post, SearchTerm
+
+TITLE_WEIGHT = 10
+MAX_TERM_LENGTH = SearchTerm._meta.get_field('term').max_length
+
+def terms(text):
+    return [term for term in re.findall(r'\w+', text.lower(), re.UNICODE)
+            if len(term) <= MAX_TERM_LENGTH]
+
+class FTS5Backend(object):
+    table = 'blogengine_post_search'
+
+    def index(self, posts):
+        cursor = connection.cursor()
+        rows = [(post.id, post.title, post.text) for post in posts]
+        cursor.executemany('DELETE FROM %s WHERE rowid = %%s' % self.table,
+                           [(row[0],) for row in rows])
+        cursor.executemany('INSERT INTO %s (rowid, title, text) VALUES (%%s, %%s, %%s)'
+                           % self.table, rows)
+
+    def remove(self, post_ids):
+        connection.cursor().executemany('DELETE FROM %s WHERE rowid = %%s' % self.table,
+                                        [(post_id,) for post_id in post_ids])
+
+    def clear(self):
+        connection.cursor().execute('DELETE FROM %s' % self.table)
+
+    def match(self, query):
+        # Every word must match; quoting keeps FTS5 syntax out of the query
+        return ' '.join('"%s"' % term for term in terms(query))
+
+    def matching(self):
+        return ('FROM {0} JOIN blogengine_post ON blogengine_post.id = {0}.rowid '
+                'WHERE {0} MATCH %s AND blogengine_post.site_id = %s'.format(self.table))
+
+    def count(self, query, site_id):
+        cursor = connection.cursor()
+        cursor.execute('SELECT count(*) ' + self.matching(), [self.match(query), site_id])
+        return cursor.fetchone()[0]
+
+    def search(self, query, site_id, offset, limit):
+        cursor = connection.cursor()
+        cursor.execute('SELECT %s.rowid %s ORDER BY bm25(%s, %d, 1) LIMIT %%s OFFSET %%s'
+                       % (self.table, self.matching(), self.table, TITLE_WEIGHT),
+                       [self.match(query), site_id, limit, offset])
+        return [row[0] for row in cursor.fetchall()]
+
+class PythonBackend(object):
+    def __init__(self):
+        self._ranked = {}
+
+    def index(self, posts):
+        posts = list(posts)
+        SearchTerm.objects.filter(post__in=[post.id for post in posts]).delete()
+        postings = []
+        for post in posts:
+            weights = defaultdict(int)
+            for term in terms(post.title):
+                weights[term] += TITLE_WEIGHT
+            for term in terms(post.text):
+                weights[term] += 1
+            postings.extend(SearchTerm(term=term, post_id=post.id, weight=weight)
+                            for term, weight in weights.items())
+        SearchTerm.objects.bulk_create(postings)
+
+    def remove(self, post_ids):
+        SearchTerm.objects.filter(post__in=post_ids).delete()
+
+    def clear(self):
+        SearchTerm.objects.all().delete()
+
+    def ranked(self, query, site_id):
+        # Counting and slicing the same results only ranks them once
+        if (query, site_id) not in self._ranked:
+            self._ranked[query, site_id] = self.rank(query, site_id)
+        return self._ranked[query, site_id]
+
+    def rank(self, query, site_id):
+        query_terms = set(terms(query))
+        if not query_terms:
+            return []
+        total = Post.objects.filter(site=site_id).count()
+        scores = None
+        for term in query_terms:
+            postings = dict(SearchTerm.objects.filter(term=term, post__site=site_id)
+                                              .values_list('post_id', 'weight'))
+            if not postings:
+                return []
+            idf = math.log(1 + float(total) / len(postings))
+            if scores is None:
+                scores = dict.fromkeys(postings, 0)
+            # Every word must match
+            scores = dict((post_id, score + postings[post_id] * idf)
+                          for post_id, score in scores.items() if post_id in postings)
+        return sorted(scores, key=lambda post_id: (-scores[post_id], -post_id))
+
+    def count(self, query, site_id):
+        return len(self.ranked(query, site_id))
+
+    def search(self, query, site_id, offset, limit):
+        return self.ranked(query, site_id)[offset:offset + limit]
+
+_fts5_available = None
+
+def fts5_available():
+    global _fts5_available
+    if _fts5_available is None:
+        _fts5_available = (connection.vendor == 'sqlite' and
+                           FTS5Backend.table in connection.introspection.table_names())
+    return _fts5_available
+
+def backend():
+    name = getattr(settings, 'BLOGENGINE_SEARCH_BACKEND', 'auto')
+    if name == 'fts5' or (name == 'auto' and fts5_available()):
+        return FTS5Backend()
+    return PythonBackend()
+
+class SearchResults(object):
+    """
+    The ranked posts of a site matching a query, as a lazy sequence a
+    Paginator can slice; only the posts of the requested slice are fetched.
+    """
+    def __init__(self, query, site, queryset):
+        self.query = query
+        self.site = site
+        self.queryset = queryset
+        self.backend = backend()
+
+    def count(self):
+        if not terms(self.query):
+            return 0
+        if not hasattr(self, '_count'):
+            self._count = self.backend.count(self.query, self.site.id)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start = index.start or 0
+        stop = self.count() if index.stop is None else index.stop
+        if stop <= start or not terms(self.query):
+            return []
+        post_ids = self.backend.search(self.query, self.site.id, start, stop - start)
+        posts = self.queryset.in_bulk(post_ids)
+        return [posts[post_id] for post_id in post_ids if post_id in posts]
+
+def rebuild_index(batch_size=1000):
+    """
+    Empties the search index and indexes every post again, returning the
+    number of posts indexed.
+    """
+    search = backend()
+    indexed = 0
+    last_id = 0
+    with transaction.atomic():
+        search.clear()
+        while True:
+            posts = list(Post.objects.filter(id__gt=last_id).order_by('id')
+                                     .only('id', 'title', 'text')[:batch_size])
+            if not posts:
+                break
+            search.index(posts)
+            indexed += len(posts)
+            last_id = posts[-1].id
+    return indexed
+
+@receiver(post_save, sender=Post)
+def post_saved(sender, instance, **kwargs):
+    backend().index([instance])
+
+@receiver(post_delete, sender=Post)
+def post_deleted(sender, instance, **kwargs):
+    backend().remove([instance.id])
@@ -0,0 +1,66 @@
+"""
+Bulk generation of synthetic posts for benchmarking.
+"""
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.db import transaction
+from django.utils import timezone
+from blogengine.models import Category, Post, Tag
+
+WORDS = ('security cryptography network kernel compiler protocol release '
+         'patch cluster latency storage python django markdown feed index '
+         'query cache report analysis source verified news engine').split()
+
+def seed_posts(count, categories=20, tags=200, tags_per_post=3,
+               text_words=200, render=True, batch_size=5000, seed=0):
+    """
+    Appends count posts spread hourly back from now over the given number
+    of categories and tags, each post carrying tags_per_post tags and a
+    Markdown body of text_words words, pre-rendered unless render is false.
+    Inserts go through bulk_create in batches, so none of the model save
+    hooks or signals run.
+    """
+    rng = random.Random(seed)
+    site, _ = Site.objects.get_or_create(id=settings.SITE_ID,
+                                         defaults={'domain': 'example.com',
+                                                   'name': 'example.com'})
+    author, _ = User.objects.get_or_create(username='benchmark')
+    category_ids = [Category.objects.get_or_create(slug='category-%d' % i,
+                        defaults={'name': 'Category %d' % i, 'description': ''})[0].id
+                    for i in range(categories)]
+    tag_ids = [Tag.objects.get_or_create(slug='tag-%d' % i,
+                   defaults={'name': 'Tag %d' % i, 'description': ''})[0].id
+               for i in range(tags)]
+
+    start = Post.objects.count()
+    now = timezone.now()
+    Through = Post.tags.through
+    created = 0
+    while created < count:
+        size = min(batch_size, count - created)
+        with transaction.atomic():
+            posts = []
+            for n in range(start + created, start + created + size):
+                text = ' '.join(rng.choice(WORDS) for _ in range(text_words))
+                post = Post(title='Post %d' % n, slug='seed-post-%d' % n,
+                            pub_date=now - timedelta(hours=n), text=text,
+                            author_id=author.id, site_id=site.id,
+                            category_id=rng.choice(category_ids))
+                if render:
+                    post.render_text()
+                posts.append(post)
+            Post.objects.bulk_create(posts)
+
+            # bulk_create doesn't hand back primary keys, but the batch was
+            # the last thing inserted
+            ids = Post.objects.order_by('-id').values_list('id', flat=True)[:size]
+            Through.objects.bulk_create(
+                Through(post_id=post_id, tag_id=tag_id)
+                for post_id in ids
+                for tag_id in rng.sample(tag_ids, min(tags_per_post, len(tag_ids))))
+        created += size
+    return created
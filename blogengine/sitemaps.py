@@ -0,0 +1,107 @@
+"""
+Sitemaps of a site's posts, categories, tags and flat pages.
+
+A site's own posts are split into chunks of Sitemap.limit in id order, so
+new posts, having the highest ids, only ever fill the last chunk. Each
+chunk is served through the page cache under a
+'sitemap-posts:<site id>:<chunk>' dependency that saves of its own posts
+drop. Creating or deleting a post shifts the posts after it, so it drops
+its chunk and every later one of its site, along with
+'sitemap-index:<site id>' as the site may gain or lose a chunk. Categories
+and tags are listed when they have posts on the site.
+"""
+from django.contrib.flatpages.models import FlatPage
+from django.contrib.sitemaps import Sitemap
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from blogengine import counters, pagecache
+from blogengine.models import Category, Post, Tag
+
+def post_chunk(site_id, post_id):
+    return (Post.objects.filter(site_id=site_id, id__lt=post_id).count() //
+            PostSitemap.limit + 1)
+
+def chunks_from(site_id, post_id):
+    # The post's chunk and every later one, including one the post may
+    # have just emptied
+    last = Post.objects.filter(site_id=site_id).count() // PostSitemap.limit + 1
+    return ['sitemap-posts:%d:%d' % (site_id, chunk)
+            for chunk in range(post_chunk(site_id, post_id), last + 1)]
+
+def sitemap_path(section, page):
+    if page == 1:
+        return '/sitemap-%s.xml' % section
+    return '/sitemap-%s-%d.xml' % (section, page)
+
+def sitemap_pages(site):
+    """
+    Yields the (section, page number) of every page of the site's sitemaps.
+    """
+    for section, sitemap in sorted(sitemaps.items()):
+        for page in range(1, sitemap(site).paginator.num_pages + 1):
+            yield section, page
+
+class SiteSitemap(Sitemap):
+    def __init__(self, site):
+        self.site = site
+
+    def dependencies(self, page):
+        return ['post-counts']
+
+class PostSitemap(SiteSitemap):
+    def items(self):
+        # Just what the URL and lastmod need
+        return Post.objects.for_site(self.site).only('slug', 'pub_date').order_by('id')
+
+    def lastmod(self, post):
+        return post.pub_date
+
+    def dependencies(self, page):
+        return ['sitemap-posts:%d:%d' % (self.site.id, page)]
+
+class CategorySitemap(SiteSitemap):
+    def items(self):
+        # Those with posts on the site
+        return counters.counted_labels(counters.site_counts(Category, self.site)
+                                               .order_by('category__id'))
+
+class TagSitemap(SiteSitemap):
+    def items(self):
+        return counters.counted_labels(counters.site_counts(Tag, self.site).order_by('tag__id'))
+
+class FlatPageSitemap(SiteSitemap):
+    def items(self):
+        return FlatPage.objects.filter(sites=self.site, registration_required=False).order_by('id')
+
+    def location(self, page):
+        return page.url
+
+    def dependencies(self, page):
+        return ['flatpages']
+
+sitemaps = {
+    'posts': PostSitemap,
+    'categories': CategorySitemap,
+    'tags': TagSitemap,
+    'pages': FlatPageSitemap,
+}
+
+@receiver(post_save, sender=Post)
+def post_saved(sender, instance, created, **kwargs):
+    site_id = instance.saved_values.get('site_id', instance.site_id)
+    if created or site_id != instance.site_id:
+        dependencies = chunks_from(instance.site_id, instance.id)
+        dependencies.append('sitemap-index:%d' % instance.site_id)
+        if not created:
+            dependencies.extend(chunks_from(site_id, instance.id))
+            dependencies.append('sitemap-index:%d' % site_id)
+    else:
+        dependencies = ['sitemap-posts:%d:%d' % (instance.site_id,
+                                                 post_chunk(instance.site_id, instance.id))]
+    pagecache.invalidate(dependencies)
+
+@receiver(post_delete, sender=Post)
+def post_deleted(sender, instance, **kwargs):
+    dependencies = chunks_from(instance.site_id, instance.id)
+    dependencies.append('sitemap-index:%d' % instance.site_id)
+    pagecache.invalidate(dependencies)
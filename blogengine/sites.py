@@ -0,0 +1,33 @@
+"""
+Works out which Site a request is for from its host name.
+
+Hosts are looked up by domain, with and without the port, through the
+in-process slugcache, falling back to the SITE_ID site; CurrentSiteMiddleware
+stores the result as request.site for the views and caches to partition by.
+"""
+from django.contrib.sites.models import Site
+from blogengine import slugcache
+
+def site_for_host(host):
+    site = slugcache.sites.get(host)
+    if site is None and ':' in host:
+        site = slugcache.sites.get(host.rsplit(':', 1)[0])
+    if site is None:
+        site = Site.objects.get_current()
+    return site
+
+def request_site(request):
+    # Requests built outside the middleware, such as feed rebuilds, may
+    # carry no site
+    site = getattr(request, 'site', None)
+    if site is None:
+        site = Site.objects.get_current()
+    return site
+
+class CurrentSiteMiddleware(object):
+    def process_request(self, request):
+        request.site = site_for_host(request.get_host())
+
+def site_url(site, path):
+    # Scheme-relative, so the request's scheme is kept when made absolute
+    return '//%s%s' % (site.domain, path)
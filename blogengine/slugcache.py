@@ -0,0 +1,93 @@
+"""
+In-process slug lookups for categories and tags, domain lookups for sites,
+and post id lookups by slug for the view counts.
+
+Each process keeps the instances it has resolved, and the slugs that matched
+nothing, together with the generation token it loaded them under. Saving or
+deleting an instance replaces the token in the shared Django cache, and
+every process drops its entries the next time it sees a different token.
+Posts are saved far more often than they are renamed, so only creating,
+deleting or renaming one replaces the posts token, and only their ids are
+kept.
+"""
+import threading
+import uuid
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from blogengine.models import Category, Post, Tag
+
+_missing = object()
+
+class SlugCache(object):
+    def __init__(self, model, field='slug', columns=None):
+        self.model = model
+        self.field = field
+        # Only these are loaded, when given
+        self.columns = columns
+        self.generation_key = 'blogengine:slugs:%s' % model._meta.model_name
+        self._entries = {}
+        self._generation = None
+        self._lock = threading.Lock()
+
+    @property
+    def shared(self):
+        return caches[getattr(settings, 'BLOGENGINE_SLUG_CACHE', 'default')]
+
+    @property
+    def max_entries(self):
+        return getattr(settings, 'BLOGENGINE_SLUG_CACHE_SIZE', 10000)
+
+    def get(self, slug):
+        """
+        Returns the instance with the given slug, or None if there isn't one.
+        """
+        generation = self.shared.get(self.generation_key)
+        if generation is None:
+            # Start a generation, unless another process just did
+            self.shared.add(self.generation_key, uuid.uuid4().hex, None)
+            generation = self.shared.get(self.generation_key)
+        with self._lock:
+            if generation is None or generation != self._generation:
+                self._entries.clear()
+                self._generation = generation
+            instance = self._entries.get(slug, _missing)
+        if instance is not _missing:
+            return instance
+
+        instances = self.model.objects.filter(**{self.field: slug})
+        if self.columns:
+            instances = instances.only(*self.columns)
+        instance = instances.first()
+        if generation is not None:
+            with self._lock:
+                if generation == self._generation:
+                    # Misses come from arbitrary URLs, so start over rather
+                    # than grow without bound
+                    if len(self._entries) >= self.max_entries:
+                        self._entries.clear()
+                    self._entries[slug] = instance
+        return instance
+
+    def invalidate(self, **kwargs):
+        self.shared.set(self.generation_key, uuid.uuid4().hex, None)
+
+categories = SlugCache(Category)
+tags = SlugCache(Tag)
+sites = SlugCache(Site, field='domain')
+posts = SlugCache(Post, columns=['slug'])
+
+def post_saved(sender, instance, created, **kwargs):
+    if created or instance.saved_values.get('slug', instance.slug) != instance.slug:
+        posts.invalidate()
+
+post_save.connect(categories.invalidate, sender=Category, weak=False)
+post_delete.connect(categories.invalidate, sender=Category, weak=False)
+post_save.connect(tags.invalidate, sender=Tag, weak=False)
+post_delete.connect(tags.invalidate, sender=Tag, weak=False)
+post_save.connect(sites.invalidate, sender=Site, weak=False)
+post_delete.connect(sites.invalidate, sender=Site, weak=False)
+post_save.connect(post_saved, sender=Post, weak=False)
+post_delete.connect(posts.invalidate, sender=Post, weak=False)
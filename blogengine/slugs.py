@@ -0,0 +1,59 @@
+"""
+Unique slugs for a batch of new rows, found with one query.
+
+allocate_slugs() takes the slug each row would like, cut to fit the field,
+and gives the taken ones the first free suffix -2, -3 and so on. The slugs
+that could clash are read with a single query of every slug starting with
+the first characters of each base, which leaves room for the suffix, so
+rows taken by the batch itself or by the database are both avoided without
+a query per row.
+
+Another writer can still take a slug between the query and the insert; the
+unique constraint then raises IntegrityError, and the callers allocate
+again and retry, up to ATTEMPTS times.
+"""
+import operator
+
+from django.db.models import Q
+from django.utils.text import slugify
+
+ATTEMPTS = 5
+# Room kept for a suffix: a dash and up to five digits
+SUFFIX_LENGTH = 6
+# Bases per query, under SQLite's 999 parameters
+CHUNK_SIZE = 500
+
+def slug_base(model, text):
+    max_length = model._meta.get_field('slug').max_length
+    return slugify(unicode(text))[:max_length] or model._meta.model_name
+
+def taken_slugs(model, bases):
+    max_length = model._meta.get_field('slug').max_length
+    stems = sorted(set(base[:max_length - SUFFIX_LENGTH] for base in bases))
+    taken = set()
+    for start in range(0, len(stems), CHUNK_SIZE):
+        prefixes = reduce(operator.or_, [Q(slug__startswith=stem)
+                                         for stem in stems[start:start + CHUNK_SIZE]])
+        taken.update(model._default_manager.filter(prefixes).values_list('slug', flat=True))
+    return taken
+
+def allocate_slugs(model, bases, reserved=()):
+    """
+    Returns a slug of the model for each base, unused by its rows, by each
+    other and by the reserved slugs.
+    """
+    max_length = model._meta.get_field('slug').max_length
+    bases = [base[:max_length] for base in bases]
+    taken = taken_slugs(model, bases)
+    taken.update(reserved)
+    slugs = []
+    for base in bases:
+        slug = base
+        number = 1
+        while slug in taken:
+            number += 1
+            suffix = '-%d' % number
+            slug = base[:max_length - len(suffix)] + suffix
+        taken.add(slug)
+        slugs.append(slug)
+    return slugs
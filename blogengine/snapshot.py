@@ -0,0 +1,293 @@
+"""
+Renders the whole public blog into a directory tree a web server can serve
+without Django.
+
+Pages are rendered by calling their views directly, the way feedcache
+rebuilds feeds, and written to <path>/index.html, or <path>/index.xml for
+feeds; sitemaps are written to the file their path names. Listings use numbered pages so their links resolve to files. A
+manifest in the output directory records what each page shows, using the
+pagecache dependency names, along with a fingerprint of every dependency at
+export time, so an incremental export only re-renders the pages whose posts,
+categories, tags, related posts, archive months, post counts, sitemap
+chunks, recent views or flat pages changed since the previous one.
+"""
+import hashlib
+import json
+import os
+from collections import defaultdict
+from datetime import timedelta
+from multiprocessing import Pool
+
+from django.contrib.flatpages.models import FlatPage
+from django.db import connections
+from django.db.models import Count
+from django.http import Http404, HttpRequest
+from blogengine import counters, months, pagecache, sitemaps, viewcounts
+from blogengine.models import Category, MonthCount, Post, PostViewCount, RelatedPost, Tag
+
+MANIFEST = '.manifest.json'
+
+def listing_pages(kind, url, count, page_size, **kwargs):
+    pages = max(1, (count + page_size - 1) // page_size)
+    for number in range(1, pages + 1):
+        path = url if number == 1 else '%s%d/' % (url, number)
+        # An explicit page number keeps the links numbered too
+        yield (path, kind, dict(kwargs, page=str(number)))
+
+def site_pages(site):
+    """
+    Yields (path, kind, kwargs) for every public page of the site's blog.
+    """
+    from blogengine.views import CategoryListView, MonthListView, PostListView, TagListView
+
+    posts = Post.objects.for_site(site)
+    for page in listing_pages('index', '/', posts.count(), PostListView.paginate_by):
+        yield page
+    for post in posts.only('slug', 'pub_date').order_by('id').iterator():
+        yield (post.get_absolute_url(), 'post',
+               {'pub_date__year': str(post.pub_date.year),
+                'pub_date__month': str(post.pub_date.month),
+                'slug': post.slug})
+
+    counts = dict(posts.order_by().values_list('category').annotate(posts=Count('id')))
+    for category in Category.objects.order_by('id'):
+        for page in listing_pages('category', category.get_absolute_url(),
+                                  counts.get(category.id, 0),
+                                  CategoryListView.paginate_by, slug=category.slug):
+            yield page
+        yield ('/feeds/posts/category/%s/' % category.slug, 'feed', {'slug': category.slug})
+    links = Post.tags.through.objects.filter(post__site=site)
+    counts = dict(links.values_list('tag').annotate(posts=Count('id')))
+    for tag in Tag.objects.order_by('id'):
+        for page in listing_pages('tag', tag.get_absolute_url(), counts.get(tag.id, 0),
+                                  TagListView.paginate_by, slug=tag.slug):
+            yield page
+    yield ('/feeds/posts/', 'feed', {})
+
+    years = set()
+    for month in months.site_months(site):
+        years.add(month.year)
+        for page in listing_pages('month', month.get_absolute_url(), month.posts,
+                                  MonthListView.paginate_by,
+                                  year=str(month.year), month=str(month.month)):
+            yield page
+    for year in sorted(years):
+        yield ('/archive/%d/' % year, 'year', {'year': str(year)})
+
+    for page in FlatPage.objects.filter(sites=site, registration_required=False):
+        yield (page.url, 'flatpage', {'url': page.url})
+    yield ('/most-read/', 'most_read', {})
+
+    yield ('/sitemap.xml', 'sitemap', {})
+    for section, page in sitemaps.sitemap_pages(site):
+        yield (sitemaps.sitemap_path(section, page), 'sitemap',
+               {'section': section, 'page': str(page)})
+
+def feed_dependencies(site, slug=None):
+    from blogengine.views import CategoryPostsFeed, PostsFeed
+
+    if slug is None:
+        dependencies = ['posts']
+        posts = PostsFeed().items(site)
+    else:
+        category = Category.objects.get(slug=slug)
+        category.site = site
+        dependencies = ['category-slug:%s' % slug, 'category:%d' % category.id,
+                        'category-posts:%d' % category.id]
+        posts = CategoryPostsFeed().items(category)
+    for post in posts:
+        dependencies.extend(pagecache.post_dependencies(post))
+    return dependencies
+
+def render_page(site, path, kind, kwargs):
+    """
+    Returns the response for the page and the dependencies it recorded.
+    """
+    from blogengine.views import (CategoryListView, CategoryPostsFeed, MonthListView,
+                                  PostDetailView, PostListView, PostsFeed, TagListView,
+                                  YearArchiveView, flatpage, most_read, sitemap_index,
+                                  sitemap_section)
+    views = {'index': PostListView, 'post': PostDetailView,
+             'category': CategoryListView, 'tag': TagListView,
+             'month': MonthListView, 'year': YearArchiveView}
+
+    request = HttpRequest()
+    request.method = 'GET'
+    request.path = path
+    request.site = site
+    request.page_dependencies = set(['flatpages'])
+    if kind == 'feed':
+        if kwargs:
+            response = CategoryPostsFeed().render_feed(request, **kwargs)
+        else:
+            response = PostsFeed().render_feed(request)
+        request.page_dependencies.update(feed_dependencies(site, kwargs.get('slug')))
+    elif kind == 'flatpage':
+        response = flatpage(request, **kwargs)
+    elif kind == 'most_read':
+        response = most_read(request)
+    elif kind == 'sitemap':
+        response = sitemap_section(request, **kwargs) if kwargs else sitemap_index(request)
+    else:
+        response = views[kind].as_view()(request, **kwargs)
+    if not getattr(response, 'is_rendered', True):
+        response.render()
+    return response, request.page_dependencies
+
+def page_filename(path, kind):
+    # Sitemap paths name their file already
+    if kind == 'sitemap':
+        return path.strip('/')
+    return os.path.join(path.strip('/'), 'index.xml' if kind == 'feed' else 'index.html')
+
+def export_page(job):
+    output, site, (path, kind, kwargs) = job
+    try:
+        response, dependencies = render_page(site, path, kind, kwargs)
+    except Http404:
+        return path, None, []
+    if response.status_code != 200:
+        return path, None, []
+
+    filename = page_filename(path, kind)
+    target = os.path.join(output, filename)
+    if not os.path.isdir(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target))
+    with open(target, 'wb') as f:
+        f.write(response.content)
+    return path, filename, sorted(dependencies)
+
+def digest(*values):
+    return hashlib.md5(repr(values)).hexdigest()
+
+def fingerprints():
+    """
+    Returns a fingerprint of the current state of every page dependency.
+
+    Listings are fingerprinted by the order of their post ids alone; what
+    each post shows is covered by its own fingerprint.
+    """
+    prints = {}
+    listings = defaultdict(hashlib.md5)
+    post_tags = defaultdict(list)
+    links = (Post.tags.through.objects.order_by('-post__pub_date', '-post__id')
+                                      .values_list('post_id', 'tag_id'))
+    for post_id, tag_id in links.iterator():
+        listings['tag-posts:%d' % tag_id].update('%d,' % post_id)
+        post_tags[post_id].append(tag_id)
+
+    posts = Post.objects.order_by('-pub_date', '-id').values_list(
+        'id', 'title', 'slug', 'pub_date', 'text_hash', 'renderer_version', 'category_id')
+    for post in posts.iterator():
+        post_id, category_id = post[0], post[-1]
+        prints['post:%d' % post_id] = digest(post, sorted(post_tags[post_id]))
+        listings['posts'].update('%d,' % post_id)
+        if category_id is not None:
+            listings['category-posts:%d' % category_id].update('%d,' % post_id)
+    prints.update((name, listing.hexdigest()) for name, listing in listings.items())
+
+    # Each site's posts in id order, in the sitemaps' chunks
+    site_posts = defaultdict(list)
+    rows = Post.objects.order_by('site', 'id').values_list('site_id', 'id', 'slug', 'pub_date')
+    for row in rows.iterator():
+        site_posts[row[0]].append(row[1:])
+    limit = sitemaps.PostSitemap.limit
+    for site_id, rows in site_posts.items():
+        chunks = [rows[start:start + limit] for start in range(0, len(rows), limit)]
+        prints['sitemap-index:%d' % site_id] = digest(len(chunks))
+        for number, chunk in enumerate(chunks, 1):
+            prints['sitemap-posts:%d:%d' % (site_id, number)] = digest(chunk)
+
+    counts = []
+    for model, name in ((Category, 'category'), (Tag, 'tag')):
+        rows = model.objects.order_by('id').values_list('id', 'name', 'slug')
+        for instance_id, instance_name, slug in rows:
+            prints['%s:%d' % (name, instance_id)] = digest(instance_name, slug)
+            prints['%s-slug:%s' % (name, slug)] = digest(instance_id)
+            counts.append((name, instance_id, instance_name, slug))
+        count_model = counters.COUNT_MODELS[model]
+        counts.extend(count_model.objects.filter(posts__gt=0).order_by('id').values_list(
+            'site_id', count_model.label_name, 'posts'))
+    prints['post-counts'] = digest(counts)
+
+    related = defaultdict(list)
+    rows = RelatedPost.objects.order_by('post', '-score').values_list('post_id', 'related_id')
+    for post_id, related_id in rows.iterator():
+        related['related:%d' % post_id].append(related_id)
+    prints.update((name, digest(related_ids)) for name, related_ids in related.items())
+
+    # The default listing, which also moves on every day
+    since = viewcounts.today() - timedelta(days=viewcounts.most_read_days())
+    prints['most-read'] = digest(viewcounts.today(), list(
+        PostViewCount.objects.filter(day__gt=since).order_by('post', 'day')
+                             .values_list('post_id', 'day', 'views')))
+
+    prints['months'] = digest(list(MonthCount.objects.filter(posts__gt=0).order_by('id')
+                                             .values_list('site_id', 'year', 'month', 'posts')))
+
+    pages = FlatPage.objects.order_by('id').values_list(
+        'id', 'url', 'title', 'content', 'template_name', 'registration_required')
+    sites = FlatPage.sites.through.objects.order_by('flatpage_id', 'site_id').values_list(
+        'flatpage_id', 'site_id')
+    prints['flatpages'] = digest(list(pages), list(sites))
+    return prints
+
+def export_site(output, site, processes=1, incremental=False):
+    """
+    Renders the site's blog into the output directory, spreading the pages
+    over a pool of processes if there is more than one, and returns the
+    numbers of pages rendered and removed.
+
+    With incremental, pages whose dependencies are unchanged since the
+    previous export are left as they are. Either way, pages that no longer
+    exist are deleted.
+    """
+    manifest_path = os.path.join(output, MANIFEST)
+    previous = {'pages': {}, 'fingerprints': {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+    elif not os.path.isdir(output):
+        os.makedirs(output)
+
+    # Fingerprint before rendering, so changes made meanwhile are picked up
+    # by the next export
+    current = fingerprints()
+    pages = {}
+    jobs = []
+    for path, kind, kwargs in site_pages(site):
+        page = previous['pages'].get(path)
+        if (incremental and page is not None and os.path.exists(os.path.join(output, page['file'])) and
+                all(current.get(name) == previous['fingerprints'].get(name)
+                    for name in page['dependencies'])):
+            pages[path] = page
+        else:
+            jobs.append((output, site, (path, kind, kwargs)))
+
+    if processes > 1 and len(jobs) > 1:
+        # The workers open their own database connections
+        for connection in connections.all():
+            connection.close()
+        pool = Pool(processes)
+        try:
+            results = pool.map(export_page, jobs, chunksize=max(1, len(jobs) // (processes * 8)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(export_page, jobs)
+
+    for path, filename, dependencies in results:
+        if filename is not None:
+            pages[path] = {'file': filename, 'dependencies': dependencies}
+
+    removed = 0
+    for path, page in previous['pages'].items():
+        target = os.path.join(output, page['file'])
+        if path not in pages and os.path.exists(target):
+            os.remove(target)
+            removed += 1
+
+    with open(manifest_path, 'w') as f:
+        json.dump({'pages': pages, 'fingerprints': current}, f)
+    return len(jobs), removed
@@ -1,16 +1,20 @@
-import markdown2
-
 from django import template
-from django.template.defaultfilters import stringfilter
-from django.utils.encoding import force_unicode
 from django.utils.safestring import mark_safe
+from blogengine import metrics
+from blogengine.models import Post
+from blogengine.rendering import render_markdown_cached
 
 register = template.Library()
 
 @register.filter(is_safe=True)
-@stringfilter
 def custom_markdown(value):
-    extras = ["fenced-code-blocks"]
+    # Posts carry their own pre-rendered HTML
+    with metrics.timed('markdown'):
+        if isinstance(value, Post):
+            return mark_safe(value.get_rendered_text())
+
+        return mark_safe(render_markdown_cached(value))
 
-    return mark_safe(markdown2.markdown(force_unicode(value),
-                                        extras = extras))
+@register.filter(is_safe=True)
+def excerpt(post):
+    return mark_safe(post.get_excerpt())
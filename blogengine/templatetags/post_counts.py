@@ -0,0 +1,27 @@
+import math
+
+from django import template
+from blogengine import counters
+from blogengine.models import Category, Tag
+
+register = template.Library()
+
+# Both tags read the site's post counters only; see blogengine.counters
+
+@register.inclusion_tag('blogengine/includes/tag_cloud.html')
+def tag_cloud(site, limit=50, steps=5):
+    tags = counters.counted_labels(counters.site_counts(Tag, site)
+                                           .order_by('-posts', 'tag__name')[:limit])
+    if tags:
+        # Weights from 1 to steps, on a log scale so a few big tags don't
+        # flatten the rest
+        low, high = math.log(tags[-1].post_count), math.log(tags[0].post_count)
+        for tag in tags:
+            spread = (math.log(tag.post_count) - low) / (high - low) if high > low else 0
+            tag.weight = 1 + int(round(spread * (steps - 1)))
+    return {'tags': sorted(tags, key=lambda tag: tag.name.lower())}
+
+@register.inclusion_tag('blogengine/includes/category_counts.html')
+def category_counts(site):
+    return {'categories': counters.counted_labels(counters.site_counts(Category, site)
+                                                          .order_by('category__name'))}
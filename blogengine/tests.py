@@ -1,8 +1,27 @@
 import markdown2 as markdown
+import json
+import os
+import shutil
+import tempfile
+import threading
+from StringIO import StringIO
+from calendar import timegm
+from datetime import timedelta
 import feedparser
 from django.test import TestCase, LiveServerTestCase, Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.db import connection
+from django.db.models.signals import post_save
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.utils import timezone
-from blogengine.models import Post, Category, Tag
+from django.utils.http import http_date
+from blogengine import (counters, feedcache, ingest, metrics, months, pagecache, related,
+                        rerendering, search, seeding, sitemaps, slugcache, slugs, viewcounts)
+from blogengine.models import (Post, Category, CategoryCount, IngestJob, MonthCount,
+                               PostViewCount, RelatedUpdate, Tag, TagCount)
+from blogengine.rendering import RENDERER_VERSION, render_cache, render_markdown_cached
 from django.contrib.flatpages.models import FlatPage
 from django.contrib.sites.models import Site
 from django.contrib.auth.models import User
@@ -159,10 +178,1433 @@ class PostTest(TestCase):
         self.assertEquals(only_post_tag.name, 'security')
         self.assertEquals(only_post_tag.description, 'System or data security')
 
+    def test_post_stores_rendered_text(self):
+        # Create the post
+        post = PostFactory(text='My *first* blog post')
+
+        # Check rendered HTML was stored on save
+        only_post = Post.objects.all()[0]
+        self.assertEquals(only_post.rendered_text, markdown.markdown(post.text))
+        self.assertEquals(only_post.renderer_version, RENDERER_VERSION)
+        self.assertTrue(only_post.rendered_text_is_current())
+
+        # Change the text
+        only_post.text = 'My *edited* blog post'
+        only_post.save()
+        self.assertTrue('<em>edited</em>' in only_post.rendered_text)
+
+    def test_stale_rendered_text_falls_back(self):
+        # Create the post
+        PostFactory(text='My *first* blog post')
+
+        # Change text behind the model's back
+        Post.objects.update(text='My *updated* blog post')
+
+        # Check stored HTML is not served
+        only_post = Post.objects.all()[0]
+        self.assertFalse(only_post.rendered_text_is_current())
+        self.assertTrue('<em>updated</em>' in only_post.get_rendered_text())
+
+class RenderCacheTest(TestCase):
+    def setUp(self):
+        render_cache.clear()
+        render_cache.shared.clear()
+        render_cache.reset_stats()
+
+    def test_render_is_cached(self):
+        # Render the same body twice
+        html = render_markdown_cached('My *first* blog post')
+        self.assertEquals(render_markdown_cached('My *first* blog post'), html)
+        self.assertEquals(html, markdown.markdown('My *first* blog post'))
+
+        # Check only the first render missed
+        stats = render_cache.stats()
+        self.assertEquals(stats['misses'], 1)
+        self.assertEquals(stats['local_hits'], 1)
+
+        # Check other workers would hit the shared cache
+        render_cache.clear()
+        render_markdown_cached('My *first* blog post')
+        self.assertEquals(render_cache.stats()['shared_hits'], 1)
+
+    @override_settings(BLOGENGINE_RENDER_CACHE_SIZE=2)
+    def test_lru_is_bounded(self):
+        # Render more bodies than fit
+        for text in ['one', 'two', 'three']:
+            render_markdown_cached(text)
+
+        # Check the oldest entry was evicted
+        stats = render_cache.stats()
+        self.assertEquals(stats['entries'], 2)
+        self.assertEquals(stats['evictions'], 1)
+
+class FeedCacheTest(TestCase):
+    def setUp(self):
+        feedcache.feed_cache().clear()
+
+    def test_feeds_are_built_on_save(self):
+        # Create the post
+        post = PostFactory(text='My *first* blog post')
+
+        # Check both feeds were stored without a request
+        for slug in [None, 'security']:
+            cached = feedcache.feed_cache().get(feedcache.feed_key(1, slug))
+            self.assertTrue(cached is not None)
+            self.assertTrue(post.title in cached[0])
+
+        # Check the stored feed is what gets served
+        Post.objects.update(title='Changed behind the cache')
+        response = self.client.get('/feeds/posts/')
+        self.assertTrue('First Post' in response.content)
+
+        # Check tagging the post rebuilds the feeds
+        post.tags.add(TagFactory())
+        response = self.client.get('/feeds/posts/category/security/')
+        feed = feedparser.parse(response.content)
+        self.assertEquals(feed.entries[0].title, 'Changed behind the cache')
+        self.assertEquals(feed.entries[0].tags[0].term, 'security')
+
+    def test_moving_post_rebuilds_old_category_feed(self):
+        # Create the post
+        post = PostFactory()
+
+        # Move it to another category
+        post.category = CategoryFactory(name='cryptography', slug='cryptography',
+                                        description='Cryptography and encryption')
+        post.save()
+
+        # Check it left the old category feed
+        response = self.client.get('/feeds/posts/category/security/')
+        self.assertEquals(len(feedparser.parse(response.content).entries), 0)
+        response = self.client.get('/feeds/posts/category/cryptography/')
+        self.assertEquals(len(feedparser.parse(response.content).entries), 1)
+
+    def test_feed_cache_must_be_shared(self):
+        # Check a cache private to each process is warned about outside DEBUG
+        local = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        shared = {'default': {'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache'}}
+        with self.settings(DEBUG=False, CACHES=local):
+            self.assertEquals([warning.id for warning in feedcache.check_feed_cache(None)],
+                              ['blogengine.W001'])
+        with self.settings(DEBUG=False, CACHES=shared):
+            self.assertEquals(feedcache.check_feed_cache(None), [])
+
+    @override_settings(BLOGENGINE_FEED_CACHE_ASYNC=True)
+    def test_async_rebuild(self):
+        # Create the post
+        PostFactory()
+
+        # Check the stale feed was dropped rather than rebuilt
+        key = feedcache.feed_key(1)
+        self.assertTrue(feedcache.feed_cache().get(key) is None)
+
+        # Check the next request rebuilds and stores it
+        response = self.client.get('/feeds/posts/')
+        self.assertTrue('First Post' in response.content)
+        self.assertTrue('First Post' in feedcache.feed_cache().get(key)[0])
+
+    def test_admin_save_rebuilds_feeds_once(self):
+        # Create a tagged post, and log in
+        post = PostFactory()
+        post.tags.add(TagFactory(), TagFactory(name='django', slug='django'))
+        User.objects.create_superuser('bobsmith', 'bob@example.com', 'password')
+        self.client.login(username='bobsmith', password='password')
+
+        # Count the feeds rebuilt
+        rebuilt = []
+        rebuild_feed = feedcache.rebuild_feed
+        def counting_rebuild(site_id, slug=None):
+            rebuilt.append((site_id, slug))
+            rebuild_feed(site_id, slug)
+        feedcache.rebuild_feed = counting_rebuild
+        self.addCleanup(setattr, feedcache, 'rebuild_feed', rebuild_feed)
+
+        # Check saving it with another tag rebuilds each of its feeds once
+        response = self.client.post('/admin/blogengine/post/%d/' % post.id, {
+            'title': 'Edited Post',
+            'text': post.text,
+            'slug': post.slug,
+            'pub_date_0': '2015-01-01',
+            'pub_date_1': '12:00:05',
+            'site': '1',
+            'category': str(post.category_id),
+            'tags': str(TagFactory(name='python', slug='python').id),
+        })
+        self.assertEquals(response.status_code, 302)
+        self.assertEquals(sorted(rebuilt), [(1, None), (1, 'security')])
+        self.assertTrue('Edited Post' in feedcache.get_feed(1)[0])
+
+    def test_rebuild_keeps_validators(self):
+        # Create the post and fetch the feed
+        post = PostFactory()
+        response = self.client.get('/feeds/posts/')
+        etag = response['ETag']
+
+        # Check it's dated by the post rather than the time it was built
+        feed = feedparser.parse(response.content)
+        self.assertEquals(feed.feed.updated_parsed[:6], post.pub_date.utctimetuple()[:6])
+        self.assertEquals(response['Last-Modified'], http_date(timegm(post.pub_date.utctimetuple())))
+
+        # Check a rebuild with nothing changed still answers the old ETag
+        feedcache.feed_cache().clear()
+        response = self.client.get('/feeds/posts/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+
+class SlugCacheTest(TestCase):
+    def test_slugs_are_resolved_once(self):
+        # Create the category
+        category = CategoryFactory()
+
+        # Check only the first lookup hits the database
+        with self.assertNumQueries(1):
+            slugcache.categories.get('security')
+        with self.assertNumQueries(0):
+            self.assertEquals(slugcache.categories.get('security'), category)
+
+        # Check saving the category drops it
+        category.name = 'infosec'
+        category.save()
+        with self.assertNumQueries(1):
+            self.assertEquals(slugcache.categories.get('security').name, 'infosec')
+
+        # Check deleted categories stop resolving
+        category.delete()
+        self.assertTrue(slugcache.categories.get('security') is None)
+
+class PageCacheTest(TestCase):
+    def setUp(self):
+        pagecache.page_cache().clear()
+
+    def test_pages_are_purged_by_dependency(self):
+        # Create the post
+        post = PostFactory()
+        post.tags.add(TagFactory())
+
+        # Check the second request for each page is served from the cache
+        urls = ['/', post.get_absolute_url(), '/category/security/', '/tag/security/']
+        for url in urls:
+            self.client.get(url)
+            with self.assertNumQueries(0):
+                self.assertEquals(self.client.get(url).status_code, 200)
+
+        # Check an unrelated category leaves the pages alone
+        CategoryFactory(name='cryptography', slug='cryptography',
+                        description='Cryptography and encryption')
+        with self.assertNumQueries(0):
+            for url in urls:
+                self.client.get(url)
+
+        # Check renaming the tag purges every page showing it
+        tag = Tag.objects.get(slug='security')
+        tag.name = 'infosec'
+        tag.save()
+        for url in urls:
+            self.assertTrue('infosec' in self.client.get(url).content)
+
+        # Check a new flat page appears in the navigation
+        FlatPageFactory().sites.add(Site.objects.get_current())
+        self.assertTrue('About Me' in self.client.get('/').content)
+
+        # Check deleting the post empties its listings
+        post.delete()
+        self.assertEquals(self.client.get(post.get_absolute_url()).status_code, 404)
+        self.assertTrue('No posts found' in self.client.get('/tag/security/').content)
+
+class ExportStaticTest(TestCase):
+    def setUp(self):
+        self.output = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output)
+
+    def export(self, incremental=False):
+        output = StringIO()
+        call_command('export_static', self.output, processes=1,
+                     incremental=incremental, stdout=output)
+        return output.getvalue()
+
+    def test_export(self):
+        # Create the post and a flat page
+        post = PostFactory()
+        post.tags.add(TagFactory())
+        FlatPageFactory().sites.add(Site.objects.get_current())
+
+        # Check every page was written
+        self.assertTrue('Rendered 15 pages' in self.export())
+        archive = 'archive/%d/' % post.pub_date.year
+        for path in ['index.html', 'category/security/index.html', 'tag/security/index.html',
+                     'feeds/posts/index.xml', 'feeds/posts/category/security/index.xml',
+                     'about/index.html', archive + 'index.html',
+                     archive + '%d/index.html' % post.pub_date.month, 'sitemap.xml',
+                     'sitemap-posts.xml', 'sitemap-categories.xml', 'sitemap-tags.xml',
+                     'sitemap-pages.xml', 'most-read/index.html']:
+            self.assertTrue(os.path.exists(os.path.join(self.output, path)))
+        with open(os.path.join(self.output, 'sitemap-posts.xml')) as f:
+            self.assertTrue(post.get_absolute_url() in f.read())
+        with open(os.path.join(self.output, post.get_absolute_url().strip('/'), 'index.html')) as f:
+            self.assertTrue('My first blog post' in f.read())
+
+        # Check an unchanged blog renders nothing
+        self.assertTrue('Rendered 0 pages' in self.export(incremental=True))
+
+        # Check editing the post leaves the flat page and year page alone
+        post.title = 'Edited Post'
+        post.save()
+        self.assertTrue('Rendered 7 pages' in self.export(incremental=True))
+        with open(os.path.join(self.output, 'index.html')) as f:
+            self.assertTrue('Edited Post' in f.read())
+
+        # Check a new post renders the posts sitemap again
+        PostFactory(title='Second Post', slug='second-post')
+        self.export(incremental=True)
+        with open(os.path.join(self.output, 'sitemap-posts.xml')) as f:
+            self.assertTrue('second-post' in f.read())
+
+        # Check deleted pages are removed
+        FlatPage.objects.all().delete()
+        self.assertTrue('Rendered 15 pages and removed 1' in self.export(incremental=True))
+        self.assertFalse(os.path.exists(os.path.join(self.output, 'about/index.html')))
+
+class SearchTest(TestCase):
+    def create_posts(self):
+        PostFactory(title='Kernel patch', slug='kernel-patch',
+                    text='A release note about the compiler')
+        PostFactory(title='Compiler release', slug='compiler-release',
+                    text='The kernel build changed')
+        PostFactory(title='Unrelated', slug='unrelated', text='Nothing to see')
+
+    def search_titles(self, query):
+        response = self.client.get('/search/', {'q': query})
+        self.assertEquals(response.status_code, 200)
+        return [post.title for post in response.context['object_list']]
+
+    def check_search(self):
+        self.create_posts()
+
+        # Check title matches rank first and every word must match
+        self.assertEquals(self.search_titles('kernel'), ['Kernel patch', 'Compiler release'])
+        self.assertEquals(self.search_titles('compiler RELEASE'),
+                          ['Compiler release', 'Kernel patch'])
+        self.assertEquals(self.search_titles('kernel unrelated'), [])
+        self.assertEquals(self.search_titles('"'), [])
+
+        # Check edits and deletes reach the index
+        post = Post.objects.get(slug='unrelated')
+        post.text = 'Kernel hardening'
+        post.save()
+        self.assertEquals(len(self.search_titles('kernel')), 3)
+        post.delete()
+        self.assertEquals(len(self.search_titles('kernel')), 2)
+
+        # Check a rebuild finds bulk inserted posts
+        Post.objects.bulk_create([Post(title='Bulk kernel', slug='bulk-kernel', text='',
+                                       pub_date=timezone.now(), author=AuthorFactory(),
+                                       site=SiteFactory())])
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEquals(self.search_titles('kernel')[0], 'Bulk kernel')
+
+    @override_settings(BLOGENGINE_SEARCH_BACKEND='fts5')
+    def test_fts5_search(self):
+        self.check_search()
+
+    @override_settings(BLOGENGINE_SEARCH_BACKEND='python')
+    def test_python_search(self):
+        self.check_search()
+
+    @override_settings(BLOGENGINE_SEARCH_BACKEND='python')
+    def test_search_pagination(self):
+        for i in range(25):
+            PostFactory(title='Post %d' % i, slug='post-%d' % i)
+
+        # Follow the next links
+        response = self.client.get('/search/', {'q': 'first'})
+        self.assertEquals(len(response.context['object_list']), 20)
+        self.assertEquals(response.context['next_page_url'], '/search/?q=first&page=2')
+        response = self.client.get(response.context['next_page_url'])
+        self.assertEquals(len(response.context['object_list']), 5)
+        self.assertEquals(response.context['previous_page_url'], '/search/?q=first')
+
+class ImportPostsTest(TestCase):
+    def setUp(self):
+        self.output = tempfile.mkdtemp()
+        AuthorFactory()
+        CategoryFactory()
+
+    def tearDown(self):
+        shutil.rmtree(self.output)
+
+    def import_file(self, name, content):
+        path = os.path.join(self.output, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        output = StringIO()
+        call_command('import_posts', path, author='testuser', batch_size=2, processes=1,
+                     stdout=output)
+        return output.getvalue()
+
+    def test_import(self):
+        # Import posts from JSON lines
+        records = [
+            {'title': 'First Post', 'text': 'My *first* post', 'category': 'security',
+             'tags': ['python', 'django'], 'pub_date': '2015-01-10T08:00:00'},
+            {'title': 'Second Post', 'text': 'Another', 'category': 'cryptography',
+             'tags': 'python'},
+            {'title': 'First Post', 'text': 'Same slug again'},
+        ]
+        output = self.import_file('posts.jsonl', '\n'.join(json.dumps(r) for r in records))
+        self.assertTrue('Imported 2 posts and skipped 1 existing' in output)
+
+        # Check the posts, categories and tags were linked up
+        post = Post.objects.get(slug='first-post')
+        self.assertEquals(post.category.slug, 'security')
+        self.assertEquals(sorted(tag.slug for tag in post.tags.all()), ['django', 'python'])
+        self.assertEquals(post.pub_date.year, 2015)
+        self.assertTrue(post.rendered_text_is_current())
+        self.assertTrue('<em>first</em>' in post.rendered_text)
+        self.assertEquals(post.excerpt, post.rendered_text)
+        self.assertEquals(Category.objects.count(), 2)
+        self.assertEquals(Tag.objects.get(slug='python').post_set.count(), 2)
+
+        # Check the counters took the imported posts in
+        self.assertEquals(TagCount.objects.get(tag__slug='python').posts, 2)
+        self.assertEquals(CategoryCount.objects.get(category__slug='security').posts, 1)
+        self.assertEquals(MonthCount.objects.get(year=2015, month=1).posts, 1)
+
+        # Check the imported posts are searchable
+        response = self.client.get('/search/', {'q': 'another'})
+        self.assertEquals(len(response.context['object_list']), 1)
+
+        # Import more from CSV
+        output = self.import_file('posts.csv', 'title,text,tags\n'
+                                               'Third Post,Body,"python, rust"\n')
+        self.assertTrue('Imported 1 posts' in output)
+        self.assertEquals(Tag.objects.get(slug='rust').post_set.get().title, 'Third Post')
+
+    def test_import_allocating_slugs(self):
+        PostFactory(title='First Post', slug='first-post')
+
+        # Import posts whose title's slug is taken, and one naming a taken slug
+        path = os.path.join(self.output, 'posts.jsonl')
+        with open(path, 'w') as f:
+            f.write('\n'.join(json.dumps(record) for record in [
+                {'title': 'First Post', 'text': 'Again'},
+                {'title': 'First Post', 'text': 'And again'},
+                {'title': 'Copy', 'text': 'Copy', 'slug': 'first-post'},
+            ]))
+        output = StringIO()
+        call_command('import_posts', path, author='testuser', processes=1,
+                     allocate_slugs=True, stdout=output)
+        self.assertTrue('Imported 2 posts and skipped 1 existing' in output.getvalue())
+
+        # Check the untitled ones were given the next free slugs
+        self.assertEquals(Post.objects.get(slug='first-post-2').text, 'Again')
+        self.assertEquals(Post.objects.get(slug='first-post-3').text, 'And again')
+
+    def test_bad_records_are_refused(self):
+        path = os.path.join(self.output, 'posts.jsonl')
+
+        # Check a record without an author, and no default, is named
+        with open(path, 'w') as f:
+            f.write(json.dumps({'title': 'First Post', 'text': 'Body'}))
+        with self.assertRaisesRegexp(CommandError, '"First Post" has no author'):
+            call_command('import_posts', path, processes=1, stdout=StringIO())
+
+        # Check an unreadable pub_date is refused too
+        with open(path, 'w') as f:
+            f.write(json.dumps({'title': 'First Post', 'text': 'Body', 'pub_date': 'soon'}))
+        with self.assertRaisesRegexp(CommandError, '"First Post": pub_date must be'):
+            call_command('import_posts', path, author='testuser', processes=1,
+                         stdout=StringIO())
+        self.assertEquals(Post.objects.count(), 0)
+
+class SlugTest(TestCase):
+    def test_allocate_slugs(self):
+        TagFactory()
+        TagFactory(name='security 2', slug='security-2')
+
+        # Check a batch is allocated with one query, avoiding rows and itself
+        with self.assertNumQueries(1):
+            allocated = slugs.allocate_slugs(Tag, ['security', 'security', 'kernel'])
+        self.assertEquals(allocated, ['security-3', 'security-4', 'kernel'])
+
+        # Check suffixes still fit the field
+        base = 'x' * 40
+        Tag.objects.create(name=base, description='')
+        self.assertEquals(slugs.allocate_slugs(Tag, [base + 'yz']), ['x' * 38 + '-2'])
+
+    def test_saves_without_slugs(self):
+        # Check duplicate names and titles get unique slugs
+        names = [Category.objects.create(name='News', description='').slug for _ in range(2)]
+        self.assertEquals(names, ['news', 'news-2'])
+        self.assertEquals(Tag.objects.create(name='!!!', description='').slug, 'tag')
+        post = PostFactory(title='First Post', slug='first-post')
+        copy = Post.objects.create(title='First Post', text='Copy', pub_date=timezone.now(),
+                                   author=post.author, site=post.site)
+        self.assertEquals(copy.slug, 'first-post-2')
+
+    def test_save_retries_taken_slug(self):
+        TagFactory()
+
+        # Have the first allocation miss the row, as if another writer had
+        # inserted it after the query
+        taken_slugs = slugs.taken_slugs
+        calls = []
+        def racing_taken_slugs(model, bases):
+            calls.append(bases)
+            return set() if len(calls) == 1 else taken_slugs(model, bases)
+        slugs.taken_slugs = racing_taken_slugs
+        try:
+            tag = Tag.objects.create(name='Security', description='')
+        finally:
+            slugs.taken_slugs = taken_slugs
+
+        # Check the clash was retried with the next slug
+        self.assertEquals(len(calls), 2)
+        self.assertEquals(tag.slug, 'security-2')
+
+class ArchiveTest(TestCase):
+    def create_posts(self):
+        for i in range(3):
+            post = PostFactory(title='Post %d' % i, slug='post-%d' % i)
+            post.tags.add(TagFactory())
+
+    def test_export_posts(self):
+        self.create_posts()
+
+        # Export in chunks smaller than the archive
+        output = StringIO()
+        with self.assertNumQueries(4):
+            call_command('export_posts', chunk_size=2, stdout=output)
+
+        # Check every post came out with its relations
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEquals([record['slug'] for record in records], ['post-0', 'post-1', 'post-2'])
+        self.assertEquals(records[0]['category'], 'security')
+        self.assertEquals(records[0]['tags'], ['security'])
+        self.assertEquals(records[0]['author'], 'testuser')
+        self.assertEquals(records[0]['site'], 'example.com')
+
+    def test_archive_endpoint(self):
+        self.create_posts()
+
+        # Check the archive is for staff only
+        response = self.client.get('/archive/posts.jsonl')
+        self.assertEquals(response.status_code, 302)
+        User.objects.create_superuser('bobsmith', 'bob@example.com', 'password')
+        self.client.login(username='bobsmith', password='password')
+
+        # Check the posts are streamed
+        response = self.client.get('/archive/posts.ndjson')
+        self.assertTrue(response.streaming)
+        self.assertEquals(response['Content-Type'], 'application/x-ndjson')
+        lines = ''.join(response.streaming_content).splitlines()
+        self.assertEquals(json.loads(lines[-1])['title'], 'Post 2')
+
+class MultiSiteTest(TestCase):
+    def setUp(self):
+        pagecache.page_cache().clear()
+        feedcache.feed_cache().clear()
+
+    def test_sites_are_kept_apart(self):
+        # Create a post on each site
+        other = SiteFactory(name='other', domain='other.example.org')
+        first = PostFactory()
+        second = PostFactory(title='Second Post', slug='second-post', site=other)
+
+        # Check each host sees its own posts, from the cache the second time
+        for host, shown, hidden in [('example.com', first, second),
+                                    ('other.example.org:8000', second, first)]:
+            for i in range(2):
+                response = self.client.get('/', HTTP_HOST=host)
+                self.assertTrue(shown.title in response.content)
+                self.assertFalse(hidden.title in response.content)
+            response = self.client.get('/feeds/posts/', HTTP_HOST=host)
+            self.assertTrue(shown.title in response.content)
+            self.assertFalse(hidden.title in response.content)
+            response = self.client.get(hidden.get_absolute_url(), HTTP_HOST=host)
+            self.assertEquals(response.status_code, 404)
+
+        # Check unknown hosts get the default site
+        response = self.client.get('/', HTTP_HOST='unknown.example.net')
+        self.assertTrue(first.title in response.content)
+
+    def test_flatpages_are_per_site(self):
+        # Create a flat page on the other site only
+        other = SiteFactory(name='other', domain='other.example.org')
+        PostFactory()
+        page = FlatPageFactory()
+        page.sites.add(other)
+
+        # Check only the other site serves it and links it in the navigation
+        response = self.client.get(page.url, HTTP_HOST='other.example.org')
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('<a href="%s">%s</a>' % (page.url, page.title) in
+                        self.client.get('/', HTTP_HOST='other.example.org').content)
+        self.assertEquals(self.client.get(page.url).status_code, 404)
+        self.assertFalse('<a href="%s">' % page.url in self.client.get('/').content)
+
+        # Check a missing slash redirects on the other site
+        response = self.client.get(page.url.rstrip('/'), HTTP_HOST='other.example.org')
+        self.assertEquals(response.status_code, 301)
+
+class MonthArchiveTest(TestCase):
+    def setUp(self):
+        pagecache.page_cache().clear()
+
+    def month_counts(self):
+        return list(months.site_months(1).values_list('year', 'month', 'posts'))
+
+    def test_month_counts_follow_posts(self):
+        # Create posts in two months
+        march = timezone.now().replace(year=2014, month=3, day=10)
+        first = PostFactory(pub_date=march)
+        second = PostFactory(title='Second Post', slug='second-post', pub_date=march)
+        PostFactory(title='Third Post', slug='third-post',
+                    pub_date=march.replace(month=5))
+        self.assertEquals(self.month_counts(), [(2014, 5, 1), (2014, 3, 2)])
+
+        # Check moving a post moves its count
+        second.pub_date = march.replace(month=5)
+        second.save()
+        self.assertEquals(self.month_counts(), [(2014, 5, 2), (2014, 3, 1)])
+
+        # Check editing a post leaves the counts alone
+        second.title = 'Edited Post'
+        second.save()
+        self.assertEquals(self.month_counts(), [(2014, 5, 2), (2014, 3, 1)])
+
+        # Check deleting the last post of a month empties it
+        first.delete()
+        self.assertEquals(self.month_counts(), [(2014, 5, 2)])
+
+        # Check a rebuild agrees
+        self.assertEquals(months.rebuild_counts(), 1)
+        self.assertEquals(self.month_counts(), [(2014, 5, 2)])
+
+    def test_archive_pages(self):
+        # Create posts in two months
+        march = timezone.now().replace(year=2014, month=3, day=10)
+        PostFactory(pub_date=march)
+        PostFactory(title='Second Post', slug='second-post', pub_date=march.replace(month=5))
+
+        # Check the sidebar links the months
+        response = self.client.get('/category/security/')
+        self.assertTrue('<a href="/archive/2014/3/">2014-03</a> (1)' in response.content)
+
+        # Check the month listing shows only its posts
+        response = self.client.get('/archive/2014/3/')
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('First Post' in response.content)
+        self.assertFalse('Second Post' in response.content)
+        self.assertEquals(self.client.get('/archive/2014/13/').status_code, 404)
+
+        # Check the year lists its months
+        response = self.client.get('/archive/2014/')
+        self.assertTrue('<a href="/archive/2014/5/">2014-05</a> (1)' in response.content)
+        self.assertEquals(self.client.get('/archive/2015/').status_code, 404)
+
+        # Check a new month purges the cached pages
+        PostFactory(title='Third Post', slug='third-post', pub_date=march.replace(month=7))
+        response = self.client.get('/category/security/')
+        self.assertTrue('<a href="/archive/2014/7/">2014-07</a> (1)' in response.content)
+
+class PostCountTest(TestCase):
+    def counts(self, site_id=1):
+        return (dict(CategoryCount.objects.filter(site_id=site_id)
+                                          .values_list('category__slug', 'posts')),
+                dict(TagCount.objects.filter(site_id=site_id).values_list('tag__slug', 'posts')))
+
+    def counts_token(self):
+        return pagecache.page_cache().get(pagecache.dependency_key('post-counts'))
+
+    def test_counts_follow_posts(self):
+        # Create posts with a category and tags
+        security = TagFactory()
+        linux = TagFactory(name='linux', slug='linux')
+        first = PostFactory()
+        second = PostFactory(title='Second Post', slug='second-post')
+        first.tags.add(security, linux)
+        security.post_set.add(second)
+        self.assertEquals(self.counts(), ({'security': 2}, {'security': 2, 'linux': 1}))
+
+        # Check adding an existing link or removing a missing one does nothing
+        first.tags.add(security)
+        second.tags.remove(linux)
+        self.assertEquals(self.counts(), ({'security': 2}, {'security': 2, 'linux': 1}))
+
+        # Check moving a post between categories
+        category = CategoryFactory(name='linux', slug='linux', description='Linux')
+        second.category = category
+        second.save()
+        self.assertEquals(self.counts()[0], {'security': 1, 'linux': 1})
+
+        # Check saving a stale instance keeps the counter
+        security.name = 'infosec'
+        security.save()
+        self.assertEquals(self.counts()[1], {'security': 2, 'linux': 1})
+
+        # Check removing and clearing links from either side
+        security.post_set.remove(second)
+        first.tags.clear()
+        self.assertEquals(self.counts()[1], {'security': 0, 'linux': 0})
+
+        # Check deleting a post drops its counts
+        first.tags.add(security)
+        first.delete()
+        self.assertEquals(self.counts(), ({'security': 0, 'linux': 1},
+                                          {'security': 0, 'linux': 0}))
+
+    def test_reconcile_and_cloud(self):
+        # Create a tagged post and break its counters
+        post = PostFactory()
+        post.tags.add(TagFactory())
+        TagCount.objects.update(posts=5)
+        CategoryCount.objects.all().delete()
+
+        # Check the command puts them right
+        output = StringIO()
+        call_command('reconcile_post_counts', stdout=output)
+        self.assertTrue('Fixed 2 post counts' in output.getvalue())
+        self.assertEquals(self.counts(), ({'security': 1}, {'security': 1}))
+
+        # Check the listings show the counts
+        response = self.client.get('/')
+        self.assertTrue('<a href="/category/security/">security</a> (1)' in response.content)
+        self.assertTrue('title="1 posts">security</a>' in response.content)
+
+    def test_counts_are_per_site(self):
+        # Create tagged posts in the same category on two sites
+        security = TagFactory()
+        first = PostFactory()
+        first.tags.add(security)
+        other = SiteFactory(name='other', domain='other.example.org')
+        second = PostFactory(title='Second Post', slug='second-post', site=other)
+        second.tags.add(security)
+        self.assertEquals(self.counts(), ({'security': 1}, {'security': 1}))
+        self.assertEquals(self.counts(other.id), ({'security': 1}, {'security': 1}))
+
+        # Check moving a post to the other site moves its counts
+        first.site = other
+        first.save()
+        self.assertEquals(self.counts(), ({'security': 0}, {'security': 0}))
+        self.assertEquals(self.counts(other.id), ({'security': 2}, {'security': 2}))
+
+        # Check each site lists only its own counts
+        response = self.client.get('/')
+        self.assertFalse('/category/security/' in response.content)
+        self.assertFalse('/tag/security/' in response.content)
+        response = self.client.get('/', HTTP_HOST='other.example.org')
+        self.assertTrue('<a href="/category/security/">security</a> (2)' in response.content)
+        self.assertTrue('title="2 posts">security</a>' in response.content)
+        response = self.client.get('/api/tags/?fields=slug,post_count')
+        self.assertEquals(json.loads(response.content)['results'],
+                          [{'slug': 'security', 'post_count': 0}])
+
+    def test_unchanged_save_keeps_counts(self):
+        post = PostFactory()
+        post.tags.add(TagFactory())
+        self.client.get('/')
+        token = self.counts_token()
+        self.assertTrue(token is not None)
+
+        # Check saving a post without moving it leaves the counted pages
+        post.title = 'Edited Post'
+        post.save()
+        Post.objects.only('title').get(id=post.id).save()
+        self.assertEquals(self.counts_token(), token)
+
+        # Check moving it drops them
+        post.category = None
+        post.save()
+        self.assertNotEquals(self.counts_token(), token)
+
+    def test_admin_save_moves_tag_counts(self):
+        # Create a post tagged twice, and log in
+        post = PostFactory()
+        post.tags.add(TagFactory(), TagFactory(name='linux', slug='linux'))
+        User.objects.create_superuser('bobsmith', 'bob@example.com', 'password')
+        self.client.login(username='bobsmith', password='password')
+
+        # Check swapping a tag in the admin moves just its count
+        django = TagFactory(name='django', slug='django')
+        response = self.client.post('/admin/blogengine/post/%d/' % post.id, {
+            'title': post.title,
+            'text': post.text,
+            'slug': post.slug,
+            'pub_date_0': '2015-01-01',
+            'pub_date_1': '12:00:05',
+            'site': '1',
+            'category': str(post.category_id),
+            'tags': [str(post.tags.get(slug='security').id), str(django.id)],
+        })
+        self.assertEquals(response.status_code, 302)
+        self.assertEquals(self.counts()[1], {'security': 1, 'linux': 0, 'django': 1})
+
+class RelatedPostsTest(TestCase):
+    def setUp(self):
+        pagecache.page_cache().clear()
+
+    def related_slugs(self, post):
+        return [other.slug for other in related.related_posts(post)]
+
+    def create_posts(self):
+        kernel = TagFactory(name='kernel', slug='kernel')
+        first = PostFactory(title='Kernel patch', slug='kernel-patch',
+                            text='A scheduler patch for the kernel')
+        second = PostFactory(title='Kernel release', slug='kernel-release',
+                             text='The kernel release brings a new scheduler')
+        third = PostFactory(title='Django tips', slug='django-tips',
+                            text='Template caching in Django')
+        first.tags.add(kernel)
+        second.tags.add(kernel)
+        return first, second, third
+
+    def test_related_posts_follow_saves(self):
+        first, second, third = self.create_posts()
+
+        # Check each post was queued once, however many signals it sent
+        self.assertEquals(sorted(RelatedUpdate.objects.values_list('post_id', flat=True)),
+                          [first.id, second.id, third.id])
+        self.assertEquals(self.related_slugs(first), [])
+        output = StringIO()
+        call_command('update_related_posts', once=True, stdout=output)
+        self.assertTrue('Updated the related posts of 3 posts' in output.getvalue())
+        self.assertEquals(RelatedUpdate.objects.count(), 0)
+
+        # Check the posts sharing tags and words are related both ways
+        self.assertEquals(self.related_slugs(first), ['kernel-release'])
+        self.assertEquals(self.related_slugs(second), ['kernel-patch'])
+        self.assertEquals(self.related_slugs(third), [])
+
+        # Check an edited post joins the lists it now belongs on
+        third.title = 'Kernel scheduler tips'
+        third.save()
+        self.assertEquals(related.update_stale(), 1)
+        self.assertEquals(self.related_slugs(third)[0], 'kernel-patch')
+        self.assertTrue('django-tips' in self.related_slugs(first))
+
+        # Check a rebuild agrees
+        output = StringIO()
+        call_command('rebuild_related_posts', stdout=output)
+        self.assertTrue('Related 3 posts of example.com' in output.getvalue())
+        self.assertEquals(self.related_slugs(third)[0], 'kernel-patch')
+        self.assertEquals(self.related_slugs(second)[0], 'kernel-patch')
+
+        # Check deleting a post takes it off the lists
+        first.delete()
+        self.assertFalse('kernel-patch' in self.related_slugs(second))
+
+    def test_clearing_tag_queues_its_posts(self):
+        first, second, third = self.create_posts()
+        related.update_stale()
+
+        # Check clearing a tag's posts queues every post it was on
+        Tag.objects.get(slug='kernel').post_set.clear()
+        self.assertEquals(sorted(RelatedUpdate.objects.values_list('post_id', flat=True)),
+                          [first.id, second.id])
+
+    def test_related_posts_on_post_page(self):
+        first, second, third = self.create_posts()
+        related.update_stale()
+
+        # Check the post page links its related posts
+        response = self.client.get(first.get_absolute_url())
+        self.assertTrue('<a href="%s">Kernel release</a>' % second.get_absolute_url()
+                        in response.content)
+
+        # Check renaming a related post purges the cached page
+        second.title = 'Kernel update'
+        second.save()
+        response = self.client.get(first.get_absolute_url())
+        self.assertTrue('Kernel update' in response.content)
+
+class SitemapTest(TestCase):
+    def setUp(self):
+        pagecache.page_cache().clear()
+        self.limit = sitemaps.PostSitemap.limit
+        sitemaps.PostSitemap.limit = 2
+
+    def tearDown(self):
+        sitemaps.PostSitemap.limit = self.limit
+
+    def test_sitemap_index(self):
+        # Create three posts, filling two chunks, and a tagged one
+        posts = [PostFactory(title='Post %d' % n, slug='post-%d' % n) for n in range(3)]
+        posts[0].tags.add(TagFactory())
+        FlatPageFactory().sites.add(Site.objects.get_current())
+
+        # Check the index lists every section and chunk
+        response = self.client.get('/sitemap.xml')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Content-Type'], 'application/xml')
+        for section in ['categories', 'tags', 'pages', 'posts']:
+            self.assertTrue('<loc>http://example.com/sitemap-%s.xml</loc>' % section
+                            in response.content)
+        self.assertTrue('<loc>http://example.com/sitemap-posts-2.xml</loc>' in response.content)
+        self.assertFalse('sitemap-posts-3.xml' in response.content)
+
+        # Check a new post starting a chunk shows up in the index
+        PostFactory(title='Post 3', slug='post-3')
+        PostFactory(title='Post 4', slug='post-4')
+        response = self.client.get('/sitemap.xml')
+        self.assertTrue('sitemap-posts-3.xml' in response.content)
+
+        # Check a chunk past the last is not found
+        response = self.client.get('/sitemap-posts-4.xml')
+        self.assertEquals(response.status_code, 404)
+
+    def test_sitemaps_are_per_site(self):
+        # Create posts on another site, then one on this site
+        other = SiteFactory(name='other', domain='other.example.org')
+        for n in range(4):
+            PostFactory(title='Post %d' % n, slug='post-%d' % n, site=other,
+                        category=CategoryFactory(name='other', slug='other', description='Other'))
+        post = PostFactory()
+
+        # Check this site's posts make a single chunk of its own
+        response = self.client.get('/sitemap.xml')
+        self.assertTrue('sitemap-posts.xml' in response.content)
+        self.assertFalse('sitemap-posts-2.xml' in response.content)
+        response = self.client.get('/sitemap-posts.xml')
+        self.assertTrue(post.get_absolute_url() in response.content)
+        self.assertFalse('post-0' in response.content)
+
+        # Check only the categories with posts on the site are listed
+        response = self.client.get('/sitemap-categories.xml')
+        self.assertTrue('/category/security/' in response.content)
+        self.assertFalse('/category/other/' in response.content)
+        response = self.client.get('/sitemap-categories.xml', HTTP_HOST='other.example.org')
+        self.assertFalse('/category/security/' in response.content)
+        self.assertTrue('/category/other/' in response.content)
+
+    def test_sitemap_sections(self):
+        post = PostFactory()
+        post.tags.add(TagFactory())
+        PostFactory(title='Second Post', slug='second-post')
+        flatpage = FlatPageFactory()
+        flatpage.sites.add(Site.objects.get_current())
+
+        # Check each section lists its URLs
+        response = self.client.get('/sitemap-posts.xml')
+        self.assertTrue('<loc>http://example.com%s</loc>' % post.get_absolute_url()
+                        in response.content)
+        for section, obj in [('categories', post.category), ('tags', post.tags.get()),
+                             ('pages', flatpage)]:
+            response = self.client.get('/sitemap-%s.xml' % section)
+            self.assertTrue('<loc>http://example.com%s</loc>' % obj.get_absolute_url()
+                            in response.content)
+
+        # Check a chunk is served from the cache
+        with self.assertNumQueries(0):
+            self.client.get('/sitemap-posts.xml')
+
+        # Check a post starting the next chunk leaves it cached
+        other = PostFactory(title='Other Post', slug='other-post')
+        with self.assertNumQueries(0):
+            self.client.get('/sitemap-posts.xml')
+
+        # Check saving one of its posts purges it
+        post.slug = 'edited-post'
+        post.save()
+        response = self.client.get('/sitemap-posts.xml')
+        self.assertTrue(post.get_absolute_url() in response.content)
+
+        # Check deleting it takes it off and moves the later posts up
+        self.assertTrue(other.get_absolute_url() in
+                        self.client.get('/sitemap-posts-2.xml').content)
+        post.delete()
+        response = self.client.get('/sitemap-posts.xml')
+        self.assertFalse(post.get_absolute_url() in response.content)
+        self.assertTrue(other.get_absolute_url() in response.content)
+        self.assertEquals(self.client.get('/sitemap-posts-2.xml').status_code, 404)
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        pagecache.page_cache().clear()
+        metrics.registry.reset()
+
+    @override_settings(BLOGENGINE_SERVER_TIMING=True)
+    def test_server_timing(self):
+        post = PostFactory()
+
+        # Check a rendered page reports its queries, templates and Markdown
+        response = self.client.get(post.get_absolute_url())
+        timing = response['Server-Timing']
+        for name in ['total;dur=', 'db;dur=', 'template;dur=', 'markdown;dur=']:
+            self.assertTrue(name in timing)
+        self.assertTrue('page-cache;desc="0/1 hits"' in timing)
+        self.assertFalse('desc="0 queries"' in timing)
+
+        # Check the cached page reports the hit and no queries
+        timing = self.client.get(post.get_absolute_url())['Server-Timing']
+        self.assertTrue('db;dur=0.0;desc="0 queries"' in timing)
+        self.assertTrue('page-cache;desc="1/1 hits"' in timing)
+
+        # Check a view that raises gives the connection its cursors back
+        self.assertEquals(self.client.get('/2014/1/missing/').status_code, 404)
+        self.assertFalse('cursor' in connection.__dict__)
+
+    @override_settings(BLOGENGINE_SERVER_TIMING=False)
+    def test_metrics_report(self):
+        post = PostFactory()
+        self.client.get(post.get_absolute_url())
+        response = self.client.get(post.get_absolute_url())
+        self.assertFalse(response.has_header('Server-Timing'))
+
+        # Check the report is for staff only
+        self.assertEquals(self.client.get('/metrics/').status_code, 302)
+        User.objects.create_superuser('staff', 'staff@example.com', 'password')
+        self.client.login(username='staff', password='password')
+
+        # Check the requests so far were aggregated
+        report = json.loads(self.client.get('/metrics/').content)
+        self.assertEquals(report['requests'], 3)
+        self.assertEquals(report['histograms']['total']['count'], 3)
+        self.assertEquals(report['caches']['page'],
+                          {'hits': 1, 'misses': 1, 'hit_ratio': 0.5})
+        self.assertTrue('render_cache' in report)
+
+class ApiTest(TestCase):
+    def setUp(self):
+        pagecache.page_cache().clear()
+
+    def get_json(self, path, **extra):
+        response = self.client.get(path, **extra)
+        return response, json.loads(response.content) if response.content else None
+
+    def test_post_list(self):
+        # Create three posts, the first in another category
+        first = PostFactory(pub_date=timezone.now() - timedelta(days=2),
+                            category=CategoryFactory(name='django', slug='django'))
+        PostFactory(title='Second Post', slug='second-post',
+                    pub_date=timezone.now() - timedelta(days=1))
+        third = PostFactory(title='Third Post', slug='third-post')
+        third.tags.add(TagFactory())
+
+        # Check the requested fields are all that is read and returned
+        with CaptureQueriesContext(connection) as queries:
+            response, data = self.get_json('/api/posts/?fields=id,title,tags&limit=2')
+        self.assertFalse(any('"text"' in query['sql'] or '"rendered_text"' in query['sql']
+                             for query in queries))
+        self.assertEquals(data['results'][0],
+                          {'id': third.id, 'title': 'Third Post',
+                           'tags': [{'name': 'security', 'slug': 'security'}]})
+        self.assertEquals(data['previous'], None)
+
+        # Check the cursor leads to the last post
+        response, data = self.get_json(data['next'].replace('http://example.com', ''))
+        self.assertEquals([post['id'] for post in data['results']], [first.id])
+        self.assertEquals(data['next'], None)
+
+        # Check posts can be filtered by category
+        response, data = self.get_json('/api/posts/?category=django&fields=slug,html')
+        self.assertEquals(data['results'], [{'slug': 'my-first-post',
+                                             'html': '<p>My first blog post</p>\n'}])
+
+        # Check unknown fields and bad cursors are refused
+        self.assertEquals(self.client.get('/api/posts/?fields=secret').status_code, 400)
+        self.assertEquals(self.client.get('/api/posts/?after=nonsense').status_code, 400)
+        for url in ['/api/posts/?after=20260101000000000000-99999999999999999999999',
+                    '/api/tags/?after=99999999999999999999999']:
+            response, data = self.get_json(url)
+            self.assertEquals(response.status_code, 400)
+            self.assertEquals(data['error'], 'Invalid page cursor')
+
+    def test_post_detail_etags(self):
+        post = PostFactory()
+
+        # Check a repeat poll with the ETag is not modified
+        response, data = self.get_json('/api/posts/%d/' % post.id)
+        self.assertEquals(data['url'], 'http://example.com%s' % post.get_absolute_url())
+        self.assertEquals(data['category'], {'name': 'security', 'slug': 'security'})
+        etag = response['ETag']
+        response, data = self.get_json('/api/posts/%d/' % post.id, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+
+        # Check editing the post changes its ETag
+        post.title = 'Edited Post'
+        post.save()
+        response, data = self.get_json('/api/posts/%d/' % post.id, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(data['title'], 'Edited Post')
+        self.assertNotEquals(response['ETag'], etag)
+
+        # Check a missing post is a JSON 404
+        response, data = self.get_json('/api/posts/%d/' % (post.id + 1))
+        self.assertEquals(response.status_code, 404)
+        self.assertTrue('error' in data)
+
+    def test_category_and_tag_lists(self):
+        PostFactory().tags.add(TagFactory())
+
+        # Check the lists page by id
+        response, data = self.get_json('/api/tags/?fields=slug,post_count')
+        self.assertEquals(data, {'results': [{'slug': 'security', 'post_count': 1}],
+                                 'next': None})
+        response, data = self.get_json('/api/categories/?fields=slug&limit=1')
+        self.assertEquals(data['next'], None)
+
+        # Check a new category purges the cached list
+        CategoryFactory(name='django', slug='django')
+        response, data = self.get_json('/api/categories/?fields=slug&limit=1')
+        self.assertEquals(data['results'], [{'slug': 'security'}])
+        response, data = self.get_json(data['next'].replace('http://example.com', ''))
+        self.assertEquals(data['results'], [{'slug': 'django'}])
+
+@override_settings(BLOGENGINE_INGEST_TOKENS={'secret': 'newsdesk'})
+class IngestTest(TestCase):
+    def setUp(self):
+        pagecache.page_cache().clear()
+        self.author = User.objects.create_user('newsdesk', 'news@example.com', 'password')
+
+    def submit(self, posts, token='secret'):
+        response = self.client.post('/api/ingest/', json.dumps(posts),
+                                    content_type='application/json',
+                                    HTTP_AUTHORIZATION='Token %s' % token)
+        return response, json.loads(response.content)
+
+    def test_ingest_queue(self):
+        # Check submissions need a source token and valid posts
+        response, data = self.submit({'title': 'Breaking', 'text': 'News'}, token='wrong')
+        self.assertEquals(response.status_code, 401)
+        response, data = self.submit([{'title': 'Breaking'}, {'title': 'Kernel', 'text': 'x',
+                                                             'author': 'admin'}])
+        self.assertEquals(data['errors'], {'0': 'text is required',
+                                           '1': 'Unknown fields: author'})
+        self.assertFalse(IngestJob.objects.exists())
+
+        # Submit two posts and one whose slug is taken
+        PostFactory(slug='taken')
+        response, data = self.submit([
+            {'title': 'Kernel release', 'text': 'A *new* kernel', 'tags': ['kernel', 'linux'],
+             'category': 'News'},
+            {'title': 'Patch day', 'text': 'Patches', 'pub_date': '2014-03-10T12:00:00'},
+            {'title': 'Taken', 'text': 'Already there', 'slug': 'taken'},
+        ])
+        self.assertEquals(response.status_code, 202)
+        self.assertEquals([job['status'] for job in data['jobs']], ['pending'] * 3)
+        self.assertFalse(Post.objects.filter(slug='kernel-release').exists())
+
+        # Drain the queue
+        output = StringIO()
+        call_command('process_ingest_queue', once=True, stdout=output)
+        self.assertTrue('Imported 2 of 3 jobs' in output.getvalue())
+
+        # Check the posts were imported by the source with their tags
+        post = Post.objects.get(slug='kernel-release')
+        self.assertEquals(post.author, self.author)
+        self.assertEquals(post.rendered_text, '<p>A <em>new</em> kernel</p>\n')
+        self.assertEquals(sorted(post.tags.values_list('slug', flat=True)), ['kernel', 'linux'])
+        self.assertEquals(CategoryCount.objects.get(category=post.category).posts, 1)
+        self.assertTrue('Patch day' in self.client.get('/archive/2014/3/').content)
+
+        # Check each job reports its outcome to its source
+        response = self.client.get(data['jobs'][0]['url'], HTTP_AUTHORIZATION='Token secret')
+        job = json.loads(response.content)
+        self.assertEquals(job['status'], 'done')
+        self.assertEquals(job['post'], 'http://example.com/api/posts/%d/' % post.id)
+        response = self.client.get(data['jobs'][2]['url'], HTTP_AUTHORIZATION='Token secret')
+        job = json.loads(response.content)
+        self.assertEquals(job['status'], 'failed')
+        self.assertTrue('taken' in job['error'])
+
+    def test_workers_claim_separate_jobs(self):
+        ingest.enqueue([{'title': 'Post %d' % n, 'text': 'News'} for n in range(3)],
+                       self.author)
+
+        # Check two workers never claim the same job
+        first = ingest.claim(2, 'first')
+        second = ingest.claim(2, 'second')
+        self.assertEquals(len(first), 2)
+        self.assertEquals(len(second), 1)
+        self.assertFalse(set(first) & set(second))
+
+        # Check stalled jobs are put back, then given up on
+        self.assertEquals(ingest.requeue_stale(timeout=0), 3)
+        IngestJob.objects.update(attempts=ingest.MAX_ATTEMPTS)
+        ingest.claim(3, 'third')
+        self.assertEquals(ingest.requeue_stale(timeout=0), 0)
+        self.assertEquals(IngestJob.objects.filter(status=IngestJob.FAILED).count(), 3)
+
+class ExplainListingsTest(TestCase):
+    def test_explain_seeded_listings(self):
+        # Seed posts and explain the listing queries
+        output = StringIO()
+        call_command('explain_listings', seed=30, runs=1, stdout=output)
+
+        # Check the posts and their tags were created
+        self.assertEquals(Post.objects.count(), 30)
+        self.assertEquals(Post.tags.through.objects.count(), 90)
+
+        # Check every query shape was reported
+        for name in ['index', 'index, deep cursor', 'category', 'site', 'tag', 'detail']:
+            self.assertTrue('\n%s: median' % name in output.getvalue())
+
+class BenchmarkViewsTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_benchmark_seeded_views(self):
+        # Seed posts here, as the test database can't be swapped for a
+        # throwaway one
+        seeding.seed_posts(30)
+        counters.reconcile()
+        months.rebuild_counts()
+        pagecache.page_cache().set('untouched', 1)
+
+        # Measure every view, then again against the results
+        first = os.path.join(self.directory, 'first.json')
+        call_command('benchmark_views', existing_database=True, requests=3, warmup=1,
+                     output=first, stderr=StringIO())
+        errors = StringIO()
+        call_command('benchmark_views', existing_database=True, requests=3, warmup=1,
+                     compare=first, stdout=StringIO(), stderr=errors)
+
+        # Check the dataset and every view and mode were reported
+        with open(first) as results_file:
+            results = json.load(results_file)
+        self.assertEquals(results['dataset']['posts'], 30)
+        self.assertEquals(sorted(results['views']), ['category', 'category feed', 'detail',
+                                                     'feed', 'index', 'tag'])
+        for view in results['views'].values():
+            self.assertEquals(view['cached']['requests'], 3)
+            self.assertTrue(view['uncached']['queries'] > view['cached']['queries'])
+            self.assertTrue(view['uncached']['p50_ms'] <= view['uncached']['p99_ms'])
+
+        # Check the comparison covered them too
+        self.assertTrue('index, uncached: p50' in errors.getvalue())
+
+        # Check the site's own caches were left alone
+        self.assertEquals(pagecache.page_cache().get('untouched'), 1)
+
+    def test_existing_database_is_not_seeded(self):
+        with self.assertRaises(CommandError):
+            call_command('benchmark_views', existing_database=True, seed=10)
+        self.assertEquals(Post.objects.count(), 0)
+
+class ExcerptTest(TestCase):
+    def setUp(self):
+        pagecache.page_cache().clear()
+        feedcache.feed_cache().clear()
+
+    def long_post(self):
+        return PostFactory(text='A *long* post ' + ' '.join(['word'] * 100))
+
+    def test_excerpt_is_stored(self):
+        # Check a long post keeps its first words with their markup
+        post = self.long_post()
+        excerpt = Post.objects.get(id=post.id).excerpt
+        self.assertTrue(excerpt.startswith('<p>A <em>long</em> post word'))
+        self.assertTrue(excerpt.endswith(u'word \u2026</p>'))
+        # Sixty words and the ellipsis
+        self.assertEquals(len(excerpt.split()), 61)
+
+        # Check a short post is kept whole
+        short = PostFactory(title='Second Post', slug='second-post', text='A *short* post')
+        self.assertEquals(short.get_excerpt(), short.rendered_text)
+
+        # Check excerpts from an older renderer are made again
+        Post.objects.filter(id=short.id).update(renderer_version=RENDERER_VERSION - 1,
+                                                excerpt='stale')
+        self.assertEquals(Post.objects.get(id=short.id).get_excerpt(),
+                          '<p>A <em>short</em> post</p>\n')
+
+    def test_listing_shows_excerpts(self):
+        post = self.long_post()
+
+        # Check the index shows the excerpt without reading the post bodies
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/')
+        self.assertFalse(any('"text"' in query['sql'] or '"rendered_text"' in query['sql']
+                             for query in queries))
+        content = response.content.decode('utf-8')
+        self.assertTrue(post.excerpt in content)
+        self.assertFalse(post.rendered_text in content)
+        self.assertTrue('Read more' in content)
+
+    def test_stale_excerpts_load_text_once(self):
+        # Create posts left by an older renderer
+        for n in range(3):
+            PostFactory(title='Post %d' % n, slug='post-%d' % n, text='Post *%d*' % n)
+        Post.objects.update(renderer_version=RENDERER_VERSION - 1, excerpt='stale')
+
+        # Check their texts are read with a single query to make excerpts
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/')
+        self.assertEquals(len([query for query in queries if '"text"' in query['sql']]), 1)
+        self.assertTrue('<p>Post <em>2</em></p>' in response.content)
+        self.assertFalse('stale' in response.content)
+
+    def test_rerender_backfills_excerpts(self):
+        post = self.long_post()
+
+        # Check a text changed by update() keeps its excerpt until rendered
+        Post.objects.filter(id=post.id).update(text='A *new* text')
+        self.assertTrue('long' in Post.objects.get(id=post.id).get_excerpt())
+        output = StringIO()
+        call_command('rerender_posts', stdout=output)
+        self.assertTrue('Rendered 1 posts again' in output.getvalue())
+        post = Post.objects.get(id=post.id)
+        self.assertEquals(post.excerpt, '<p>A <em>new</em> text</p>\n')
+        self.assertEquals(post.rendered_text, post.excerpt)
+
+        # Check current posts are left alone
+        output = StringIO()
+        call_command('rerender_posts', stdout=output)
+        self.assertTrue('Rendered 0 posts again' in output.getvalue())
+
+    def test_rerender_skips_post_signals(self):
+        # Create posts left by an older renderer, with the index cached
+        for n in range(3):
+            PostFactory(title='Post %d' % n, slug='post-%d' % n, text='Post *%d*' % n)
+        Post.objects.update(renderer_version=RENDERER_VERSION - 1, excerpt='stale')
+        RelatedUpdate.objects.all().delete()
+        feedcache.feed_cache().clear()
+        self.client.get('/')
+
+        # Check they're written without saves, in batches
+        saved = []
+        receiver = lambda sender, instance, **kwargs: saved.append(instance.id)
+        post_save.connect(receiver, sender=Post, weak=False)
+        self.addCleanup(post_save.disconnect, receiver, sender=Post)
+        self.assertEquals(rerendering.rerender_posts(batch_size=2), 3)
+        self.assertEquals(saved, [])
+
+        # Check the pages and feed show them, and their unchanged texts
+        # weren't queued for related posts
+        self.assertFalse('stale' in self.client.get('/').content)
+        feed = feedcache.feed_cache().get(feedcache.feed_key(1))
+        self.assertTrue('Post &lt;em&gt;2&lt;/em&gt;' in feed[0])
+        self.assertEquals(RelatedUpdate.objects.count(), 0)
+
+    @override_settings(BLOGENGINE_LIST_FULL_TEXT=True)
+    def test_listing_shows_full_text(self):
+        # Check the whole post is shown when asked for
+        post = self.long_post()
+        response = self.client.get('/')
+        self.assertTrue(post.rendered_text in response.content)
+        self.assertFalse('Read more' in response.content)
+
+    def test_feeds_show_excerpts(self):
+        post = self.long_post()
+        for url in ['/feeds/posts/', '/feeds/posts/category/security/']:
+            feed = feedparser.parse(self.client.get(url).content)
+            self.assertTrue(feed.entries[0].description.endswith(u'word \u2026</p>'))
+
+        # Check the feeds carry whole posts when asked for
+        feedcache.feed_cache().clear()
+        with self.settings(BLOGENGINE_FEED_FULL_TEXT=True):
+            feed = feedparser.parse(self.client.get('/feeds/posts/').content)
+        self.assertEquals(feed.entries[0].description, post.rendered_text.strip())
+
+class ViewCountTest(TestCase):
+    def setUp(self):
+        pagecache.page_cache().clear()
+        viewcounts.buffer.clear()
+
+    def test_views_are_buffered(self):
+        post = PostFactory()
+        other = PostFactory(title='Second Post', slug='second-post')
+
+        # Check views, cached ones too, wait in the buffer
+        for _ in range(3):
+            self.assertEquals(self.client.get(post.get_absolute_url()).status_code, 200)
+        self.client.get('/2015/1/no-such-post/')
+        self.assertEquals(len(viewcounts.buffer), 3)
+        self.assertEquals(PostViewCount.objects.count(), 0)
+
+        # Check a flush writes them
+        self.assertEquals(viewcounts.buffer.flush(), 3)
+        self.assertEquals(PostViewCount.objects.get(post=post).views, 3)
+        self.assertEquals(len(viewcounts.buffer), 0)
+
+        # Check existing rows are moved with a single UPDATE and new ones inserted
+        for _ in range(2):
+            self.client.get(post.get_absolute_url())
+        self.client.get(other.get_absolute_url())
+        with CaptureQueriesContext(connection) as queries:
+            viewcounts.buffer.flush()
+        updates = [query for query in queries if 'UPDATE' in query['sql']]
+        self.assertEquals(len(updates), 1)
+        self.assertEquals(PostViewCount.objects.get(post=post).views, 5)
+        self.assertEquals(PostViewCount.objects.get(post=other).views, 1)
+
+        # Check views are kept by post, whatever its slug
+        post.slug = 'renamed-post'
+        post.save()
+        self.client.get(post.get_absolute_url())
+        viewcounts.buffer.flush()
+        self.assertEquals(PostViewCount.objects.get(post=post).views, 6)
+
+    def recording_buffer(self):
+        # Writes to a list, as the test database is out of the thread's reach
+        class RecordingBuffer(viewcounts.ViewBuffer):
+            def write(self, counts):
+                self.written.append(dict(counts))
+                self.flushed.set()
+                return sum(counts.values())
+        views = RecordingBuffer()
+        views.written = []
+        views.flushed = threading.Event()
+        self.addCleanup(views.stop)
+        return views
+
+    @override_settings(BLOGENGINE_VIEW_BUFFER_SIZE=2)
+    def test_full_buffer_is_flushed(self):
+        # Check the thread writes a full buffer without waiting for the interval
+        views = self.recording_buffer()
+        views.record(1)
+        self.assertFalse(views.flushed.wait(0.2))
+        views.record(1)
+        self.assertTrue(views.flushed.wait(5))
+        self.assertEquals(views.written, [{(1, viewcounts.today()): 2}])
+        self.assertEquals(len(views), 0)
+
+    @override_settings(BLOGENGINE_VIEW_FLUSH_INTERVAL=0.1)
+    def test_idle_buffer_is_flushed(self):
+        # Check views are written once the interval passes without more
+        views = self.recording_buffer()
+        views.record(1)
+        self.assertTrue(views.flushed.wait(5))
+        self.assertEquals(views.written, [{(1, viewcounts.today()): 1}])
+
+    def test_most_read(self):
+        # Read one post most lately, the other most over the month
+        today = viewcounts.today()
+        post = PostFactory()
+        other = PostFactory(title='Second Post', slug='second-post')
+        PostViewCount.objects.create(post=post, day=today, views=10)
+        PostViewCount.objects.create(post=other, day=today, views=3)
+        PostViewCount.objects.create(post=other, day=today - timedelta(days=10), views=20)
+
+        # Check the listing sums the last days
+        self.assertEquals([(ranked.title, ranked.recent_views) for ranked in
+                           viewcounts.most_read(post.site, 7, 10)],
+                          [('First Post', 10), ('Second Post', 3)])
+        response = self.client.get('/most-read/30/')
+        self.assertTrue(response.content.index('Second Post') <
+                        response.content.index('First Post'))
+        self.assertTrue('(23 views)' in response.content)
+        self.assertEquals(self.client.get('/most-read/0/').status_code, 404)
+
+        # Check writing views refreshes the cached listing
+        response = self.client.get('/most-read/')
+        self.assertTrue('(10 views)' in response.content)
+        self.client.get(post.get_absolute_url())
+        viewcounts.buffer.flush()
+        response = self.client.get('/most-read/')
+        self.assertTrue('(11 views)' in response.content)
+
 class BaseAcceptanceTest(LiveServerTestCase):
     def set_up(self):
         self.client = Client()
 
+    def setUp(self):
+        cache.clear()
+
 class AdminTest(BaseAcceptanceTest):
     fixtures = ['users.json']
 
@@ -707,6 +2149,85 @@ class PostViewTest(BaseAcceptanceTest):
         # Check the link is marked up properly
         self.assertTrue('<a href="http://127.0.0.1:8000/">my first blog post</a>' in response.content)
 
+    def count_listing_queries(self, url, number_of_posts):
+        # Create posts with a category and a tag each
+        tag = TagFactory()
+        for i in range(number_of_posts):
+            post = PostFactory(title='Post %d' % i, slug='post-%d' % i)
+            post.tags.add(tag)
+
+        # Fetch the listing once the slug is cached
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        Post.objects.all().delete()
+        return len(queries)
+
+    def test_listing_query_count_is_constant(self):
+        for url in ['/', '/category/security/', '/tag/security/']:
+            one_post = self.count_listing_queries(url, 1)
+            ten_posts = self.count_listing_queries(url, 10)
+            self.assertEquals(one_post, ten_posts)
+
+    def create_posts(self, number_of_posts):
+        # Pairs of posts share a publication date
+        now = timezone.now()
+        for i in range(number_of_posts):
+            PostFactory(title='Post %d' % i, slug='post-%d' % i,
+                        pub_date=now - timedelta(hours=i // 2))
+
+    def walk_pages(self, url):
+        titles = []
+        while url:
+            response = self.client.get(url)
+            self.assertEquals(response.status_code, 200)
+            titles.extend(post.title for post in response.context['object_list'])
+            url = response.context['next_page_url']
+        return titles, response
+
+    @override_settings(BLOGENGINE_PAGINATION='cursor')
+    def test_cursor_pagination(self):
+        self.create_posts(25)
+        expected = list(Post.objects.order_by('-pub_date', '-id')
+                                    .values_list('title', flat=True))
+
+        # Follow the next links through the index and category
+        for url in ['/', '/category/security/']:
+            titles, response = self.walk_pages(url)
+            self.assertEquals(titles, expected)
+            self.assertTrue('?after=' not in response.content)
+
+        # Step back from the last category page
+        response = self.client.get(response.context['previous_page_url'])
+        titles = [post.title for post in response.context['object_list']]
+        self.assertEquals(titles, expected[10:20])
+
+        # Check numbered pages still work
+        response = self.client.get('/2/')
+        titles = [post.title for post in response.context['object_list']]
+        self.assertEquals(titles, expected[20:])
+
+        # Check a mangled cursor is a 404, as is an id too large to query
+        response = self.client.get('/?after=nonsense')
+        self.assertEquals(response.status_code, 404)
+        for key in ['after', 'before']:
+            response = self.client.get('/?%s=20260101000000000000-99999999999999999999999' % key)
+            self.assertEquals(response.status_code, 404)
+
+    @override_settings(BLOGENGINE_PAGINATION='offset')
+    def test_offset_pagination(self):
+        self.create_posts(25)
+        expected = list(Post.objects.order_by('-pub_date', '-id')
+                                    .values_list('title', flat=True))
+
+        # Follow the numbered links
+        titles, response = self.walk_pages('/tag/security/')
+        self.assertEquals(len(titles), 0)
+        titles, response = self.walk_pages('/category/security/')
+        self.assertEquals(titles, expected)
+        self.assertEquals(response.context['previous_page_url'], '/category/security/2/')
+
     def test_nonexistent_category_page(self):
         category_url = '/category/blah/'
         response = self.client.get(category_url)
@@ -797,6 +2318,64 @@ class FeedTest(BaseAcceptanceTest):
         # Check second post is not in feed
         self.assertTrue('This is my <em>second</em> post' not in response.content)
 
+    @override_settings(BLOGENGINE_FEED_ITEMS=2)
+    def test_feed_is_bounded(self):
+        # Create more posts than the feed holds
+        for i in range(3):
+            PostFactory(title='Post %d' % i, slug='post-%d' % i)
+
+        # Check both feeds are capped
+        for url in ['/feeds/posts/', '/feeds/posts/category/security/']:
+            response = self.client.get(url)
+            feed = feedparser.parse(response.content)
+            self.assertEquals(len(feed.entries), 2)
+
+    def test_unchanged_feed_is_not_modified(self):
+        # Create post
+        PostFactory()
+
+        # Fetch feed
+        response = self.client.get('/feeds/posts/')
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(response.has_header('ETag'))
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        # Poll again with the validators
+        response = self.client.get('/feeds/posts/',
+            HTTP_IF_NONE_MATCH=response['ETag'],
+            HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(response.content, '')
+
+        # Check a newer post changes the validators
+        etag = response['ETag']
+        PostFactory(title='Second Post', slug='my-second-post',
+                    pub_date=timezone.now() + timedelta(days=1))
+        response = self.client.get('/feeds/posts/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+
+    def test_edited_feed_is_modified(self):
+        # Create an older and a newer post, and fetch the feed
+        older = PostFactory(pub_date=timezone.now() - timedelta(days=1))
+        PostFactory(title='Second Post', slug='my-second-post')
+        response = self.client.get('/feeds/posts/')
+        etag = response['ETag']
+
+        # Check editing the older post changes the validators
+        older.title = 'Edited Post'
+        older.save()
+        response = self.client.get('/feeds/posts/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('Edited Post' in response.content)
+        self.assertNotEquals(response['ETag'], etag)
+
+        # Check deleting it does as well
+        etag = response['ETag']
+        older.delete()
+        response = self.client.get('/feeds/posts/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertFalse('Edited Post' in response.content)
+
 class FlatPageViewTest(BaseAcceptanceTest):
     def test_create_flat_page(self):
         # Create flat page
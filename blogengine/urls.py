@@ -1,35 +1,52 @@
 from django.conf.urls import patterns, url
-from django.views.generic import ListView, DetailView
-from blogengine.models import Post, Category, Tag
-from blogengine.views import CategoryListView, TagListView, PostsFeed, CategoryPostsFeed
+from blogengine.views import (PostListView, PostDetailView, CategoryListView,
+                              TagListView, MonthListView, YearArchiveView, SearchView,
+                              PostsFeed, CategoryPostsFeed, metrics_report, post_archive,
+                              most_read, sitemap_index, sitemap_section)
+from blogengine import api
+from blogengine.viewcounts import counted_view
+from blogengine.pagecache import cached_page
 
 urlpatterns = patterns('',
     # Index
-    url('^(?P<page>\d+)?/?$', ListView.as_view(
-        model = Post,
-        paginate_by=20
-        )
-    ),
+    url('^(?P<page>\d+)?/?$', cached_page(PostListView.as_view())),
 
     # Individual posts
-    url(r'^(?P<pub_date__year>\d{4})/(?P<pub_date__month>\d{1,2})/(?P<slug>[a-zA-Z0-9-]+)/?$', DetailView.as_view(
-        model = Post,
-        )
-    ),
+    url(r'^(?P<pub_date__year>\d{4})/(?P<pub_date__month>\d{1,2})/(?P<slug>[a-zA-Z0-9-]+)/?$', counted_view(cached_page(PostDetailView.as_view()))),
 
     # Categories
-    url(r'^category/(?P<slug>[a-zA-Z0-9-]+)/?$', CategoryListView.as_view(
-        paginate_by=10,
-        model=Category,
-        )
-    ),
+    url(r'^category/(?P<slug>[a-zA-Z0-9-]+)(?:/(?P<page>\d+))?/?$', cached_page(CategoryListView.as_view())),
 
     # Tags
-    url(r'^tag/(?P<slug>[a-zA-Z0-9-]+)/?$', TagListView.as_view(
-        paginate_by=10,
-        model=Tag,
-        )
-    ),
+    url(r'^tag/(?P<slug>[a-zA-Z0-9-]+)(?:/(?P<page>\d+))?/?$', cached_page(TagListView.as_view())),
+
+    # Date archive
+    url(r'^archive/(?P<year>\d{4})/?$', cached_page(YearArchiveView.as_view())),
+    url(r'^archive/(?P<year>\d{4})/(?P<month>\d{1,2})(?:/(?P<page>\d+))?/?$', cached_page(MonthListView.as_view())),
+
+    # Most read posts
+    url(r'^most-read/(?:(?P<days>\d+)/)?$', cached_page(most_read)),
+
+    # Search
+    url(r'^search/$', SearchView.as_view()),
+
+    # Archive of all posts
+    url(r'^archive/posts\.(?P<format>jsonl|ndjson)$', post_archive),
+
+    # JSON API
+    url(r'^api/posts/$', api.api_view(cached_page(api.post_list))),
+    url(r'^api/posts/(?P<post_id>\d+)/$', api.api_view(cached_page(api.post_detail))),
+    url(r'^api/categories/$', api.api_view(cached_page(api.category_list))),
+    url(r'^api/tags/$', api.api_view(cached_page(api.tag_list))),
+    url(r'^api/ingest/$', api.ingest_posts),
+    url(r'^api/ingest/(?P<job_id>\d+)/$', api.api_view(api.ingest_status)),
+
+    # Request metrics
+    url(r'^metrics/$', metrics_report),
+
+    # Sitemaps
+    url(r'^sitemap\.xml$', cached_page(sitemap_index)),
+    url(r'^sitemap-(?P<section>posts|categories|tags|pages)(?:-(?P<page>\d+))?\.xml$', cached_page(sitemap_section)),
 
     # Post RSS feed
     url(r'^feeds/posts/$', PostsFeed()),
@@ -0,0 +1,223 @@
+"""
+Counts how often each post's page is read, for the most read listing.
+
+A write per view would put an UPDATE on every hit, so views are buffered in
+process by post id and day, the id looked up by slug through slugcache, and
+written by a background thread every BLOGENGINE_VIEW_FLUSH_INTERVAL seconds,
+or sooner when BLOGENGINE_VIEW_BUFFER_SIZE views are waiting, so no request
+waits on the writes and an idle process still writes what it has. A flush
+moves the PostViewCount rows of the day already there with a single UPDATE,
+adding each row's own count, and creates the missing rows with
+bulk_create. Views are counted outside the page cache, so cached pages
+count as well.
+
+Each process keeps its own buffer and flushes it at exit; the views
+buffered in a process that dies are lost, which a popularity ranking can
+afford.
+
+most_read() sums the day rows of the last days, so it reads a row per post
+and day rather than one per view.
+"""
+import atexit
+import threading
+from collections import Counter
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.db.models import Sum
+from django.utils import timezone
+from blogengine import pagecache, slugcache
+from blogengine.models import Post, PostViewCount
+
+ATTEMPTS = 5
+# Seconds stop() waits for a flush under way
+STOP_TIMEOUT = 10
+# Rows per UPDATE; each takes three parameters, under SQLite's 999
+CHUNK_SIZE = 300
+
+def flush_interval():
+    return getattr(settings, 'BLOGENGINE_VIEW_FLUSH_INTERVAL', 60)
+
+def buffer_size():
+    return getattr(settings, 'BLOGENGINE_VIEW_BUFFER_SIZE', 1000)
+
+def most_read_days():
+    return getattr(settings, 'BLOGENGINE_MOST_READ_DAYS', 7)
+
+def today():
+    return timezone.localtime(timezone.now()).date()
+
+def chunks(items):
+    items = list(items)
+    for start in range(0, len(items), CHUNK_SIZE):
+        yield items[start:start + CHUNK_SIZE]
+
+def add_views(counts):
+    """
+    Adds a Counter of views by (post id, day) to the day rows.
+    """
+    rows = {}
+    for day in set(day for post_id, day in counts):
+        post_ids = [post_id for post_id, counted_day in counts if counted_day == day]
+        for chunk in chunks(post_ids):
+            rows.update(((post_id, day), row_id) for row_id, post_id in
+                        PostViewCount.objects.filter(day=day, post_id__in=chunk)
+                                             .values_list('id', 'post_id'))
+
+    # One UPDATE, each row moved by its own count
+    table = connection.ops.quote_name(PostViewCount._meta.db_table)
+    cursor = connection.cursor()
+    for chunk in chunks(rows.items()):
+        params = []
+        for key, row_id in chunk:
+            params.extend([row_id, counts[key]])
+        params.extend(row_id for key, row_id in chunk)
+        cursor.execute('UPDATE %s SET views = views + CASE id %s END WHERE id IN (%s)' % (
+            table, ' '.join(['WHEN %s THEN %s'] * len(chunk)), ', '.join(['%s'] * len(chunk))),
+            params)
+
+    PostViewCount.objects.bulk_create(
+        PostViewCount(post_id=post_id, day=day, views=views)
+        for (post_id, day), views in counts.items() if (post_id, day) not in rows)
+
+def write_views(counts):
+    """
+    Writes a Counter of views by (post id, day), returning how many were
+    of posts that still exist.
+    """
+    existing = set()
+    for chunk in chunks(set(post_id for post_id, day in counts)):
+        existing.update(Post.objects.filter(id__in=chunk).values_list('id', flat=True))
+    views = Counter(dict((key, count) for key, count in counts.items() if key[0] in existing))
+    if not views:
+        return 0
+
+    for attempt in range(ATTEMPTS):
+        try:
+            # Another process may create a missing row first
+            with transaction.atomic():
+                add_views(views)
+            break
+        except IntegrityError:
+            if attempt + 1 == ATTEMPTS:
+                raise
+    pagecache.invalidate(['most-read'])
+    return sum(views.values())
+
+class ViewBuffer(object):
+    """
+    Post views waiting to be written, by post id and day, and the thread
+    writing them.
+    """
+    def __init__(self):
+        self._counts = Counter()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._due = threading.Event()
+        self._thread = None
+        self._stopping = False
+
+    def __len__(self):
+        return self._pending
+
+    def record(self, post_id):
+        with self._lock:
+            self._counts[(post_id, today())] += 1
+            self._pending += 1
+            full = self._pending >= buffer_size()
+            # Started on the first view, and again in a forked process
+            if not self._stopping and (self._thread is None or not self._thread.is_alive()):
+                self._thread = threading.Thread(target=self.run, name='view-counts')
+                self._thread.daemon = True
+                self._thread.start()
+        if full:
+            self._due.set()
+
+    def run(self):
+        while True:
+            self._due.wait(flush_interval())
+            self._due.clear()
+            if self._stopping:
+                return
+            try:
+                self.flush()
+            finally:
+                # The thread's own connection, not to be held while idle
+                connection.close()
+
+    def write(self, counts):
+        return write_views(counts)
+
+    def flush(self):
+        """
+        Writes the buffered views, returning how many were written.
+        """
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+            self._pending = 0
+        if not counts:
+            return 0
+        try:
+            return self.write(counts)
+        except DatabaseError:
+            # Kept for the next flush
+            with self._lock:
+                self._counts.update(counts)
+                self._pending += sum(counts.values())
+            return 0
+
+    def stop(self):
+        """
+        Stops the thread and writes what is left, before the interpreter
+        tears the thread down mid-wait.
+        """
+        self._stopping = True
+        self._due.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(STOP_TIMEOUT)
+        return self.flush()
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+            self._pending = 0
+
+buffer = ViewBuffer()
+atexit.register(buffer.stop)
+
+def counted_view(view):
+    """
+    Counts the views of the post pages the view serves, found by their slug.
+    """
+    @wraps(view)
+    def counting_view(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        if request.method == 'GET' and response.status_code == 200:
+            post = slugcache.posts.get(kwargs['slug'])
+            if post is not None:
+                buffer.record(post.id)
+        return response
+    return counting_view
+
+def most_read(site, days, count):
+    """
+    Returns the count posts of the site read most in the last days, each
+    with its views in recent_views.
+    """
+    totals = (PostViewCount.objects.filter(day__gt=today() - timedelta(days=days),
+                                           post__site=site)
+                                   .values_list('post')
+                                   .annotate(views=Sum('views'))
+                                   .order_by('-views', '-post')[:count])
+    totals = list(totals)
+    posts = Post.objects.only('title', 'slug', 'pub_date').in_bulk(
+        [post_id for post_id, views in totals])
+    ranked = []
+    for post_id, views in totals:
+        # Posts deleted since are left out
+        if post_id in posts:
+            posts[post_id].recent_views = views
+            ranked.append(posts[post_id])
+    return ranked
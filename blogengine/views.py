@@ -1,71 +1,426 @@
+from urllib import urlencode
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib.flatpages.models import FlatPage
+from django.contrib.flatpages.views import render_flatpage
+from django.core.paginator import EmptyPage
+from django.http import (Http404, HttpResponsePermanentRedirect, JsonResponse,
+                         StreamingHttpResponse)
+from django.template.response import TemplateResponse
 from django.shortcuts import render
-from django.views.generic import ListView
-from blogengine.models import Category, Post, Tag
+from django.views.generic import DetailView, ListView
+from blogengine.models import Category, MonthCount, Post, Tag, load_stale_text
 from django.contrib.syndication.views import Feed
-from django.utils.encoding import force_unicode
 from django.utils.safestring import mark_safe
 from django.shortcuts import get_object_or_404
-import markdown2
+from django.views.decorators.http import condition
+from blogengine import (archive, feedcache, metrics, months, pagecache, related, search,
+                        sitemaps, slugcache, viewcounts)
+from blogengine.sites import request_site, site_url
+from blogengine.pagination import CursorPage, paginate_by_cursor
+from blogengine.rendering import render_cache
+
+# Columns only needed to show a whole post, left unread where excerpts are
+# shown
+FULL_TEXT_FIELDS = ('text', 'rendered_text', 'text_hash')
 
 # Create your views here.
-class CategoryListView(ListView):
-    template_name = 'blogengine/category_post_list.html'
+def post_queryset(site, full_text=True):
+    # Everything the post templates touch, fetched up front
+    posts = (Post.objects.for_site(site)
+                         .select_related('category', 'author', 'site')
+                         .prefetch_related('tags')
+                         .order_by('-pub_date', '-id'))
+    if not full_text:
+        posts = posts.defer(*FULL_TEXT_FIELDS)
+    return posts
+
+class PostListView(ListView):
+    model = Post
+    paginate_by = 20
+    # 'offset' or 'cursor', defaults to BLOGENGINE_PAGINATION
+    pagination = None
+    # Whole posts rather than excerpts, defaults to BLOGENGINE_LIST_FULL_TEXT
+    full_text = None
+
+    def get_full_text(self):
+        if self.full_text is not None:
+            return self.full_text
+        return getattr(settings, 'BLOGENGINE_LIST_FULL_TEXT', False)
+
+    def get_posts(self):
+        return post_queryset(request_site(self.request), self.get_full_text())
 
     def get_queryset(self):
-        slug = self.kwargs['slug']
+        return self.get_posts()
+
+    def get_listing_url(self):
+        return '/'
+
+    def get_page_dependencies(self):
+        return ['posts']
+
+    def get_pagination(self):
+        # Numbered page URLs keep working whatever the mode
+        if self.kwargs.get('page') or self.request.GET.get('page'):
+            return 'offset'
+        return self.pagination or getattr(settings, 'BLOGENGINE_PAGINATION', 'offset')
+
+    def paginate_queryset(self, queryset, page_size):
+        if self.get_pagination() != 'cursor':
+            return super(PostListView, self).paginate_queryset(queryset, page_size)
+
         try:
-            category = Category.objects.get(slug=slug)
-            return Post.objects.filter(category=category)
-        except Category.DoesNotExist:
+            page = paginate_by_cursor(queryset, page_size,
+                                      after=self.request.GET.get('after'),
+                                      before=self.request.GET.get('before'))
+        except ValueError:
+            raise Http404("Invalid page cursor")
+        return (None, page, page.object_list, page.has_other_pages())
+
+    def get_context_data(self, **kwargs):
+        context = super(PostListView, self).get_context_data(**kwargs)
+        context['site'] = request_site(self.request)
+        context['archive_months'] = months.site_months(context['site'])
+        context['full_text'] = self.get_full_text()
+        pagecache.depends_on(self.request, 'months', 'post-counts',
+                             *self.get_page_dependencies())
+        for post in context['object_list']:
+            pagecache.depends_on(self.request, *pagecache.post_dependencies(post))
+        if not context['full_text']:
+            load_stale_text(context['object_list'])
+
+        page = context['page_obj']
+        url = self.get_listing_url()
+        context['next_page_url'] = None
+        context['previous_page_url'] = None
+        if page is None:
+            return context
+
+        if isinstance(page, CursorPage):
+            if page.has_next():
+                context['next_page_url'] = '%s?after=%s' % (url, page.next_cursor())
+            if page.has_previous():
+                context['previous_page_url'] = '%s?before=%s' % (url, page.previous_cursor())
+        else:
+            if page.has_next():
+                context['next_page_url'] = self.get_page_url(page.next_page_number())
+            if page.has_previous():
+                context['previous_page_url'] = self.get_page_url(page.previous_page_number())
+        return context
+
+    def get_page_url(self, number):
+        url = self.get_listing_url()
+        return url if number == 1 else '%s%d/' % (url, number)
+
+class PostDetailView(DetailView):
+    model = Post
+
+    def get_queryset(self):
+        return post_queryset(request_site(self.request))
+
+    def get_object(self, queryset=None):
+        post = super(PostDetailView, self).get_object(queryset)
+        pagecache.depends_on(self.request, *pagecache.post_dependencies(post))
+        return post
+
+    def get_context_data(self, **kwargs):
+        context = super(PostDetailView, self).get_context_data(**kwargs)
+        context['related_posts'] = related.related_posts(self.object)
+        pagecache.depends_on(self.request, 'related:%d' % self.object.id,
+                             *['post:%d' % post.id for post in context['related_posts']])
+        return context
+
+class CategoryListView(PostListView):
+    template_name = 'blogengine/category_post_list.html'
+    paginate_by = 10
+
+    def get_listing_url(self):
+        return '/category/%s/' % self.kwargs['slug']
+
+    def get_page_dependencies(self):
+        dependencies = ['category-slug:%s' % self.kwargs['slug']]
+        if self.category is not None:
+            dependencies.append('category:%d' % self.category.id)
+            dependencies.append('category-posts:%d' % self.category.id)
+        return dependencies
+
+    def get_queryset(self):
+        self.category = slugcache.categories.get(self.kwargs['slug'])
+        if self.category is None:
             return Post.objects.none()
+        return self.get_posts().filter(category_id=self.category.id)
 
     def get_context_data(self, **kwargs):
         context = super(CategoryListView, self).get_context_data(**kwargs)
-        slug = self.kwargs['slug']
-        try:
-            context['category'] = Category.objects.get(slug=slug)
-        except Category.DoesNotExist:
-            context['category'] = None
+        context['category'] = self.category
         return context
 
-class TagListView(ListView):
+class TagListView(PostListView):
+    paginate_by = 10
+
+    def get_listing_url(self):
+        return '/tag/%s/' % self.kwargs['slug']
+
+    def get_page_dependencies(self):
+        dependencies = ['tag-slug:%s' % self.kwargs['slug']]
+        if self.tag is not None:
+            dependencies.append('tag-posts:%d' % self.tag.id)
+        return dependencies
+
     def get_queryset(self):
-        slug = self.kwargs['slug']
-        try:
-            tag = Tag.objects.get(slug=slug)
-            return tag.post_set.all()
-        except Tag.DoesNotExist:
+        self.tag = slugcache.tags.get(self.kwargs['slug'])
+        if self.tag is None:
             return Post.objects.none()
+        return self.get_posts().filter(tags=self.tag.id)
+
+class MonthListView(PostListView):
+    paginate_by = 10
+
+    def get_listing_url(self):
+        return '/archive/%d/%d/' % (int(self.kwargs['year']), int(self.kwargs['month']))
+
+    def get_queryset(self):
+        year, month = int(self.kwargs['year']), int(self.kwargs['month'])
+        if not (1 <= year < 9999 and 1 <= month <= 12):
+            raise Http404("Invalid month")
+        # A range on pub_date, which the listing indexes lead with
+        start, end = months.month_range(year, month)
+        return self.get_posts().filter(pub_date__gte=start, pub_date__lt=end)
+
+    def get_context_data(self, **kwargs):
+        context = super(MonthListView, self).get_context_data(**kwargs)
+        context['month'] = months.month_range(int(self.kwargs['year']),
+                                              int(self.kwargs['month']))[0]
+        return context
+
+class YearArchiveView(ListView):
+    model = MonthCount
+    template_name = 'blogengine/year_archive.html'
+    allow_empty = False
+
+    def get_queryset(self):
+        return months.site_months(request_site(self.request)).filter(year=self.kwargs['year'])
+
+    def get_context_data(self, **kwargs):
+        context = super(YearArchiveView, self).get_context_data(**kwargs)
+        context['year'] = self.kwargs['year']
+        context['archive_months'] = months.site_months(request_site(self.request))
+        pagecache.depends_on(self.request, 'months')
+        return context
+
+class SearchView(PostListView):
+    template_name = 'blogengine/search_results.html'
+    pagination = 'offset'
+
+    def get_query(self):
+        return self.request.GET.get('q', '').strip()
+
+    def get_listing_url(self):
+        return '/search/?%s' % urlencode({'q': self.get_query().encode('utf-8')})
+
+    def get_page_url(self, number):
+        url = self.get_listing_url()
+        return url if number == 1 else '%s&page=%d' % (url, number)
+
+    def get_queryset(self):
+        return search.SearchResults(self.get_query(), request_site(self.request),
+                                    self.get_posts())
+
+    def get_context_data(self, **kwargs):
+        context = super(SearchView, self).get_context_data(**kwargs)
+        context['query'] = self.get_query()
+        return context
+
+# Longest period the most read listing sums
+MAX_MOST_READ_DAYS = 365
+
+def most_read(request, days=None):
+    site = request_site(request)
+    days = int(days) if days else viewcounts.most_read_days()
+    if not 1 <= days <= MAX_MOST_READ_DAYS:
+        raise Http404("Invalid number of days")
+    posts = viewcounts.most_read(site, days, getattr(settings, 'BLOGENGINE_MOST_READ_POSTS', 10))
+    pagecache.depends_on(request, 'most-read', 'months',
+                         *['post:%d' % post.id for post in posts])
+    return TemplateResponse(request, 'blogengine/most_read.html', {
+        'posts': posts,
+        'days': days,
+        'archive_months': months.site_months(site),
+    })
+
+def flatpage(request, url):
+    """
+    Django's flatpage view, looking the page up on the request's site
+    rather than the SITE_ID one.
+    """
+    if not url.startswith('/'):
+        url = '/' + url
+    pages = FlatPage.objects.filter(sites=request_site(request))
+    try:
+        page = get_object_or_404(pages, url=url)
+    except Http404:
+        if url.endswith('/') or not settings.APPEND_SLASH:
+            raise
+        get_object_or_404(pages, url=url + '/')
+        return HttpResponsePermanentRedirect('%s/' % request.path)
+    return render_flatpage(request, page)
+
+def sitemap_url(request, section, page):
+    return '%s:%s' % (request.scheme, site_url(request_site(request),
+                                               sitemaps.sitemap_path(section, page)))
+
+def sitemap_index(request):
+    site = request_site(request)
+    locations = [sitemap_url(request, section, page)
+                 for section, page in sitemaps.sitemap_pages(site)]
+    pagecache.depends_on(request, 'sitemap-index:%d' % site.id, 'post-counts')
+    return TemplateResponse(request, 'sitemap_index.xml', {'sitemaps': locations},
+                            content_type='application/xml')
+
+def sitemap_section(request, section, page=None):
+    site = request_site(request)
+    sitemap = sitemaps.sitemaps[section](site)
+    page = int(page or 1)
+    try:
+        urls = sitemap.get_urls(page=page, site=site, protocol=request.scheme)
+    except EmptyPage:
+        raise Http404("No sitemap page %d" % page)
+    pagecache.depends_on(request, *sitemap.dependencies(page))
+    return TemplateResponse(request, 'sitemap.xml', {'urlset': urls},
+                            content_type='application/xml')
+
+@staff_member_required
+def post_archive(request, format):
+    # JSON lines and NDJSON are the same thing under two names
+    content_type = 'application/x-ndjson' if format == 'ndjson' else 'application/jsonl'
+    response = StreamingHttpResponse(archive.archive_lines(), content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename=posts.%s' % format
+    return response
+
+@staff_member_required
+def metrics_report(request):
+    report = metrics.registry.report()
+    report['render_cache'] = render_cache.stats()
+    return JsonResponse(report)
+
+def feed_item_limit():
+    return getattr(settings, 'BLOGENGINE_FEED_ITEMS', 20)
+
+def feed_full_text():
+    return getattr(settings, 'BLOGENGINE_FEED_FULL_TEXT', False)
 
 class PostsFeed(Feed):
     title = "RSS feed - posts"
-    link = "feeds/posts/"
     description = "RSS feed - blog posts"
+    # Whole posts rather than excerpts, defaults to BLOGENGINE_FEED_FULL_TEXT
+    full_text = None
+
+    def get_full_text(self):
+        return feed_full_text() if self.full_text is None else self.full_text
+
+    def __call__(self, request, *args, **kwargs):
+        # Answer unchanged polls with a 304, by the validators stored with
+        # the feed's XML
+        view = condition(etag_func=self.etag,
+                         last_modified_func=self.last_modified)(self.serve_feed)
+        return view(request, *args, **kwargs)
+
+    def stored_feed(self, request, *args, **kwargs):
+        # Looked up once for the validators and the response
+        if not hasattr(request, 'stored_feed'):
+            site = request_site(request)
+            slug = kwargs.get('slug')
+            feed = feedcache.get_feed(site.id, slug)
+            if feed is None:
+                response = self.render_feed(request, *args, **kwargs)
+                feed = feedcache.store_feed_response(site.id, slug, response,
+                                                     self.validated_posts(request))
+            request.stored_feed = feed
+        return request.stored_feed
+
+    def serve_feed(self, request, *args, **kwargs):
+        return feedcache.feed_response(self.stored_feed(request, *args, **kwargs))
+
+    def render_feed(self, request, *args, **kwargs):
+        return super(PostsFeed, self).__call__(request, *args, **kwargs)
+
+    def get_feed(self, obj, request):
+        # Kept for validated_posts()
+        request.feed_object = obj
+        return super(PostsFeed, self).get_feed(obj, request)
+
+    def validated_posts(self, request):
+        # The rows of the posts of the feed just rendered, for its validators
+        posts = self.item_posts(request.feed_object).order_by('-pub_date', '-id')
+        return list(posts.values_list(*feedcache.VALIDATED_FIELDS)[:feed_item_limit()])
+
+    def get_object(self, request):
+        return request_site(request)
+
+    def etag(self, request, *args, **kwargs):
+        return self.stored_feed(request, *args, **kwargs)[2]
+
+    def last_modified(self, request, *args, **kwargs):
+        return self.stored_feed(request, *args, **kwargs)[3]
 
-    def items(self):
-        return Post.objects.order_by('-pub_date')
+    # Links are built from the request's site here, as Feed would use the
+    # SITE_ID site's domain
+    def link(self, site):
+        return site_url(site, '/')
+
+    def feed_url(self, site):
+        return site_url(site, feedcache.feed_path())
+
+    def feed_items(self, posts):
+        posts = posts.order_by('-pub_date', '-id').select_related('site').prefetch_related('tags')
+        if self.get_full_text():
+            return posts[:feed_item_limit()]
+        return load_stale_text(list(posts.defer(*FULL_TEXT_FIELDS)[:feed_item_limit()]))
+
+    def item_posts(self, site):
+        return Post.objects.for_site(site)
+
+    def items(self, obj):
+        return self.feed_items(self.item_posts(obj))
 
     def item_title(self, item):
         return item.title
 
+    def item_link(self, item):
+        return site_url(item.site, item.get_absolute_url())
+
+    # Also dates the feed by its newest post rather than the time it's built
+    def item_pubdate(self, item):
+        return item.pub_date
+
     def item_description(self, item):
-        extras = ["fenced-code-blocks"]
-        content = mark_safe(markdown2.markdown(force_unicode(item.text),
-                                                extras = extras))
-        return content
+        if not self.get_full_text():
+            return mark_safe(item.get_excerpt())
+        with metrics.timed('markdown'):
+            return mark_safe(item.get_rendered_text())
+
+    def item_categories(self, item):
+        return [tag.name for tag in item.tags.all()]
 
 class CategoryPostsFeed(PostsFeed):
     def get_object(self, request, slug):
-        return get_object_or_404(Category, slug=slug)
+        category = get_object_or_404(Category, slug=slug)
+        category.site = request_site(request)
+        return category
 
     def title(self, obj):
         return "RSS feed - blog posts in category %s" % obj.name
 
     def link(self, obj):
-        return obj.get_absolute_url()
+        return site_url(obj.site, obj.get_absolute_url())
+
+    def feed_url(self, obj):
+        return site_url(obj.site, feedcache.feed_path(obj.slug))
 
     def description(self, obj):
         return "RSS feed - blog posts in category %s" % obj.name
 
-    def items(self, obj):
-        return Post.objects.filter(category=obj).order_by('-pub_date')
+    def item_posts(self, obj):
+        return Post.objects.for_site(obj.site).filter(category=obj)
@@ -40,9 +40,12 @@ INSTALLED_APPS = (
     'django.contrib.sites',
     'django.contrib.flatpages',
     'django.contrib.syndication',
+    'django.contrib.sitemaps',
 )
 
 MIDDLEWARE_CLASSES = (
+    'blogengine.metrics.MetricsMiddleware',
+    'blogengine.feedcache.FeedRebuildMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -50,6 +53,18 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'blogengine.sites.CurrentSiteMiddleware',
+)
+
+TEMPLATE_CONTEXT_PROCESSORS = (
+    'django.contrib.auth.context_processors.auth',
+    'django.core.context_processors.debug',
+    'django.core.context_processors.i18n',
+    'django.core.context_processors.media',
+    'django.core.context_processors.static',
+    'django.core.context_processors.tz',
+    'django.contrib.messages.context_processors.messages',
+    'blogengine.context_processors.navigation',
 )
 
 ROOT_URLCONF = 'metis.urls'
@@ -90,3 +105,70 @@ STATIC_URL = '/static/'
 TEMPLATE_DIRS = [os.path.join(BASE_DIR, 'templates')]
 
 SITE_ID = 1
+
+# Blog engine
+
+# Rendered Markdown is cached in a bounded in-process LRU in front of this
+# Django cache
+BLOGENGINE_RENDER_CACHE = 'default'
+BLOGENGINE_RENDER_CACHE_SIZE = 512
+
+# Number of most recent posts served in each RSS feed
+BLOGENGINE_FEED_ITEMS = 20
+
+# Only drop cached feed XML on saves, for the next request to rebuild, rather
+# than rebuild it during the save; the cache must be shared by all processes,
+# and entries expire after BLOGENGINE_FEED_CACHE_TIMEOUT seconds in case one
+# is missed
+BLOGENGINE_FEED_CACHE = 'default'
+BLOGENGINE_FEED_CACHE_ASYNC = False
+BLOGENGINE_FEED_CACHE_TIMEOUT = 10 * 60
+
+# Page through post listings by (pub_date, id) cursor rather than page number
+BLOGENGINE_PAGINATION = 'cursor'
+
+# Category and tag slug and site domain lookups are kept in-process, up to
+# BLOGENGINE_SLUG_CACHE_SIZE per model, invalidated through a generation
+# token in this Django cache
+BLOGENGINE_SLUG_CACHE = 'default'
+BLOGENGINE_SLUG_CACHE_SIZE = 10000
+
+# Whole pages served to anonymous visitors, purged per object on save; the
+# timeout is only a backstop
+BLOGENGINE_PAGE_CACHE = 'default'
+BLOGENGINE_PAGE_CACHE_TIMEOUT = 24 * 60 * 60
+
+# 'fts5' on SQLite builds with FTS5, 'python' for the portable SearchTerm
+# index, or 'auto' to pick FTS5 where its table exists
+BLOGENGINE_SEARCH_BACKEND = 'auto'
+
+# Number of related posts kept for each post; a saved post is compared with
+# the posts sharing its tags and this many of the most recent ones
+BLOGENGINE_RELATED_POSTS = 5
+BLOGENGINE_RELATED_WINDOW = 200
+
+# Send each request's query, template and Markdown timings and cache hits
+# back in a Server-Timing header, to anyone, so only while debugging;
+# /metrics/ reports them either way
+BLOGENGINE_SERVER_TIMING = DEBUG
+
+# Ingestion API tokens of the outside news sources, each mapped to the
+# username their posts are by, e.g. {'<token>': 'newsdesk'}; jobs left
+# running this many seconds by a worker that died are queued again
+BLOGENGINE_INGEST_TOKENS = {}
+BLOGENGINE_INGEST_TIMEOUT = 10 * 60
+
+# Show whole posts on the listings and in the feeds instead of their stored
+# excerpts, which lets those queries skip the post bodies; views can also
+# set full_text themselves
+BLOGENGINE_LIST_FULL_TEXT = False
+BLOGENGINE_FEED_FULL_TEXT = False
+
+# Post views are buffered in each process and written together by a
+# background thread every BLOGENGINE_VIEW_FLUSH_INTERVAL seconds, or once
+# this many are waiting; the most read listing covers the last
+# BLOGENGINE_MOST_READ_DAYS days unless its URL names another number
+BLOGENGINE_VIEW_FLUSH_INTERVAL = 60
+BLOGENGINE_VIEW_BUFFER_SIZE = 1000
+BLOGENGINE_MOST_READ_DAYS = 7
+BLOGENGINE_MOST_READ_POSTS = 10
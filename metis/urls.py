@@ -1,6 +1,8 @@
 from django.conf.urls import patterns, include, url
 
 from django.contrib import admin
+from blogengine.pagecache import cached_page
+from blogengine.views import flatpage
 admin.autodiscover()
 
 urlpatterns = patterns('',
@@ -14,5 +16,5 @@ urlpatterns = patterns('',
     url(r'', include('blogengine.urls')),
 
     # Flat pages
-    url(r'', include('django.contrib.flatpages.urls')),
+    url(r'^(?P<url>.*)$', cached_page(flatpage)),
 )